@@ -0,0 +1,160 @@
+import alpaca_trade_api as tradeapi
+import argparse
+import collections
+import datetime
+import logging
+import realtime
+import threading
+import time
+import utils
+import uuid
+from tabulate import tabulate
+
+Clock = collections.namedtuple('Clock', ['is_open', 'next_close'])
+Account = collections.namedtuple('Account', ['equity', 'cash'])
+Position = collections.namedtuple('Position', ['symbol', 'qty', 'current_price',
+                                               'market_value', 'cost_basis'])
+Order = collections.namedtuple('Order', ['id', 'client_order_id', 'symbol', 'qty', 'side',
+                                         'type', 'limit_price', 'status', 'submitted_at'])
+
+
+class FakeBroker(object):
+    """In-memory stand-in for the Alpaca REST API, for tests and latency benchmarks.
+
+    Every call takes latency seconds. Submitted orders fill at the current
+    price after fill_delay seconds, and trade updates are sent to subscribers.
+    Duplicate client order IDs are rejected like the real API.
+    """
+
+    def __init__(self, prices, cash=100000, latency=0.05, fill_delay=0.5, next_close=None,
+                 clock=time):
+        self.prices = prices
+        self.cash = cash
+        self.latency = latency
+        self.fill_delay = fill_delay
+        self.clock = clock
+        self.next_close = next_close or datetime.datetime.now() + datetime.timedelta(hours=1)
+        self.positions = {}
+        self.orders = collections.OrderedDict()
+        self.subscribers = []
+        self.lock = threading.RLock()
+        self.call_count = 0
+
+    def _call(self):
+        with self.lock:
+            self.call_count += 1
+        self.clock.sleep(self.latency)
+
+    def subscribe(self, on_trade_update):
+        self.subscribers.append(on_trade_update)
+
+    def get_clock(self):
+        self._call()
+        return Clock(True, self.next_close)
+
+    def get_account(self):
+        self._call()
+        with self.lock:
+            equity = self.cash + sum(qty * self.prices[symbol] for symbol, qty in self.positions.items())
+            return Account(str(equity), str(self.cash))
+
+    def list_positions(self):
+        self._call()
+        with self.lock:
+            return [Position(symbol, str(qty), str(self.prices[symbol]),
+                             str(qty * self.prices[symbol]), str(qty * self.prices[symbol]))
+                    for symbol, qty in self.positions.items() if qty]
+
+    def list_orders(self, status='open'):
+        self._call()
+        with self.lock:
+            return [order for order in self.orders.values() if status == 'all' or order.status == status]
+
+    def submit_order(self, symbol, qty, side, type, time_in_force, limit_price=None,
+                     client_order_id=None):
+        self._call()
+        with self.lock:
+            if client_order_id and any(order.client_order_id == client_order_id
+                                       for order in self.orders.values()):
+                raise tradeapi.rest.APIError({'code': 40010001,
+                                              'message': 'client_order_id must be unique'})
+            order = Order(str(uuid.uuid4()), client_order_id or str(uuid.uuid4()), symbol, int(qty),
+                          side, type, limit_price, 'open', self.clock.time())
+            self.orders[order.id] = order
+        timer = threading.Timer(self.fill_delay, self._fill, args=(order.id,))
+        timer.daemon = True
+        timer.start()
+        return order
+
+    def _fill(self, order_id):
+        with self.lock:
+            order = self.orders[order_id]
+            if order.status != 'open':
+                return
+            price = self.prices[order.symbol]
+            if order.type == 'limit' and ((order.side == 'buy' and price > order.limit_price) or
+                                          (order.side == 'sell' and price < order.limit_price)):
+                return
+            sign = 1 if order.side == 'buy' else -1
+            self.positions[order.symbol] = self.positions.get(order.symbol, 0) + sign * order.qty
+            self.cash -= sign * order.qty * price
+            order = order._replace(status='filled')
+            self.orders[order_id] = order
+        self._publish('fill', order)
+
+    def cancel_all_orders(self):
+        self._call()
+        canceled = []
+        with self.lock:
+            for order_id, order in self.orders.items():
+                if order.status == 'open':
+                    self.orders[order_id] = order._replace(status='canceled')
+                    canceled.append(self.orders[order_id])
+        for order in canceled:
+            self._publish('canceled', order)
+
+    def _publish(self, event, order):
+        for on_trade_update in self.subscribers:
+            on_trade_update(event, order._asdict())
+
+
+def benchmark(n_orders, latency, fill_delay):
+    """Compares serial and concurrent order submission against the fake broker."""
+    benchmark_table = []
+    prices = {'SYM%d' % (i,): 100.0 for i in range(n_orders)}
+    orders = [realtime.OrderRequest(symbol, 10, 'buy', 'market', None) for symbol in prices]
+    for max_workers in [1, realtime.ORDER_WORKERS]:
+        broker = FakeBroker(prices, latency=latency, fill_delay=fill_delay)
+        filled = threading.Event()
+        fill_count = [0]
+
+        def on_trade_update(event, _):
+            fill_count[0] += 1
+            if fill_count[0] == n_orders:
+                filled.set()
+
+        broker.subscribe(on_trade_update)
+        start_time = time.time()
+        realtime.submit_orders(broker, orders, [realtime.get_client_order_id(order, 1) for order in orders],
+                               max_workers)
+        submit_secs = time.time() - start_time
+        filled.wait(fill_delay + 10)
+        fill_secs = time.time() - start_time
+        benchmark_table.append([max_workers, n_orders, '%.3f' % (submit_secs,), '%.3f' % (fill_secs,)])
+    logging.info(utils.get_header('Order Submission Benchmark') + '\n' +
+                 tabulate(benchmark_table, headers=['Workers', 'Orders', 'Submit Seconds', 'All Filled Seconds'],
+                          tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark order submission against a fake broker.')
+    parser.add_argument('--orders', default=16, type=int, help='Number of orders.')
+    parser.add_argument('--latency', default=0.1, type=float, help='Seconds of each API call.')
+    parser.add_argument('--fill_delay', default=0.5, type=float, help='Seconds for an order to fill.')
+    args = parser.parse_args()
+    utils.logging_config()
+    benchmark(args.orders, args.latency, args.fill_delay)
+
+
+if __name__ == '__main__':
+    main()
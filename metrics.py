@@ -0,0 +1,128 @@
+import collections
+import math
+import numpy as np
+import os
+import threading
+import utils
+from tabulate import tabulate
+
+# Upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf)
+# Number of latest observations kept per series for percentiles
+MAX_SAMPLES = 10000
+
+
+class Histogram(object):
+    """Histogram of observations with cumulative buckets, like Prometheus histograms.
+
+    The latest observations are also kept for exact percentiles in summaries.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.samples.append(value)
+
+    def get_cumulative_counts(self):
+        return list(np.cumsum(self.counts))
+
+
+class MetricsRegistry(object):
+    """Latency histograms and gauges of named metrics, with optional labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+
+    def observe(self, name, value, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, help_text)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def set(self, name, value, help_text='', **labels):
+        with self.lock:
+            self.help.setdefault(name, help_text)
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def get_samples(self, name, **labels):
+        with self.lock:
+            histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+            return list(histogram.samples) if histogram else []
+
+    def to_prometheus(self):
+        """Formats all metrics in the Prometheus text exposition format."""
+        lines = []
+        typed = set()
+
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{%s}' % (','.join('%s="%s"' % (key, value) for key, value in labels),)
+
+        def add_header(name, metric_type):
+            if name in typed:
+                return
+            typed.add(name)
+            if self.help.get(name):
+                lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                add_header(name, 'histogram')
+                for bound, count in zip(histogram.buckets, histogram.get_cumulative_counts()):
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', le),)), count))
+                lines.append('%s_sum%s %r' % (name, format_labels(labels), float(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+            for (name, labels), value in self.gauges.items():
+                add_header(name, 'gauge')
+                lines.append('%s%s %r' % (name, format_labels(labels), float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def format_summary(self):
+        """Formats percentiles of histograms and values of gauges as tables."""
+        summary_table = []
+        gauge_table = []
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                samples = list(histogram.samples)
+                summary_table.append([name, ', '.join('%s=%s' % label for label in labels), histogram.count,
+                                      '%.3f' % (histogram.sum / histogram.count,)] +
+                                     ['%.3f' % (np.percentile(samples, q),) for q in (50, 90, 99)] +
+                                     ['%.3f' % (np.max(samples),)])
+            for (name, labels), value in self.gauges.items():
+                gauge_table.append([name, ', '.join('%s=%s' % label for label in labels), '%.3f' % (value,)])
+        outputs = [utils.get_header('Latencies'),
+                   tabulate(summary_table, headers=['Metric', 'Labels', 'Count', 'Mean', 'P50', 'P90', 'P99', 'Max'],
+                            tablefmt='grid')]
+        if gauge_table:
+            outputs.extend([utils.get_header('Gauges'),
+                            tabulate(gauge_table, headers=['Metric', 'Labels', 'Value'], tablefmt='grid')])
+        return '\n'.join(outputs)
+
+    def write(self, metrics_file, summary_file=None):
+        """Writes metrics in Prometheus text format, and optionally a summary."""
+        tmp_file = metrics_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_file, metrics_file)
+        if summary_file:
+            with open(summary_file, 'w') as f:
+                f.write(self.format_summary() + '\n')
@@ -0,0 +1,46 @@
+import metrics
+import os
+import tempfile
+import unittest
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        for value in [0.02, 0.2, 2]:
+            self.registry.observe('refresh_cycle_seconds', value, 'Refresh time.', tier=10)
+        self.registry.observe('score_seconds', 0.5)
+        self.registry.set('close_step_seconds_left', 88, step='Trade Start')
+
+    def test_to_prometheus(self):
+        lines = self.registry.to_prometheus().splitlines()
+        self.assertIn('# HELP refresh_cycle_seconds Refresh time.', lines)
+        self.assertIn('# TYPE refresh_cycle_seconds histogram', lines)
+        self.assertIn('refresh_cycle_seconds_bucket{tier="10",le="0.025"} 1', lines)
+        self.assertIn('refresh_cycle_seconds_bucket{tier="10",le="2.5"} 3', lines)
+        self.assertIn('refresh_cycle_seconds_bucket{tier="10",le="+Inf"} 3', lines)
+        self.assertIn('refresh_cycle_seconds_count{tier="10"} 3', lines)
+        self.assertIn('score_seconds_sum 0.5', lines)
+        self.assertIn('# TYPE close_step_seconds_left gauge', lines)
+        self.assertIn('close_step_seconds_left{step="Trade Start"} 88.0', lines)
+
+    def test_get_samples(self):
+        self.assertEqual(self.registry.get_samples('refresh_cycle_seconds', tier=10), [0.02, 0.2, 2])
+        self.assertEqual(self.registry.get_samples('refresh_cycle_seconds', tier=100), [])
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as d:
+            metrics_file = os.path.join(d, 'metrics.prom')
+            summary_file = os.path.join(d, 'summary.txt')
+            self.registry.write(metrics_file, summary_file)
+            with open(metrics_file) as f:
+                self.assertEqual(f.read(), self.registry.to_prometheus())
+            with open(summary_file) as f:
+                summary = f.read()
+        self.assertIn('refresh_cycle_seconds', summary)
+        self.assertIn('tier=10', summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
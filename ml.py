@@ -1,18 +1,56 @@
 import argparse
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import logging
 import os
 import pandas as pd
 import pickle
+import profiling
+import shutil
+import time
 import utils
 from sklearn.model_selection import KFold
 from sklearn import ensemble
 from sklearn import metrics
 from tabulate import tabulate
+from threadpoolctl import threadpool_limits
+try:
+    # Histogram gradient boosting is experimental before scikit-learn 1.0
+    from sklearn.experimental import enable_hist_gradient_boosting  # noqa: F401
+except ImportError:
+    pass
 
 NON_ML_FEATURE_COLUMNS = ['Gain', 'Symbol', 'Date']
+BACKENDS = ['forest', 'hist']
+DEFAULT_HYPER_PARAMETERS = {'forest': {'max_depth': 2,
+                                       'min_samples_leaf': 0.1,
+                                       'n_estimators': 100},
+                            'hist': {'max_depth': 3,
+                                     'min_samples_leaf': 100,
+                                     'max_iter': 100,
+                                     'learning_rate': 0.1,
+                                     'max_bins': 255}}
+SEARCH_SPACES = {'forest': {'max_depth': [2, 3, 5, 8],
+                            'min_samples_leaf': [0.01, 0.05, 0.1],
+                            'n_estimators': [50, 100, 200],
+                            'max_features': ['sqrt', 0.5, 1.0]},
+                 'hist': {'max_depth': [2, 3, 5, 8],
+                          'min_samples_leaf': [20, 100, 1000],
+                          'max_iter': [50, 100, 200],
+                          'learning_rate': [0.03, 0.1, 0.3]}}
+SEARCH_RESULT_COLUMNS = ['Parameters', 'Fold', 'Accuracy', 'Gain', 'Fit Seconds']
 
+# Dataset shared with worker processes. Arrays are memory-mapped from disk so
+# that workers read the same pages instead of receiving a pickled copy each.
+_shared_data = None
 
+
+@profiling.timed('reporting')
 def print_metrics(y_true, y_pred, y_meta, title_prefix='', r=None):
     outputs = []
     confusion_matrix_main = metrics.confusion_matrix(y_true, y_pred)
@@ -55,82 +93,261 @@ def print_metrics(y_true, y_pred, y_meta, title_prefix='', r=None):
     return accuracy_final, gain
 
 
+@profiling.timed('features')
 def process_data(df):
-    X, y, w, r = [], [], [], []
     logging.info('Processing data...')
-    for _, row in df.iterrows():
-        gain = row['Gain']
-        if gain >= 0:
-            y_value = 1
-        else:
-            y_value = 0
-        x_value = [row[col] for col in utils.ML_FEATURES]
-        X.append(x_value)
-        y.append(y_value)
-        w.append(np.abs(gain))
-        r.append(gain)
-    X = np.array(X)
-    y = np.array(y)
-    w = np.array(w)
-    r = np.array(r)
+    gain = df['Gain'].values
+    X = df[utils.ML_FEATURES].values
+    y = (gain >= 0).astype(np.int)
+    w = np.abs(gain)
+    r = np.array(gain)
     logging.info('%d data samples loaded', len(X))
     return X, y, w, r
 
 
+def filter_dates(df, start_date=None, end_date=None):
+    mask = np.ones(len(df), dtype=bool)
+    if start_date:
+        mask &= (df['Date'] >= start_date).values
+    if end_date:
+        mask &= (df['Date'] <= end_date).values
+    return df[mask]
+
+
+def iter_data_chunks(data_files, chunk_size, start_date=None, end_date=None):
+    """Reads data files in chunks of at most chunk_size rows."""
+    columns = utils.ML_FEATURES + NON_ML_FEATURE_COLUMNS
+    for data_file in data_files:
+        for chunk in pd.read_csv(data_file, usecols=columns, chunksize=chunk_size):
+            chunk = filter_dates(chunk.dropna(), start_date, end_date)
+            if len(chunk):
+                yield chunk
+
+
+class ChunkEnsemble(object):
+    """Averages models fitted on separate chunks of data.
+
+    Behaves like a single fitted sklearn estimator for predict(), so it is
+    persisted and loaded the same way as the in-memory models.
+    """
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.estimators = []
+
+    def add(self, estimator):
+        self.estimators.append(estimator)
+
+    def predict(self, X):
+        if not self.classifier:
+            return np.mean([estimator.predict(X) for estimator in self.estimators], axis=0)
+        probabilities = np.zeros(len(X))
+        for estimator in self.estimators:
+            classes = list(estimator.classes_)
+            if 1 in classes:
+                probabilities += estimator.predict_proba(X)[:, classes.index(1)]
+        return (probabilities / len(self.estimators) >= 0.5).astype(np.int)
+
+
+def make_models(backend, hyper_parameters, n_jobs=None):
+    """Creates unfitted main classifier and meta regressor of a backend."""
+    if backend == 'forest':
+        main_model = ensemble.RandomForestClassifier(n_jobs=n_jobs, **hyper_parameters)
+        meta_model = ensemble.RandomForestRegressor(n_jobs=n_jobs, **hyper_parameters)
+    elif backend == 'hist':
+        # Histogram models bin features once and are multi-threaded by OpenMP
+        main_model = ensemble.HistGradientBoostingClassifier(**hyper_parameters)
+        meta_model = ensemble.HistGradientBoostingRegressor(**hyper_parameters)
+    else:
+        raise ValueError('Invalid backend %s' % (backend,))
+    return main_model, meta_model
+
+
+def get_search_configs(mode, n_iter, backend='forest'):
+    """Lists hyper-parameter configurations to evaluate in a search."""
+    search_space = SEARCH_SPACES[backend]
+    keys = sorted(search_space.keys())
+    configs = [dict(zip(keys, values))
+               for values in itertools.product(*[search_space[key] for key in keys])]
+    if mode == 'random':
+        # Fixed seed so that a resumed search samples the same configurations
+        rng = np.random.RandomState(0)
+        indices = rng.choice(len(configs), min(n_iter, len(configs)), replace=False)
+        configs = [configs[i] for i in indices]
+    elif mode != 'grid':
+        raise ValueError('Invalid search mode %s' % (mode,))
+    return configs
+
+
+def _config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def _count_or_fraction(value):
+    """Parses a number as an int if integral, since scikit-learn reads floats as fractions."""
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _init_fold_worker(data_dir):
+    global _shared_data
+    # Workers already fit one fold each in parallel. OpenMP threads of histogram
+    # models, which ignore n_jobs, would otherwise oversubscribe the CPUs.
+    threadpool_limits(1)
+    _shared_data = tuple(np.load(os.path.join(data_dir, name + '.npy'), mmap_mode='r')
+                         for name in ['X', 'y', 'w', 'r'])
+
+
+def _evaluate_fold(task):
+    """Fits and tests one fold of one configuration in a worker process."""
+    backend, hyper_parameters, k, fold = task
+    X, y, w, r = _shared_data
+    k_fold = KFold(n_splits=k, shuffle=True, random_state=0)
+    train_index, test_index = list(k_fold.split(X))[fold - 1]
+    X_train, y_train, w_train, r_train = X[train_index], y[train_index], w[train_index], r[train_index]
+    X_test, y_test, r_test = X[test_index], y[test_index], r[test_index]
+    logging.info('[Fold %d] %d training samples, %d testing samples',
+                 fold, len(X_train), len(X_test))
+    fit_start = time.time()
+    main_model, meta_model = make_models(backend, hyper_parameters, n_jobs=1)
+    main_model.fit(X_train, y_train, sample_weight=w_train)
+    y_train_pred = main_model.predict(X_train)
+    y_diff = (y_train == y_train_pred).astype(np.int)
+    meta_model.fit(X_train, y_diff)
+    fit_seconds = time.time() - fit_start
+    y_train_meta = meta_model.predict(X_train)
+    print_metrics(y_train, y_train_pred, y_train_meta, 'Fold %d Training ' % (fold,), r_train)
+    y_test_pred = main_model.predict(X_test)
+    y_test_meta = meta_model.predict(X_test)
+    accuracy, gain = print_metrics(y_test, y_test_pred, y_test_meta,
+                                   'Fold %d Testing ' % (fold,), r_test)
+    return {'Parameters': _config_key(hyper_parameters), 'Fold': fold,
+            'Accuracy': accuracy, 'Gain': gain, 'Fit Seconds': fit_seconds}
+
+
 class ML(object):
 
-    def __init__(self, data_files, start_date=None, end_date=None, model_suffix=None):
-        data_files = data_files
+    def __init__(self, data_files, start_date=None, end_date=None, model_suffix=None,
+                 hyper_parameters=None, n_jobs=None, chunk_size=None, backend='forest'):
+        self.data_files = data_files
+        self.start_date = start_date
+        self.end_date = end_date
         self.model_suffix = model_suffix
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
-        logging.info('Reading csv data...')
-        self.df = pd.concat([pd.read_csv(data_file) for data_file in data_files])
-        self.df.dropna(inplace=True)
-        indices = []
-        for i, row in self.df.iterrows():
-            if (not start_date or row['Date'] >= start_date) and (not end_date or row['Date'] <= end_date):
-                indices.append(i)
-        self.df = self.df.iloc[indices]
-        self.hyper_parameters = {'max_depth': 2,
-                                 'min_samples_leaf': 0.1,
-                                 'n_jobs': 2}
-        logging.info('Model hyper-parameters: %s', self.hyper_parameters)
+        self.chunk_size = chunk_size
+        if chunk_size:
+            # Data are streamed from the files on demand
+            self.df = None
+        else:
+            logging.info('Reading csv data...')
+            with profiling.phase('data_load'):
+                self.df = pd.concat([pd.read_csv(data_file) for data_file in data_files])
+            self.df.dropna(inplace=True)
+            self.df = filter_dates(self.df, start_date, end_date).reset_index(drop=True)
+        self.backend = backend
+        self.hyper_parameters = dict(DEFAULT_HYPER_PARAMETERS[backend])
+        self.hyper_parameters.update(hyper_parameters or {})
+        self.n_jobs = n_jobs or os.cpu_count()
+        logging.info('Model backend: %s. Hyper-parameters: %s', self.backend, self.hyper_parameters)
 
     def k_fold_cross_validation(self, k):
-        X, y, w, _ = process_data(self.df)
-        main_model = ensemble.RandomForestClassifier(**self.hyper_parameters)
-        meta_model = ensemble.RandomForestRegressor(**self.hyper_parameters)
-        k_fold = KFold(n_splits=k, shuffle=True, random_state=0)
-        fold = 1
+        """Evaluates current hyper-parameters with k folds fitted in parallel."""
+        tasks = [(self.backend, self.hyper_parameters, k, fold) for fold in range(1, k + 1)]
         accuracy_sum = 0
         accuracy_table = []
-        for train_index, test_index in k_fold.split(X):
-            X_train = X[train_index]
-            X_test = X[test_index]
-            y_train = y[train_index]
-            y_test = y[test_index]
-            w_train = w[train_index]
-            logging.info('[Fold %d] %d training samples, %d testing samples',
-                         fold, len(X_train), len(X_test))
-            logging.info('[Fold %d] Fitting main model...', fold)
-            main_model.fit(X_train, y_train, sample_weight=w_train)
-            y_train_pred = main_model.predict(X_train)
-            y_diff = y_train == y_train_pred
-            y_diff = y_diff.astype(np.int)
-            logging.info('[Fold %d] Fitting meta model...', fold)
-            meta_model.fit(X_train, y_diff)
-            y_train_meta = meta_model.predict(X_train)
-            print_metrics(y_train, y_train_pred, y_train_meta, 'Fold %d Training ' % (fold,))
-            y_test_pred = main_model.predict(X_test)
-            y_test_meta = meta_model.predict(X_test)
-            accuracy = print_metrics(y_test, y_test_pred, y_test_meta, 'Fold %d Testing ' % (fold,))
-            accuracy_table.append([str(fold), '%.2f%%' % (accuracy * 100,)])
-            accuracy_sum += accuracy
-            fold += 1
+        for result in self._run_fold_tasks(tasks):
+            accuracy_table.append([str(result['Fold']), '%.2f%%' % (result['Accuracy'] * 100,)])
+            accuracy_sum += result['Accuracy']
+        accuracy_table.sort(key=lambda row: int(row[0]))
         accuracy_table.append(['Average', '%.2f%%' % (accuracy_sum / k * 100)])
         logging.info(utils.get_header('Model Accuracy') + '\n' +
                      tabulate(accuracy_table, headers=['Fold', 'Accuracy'], tablefmt='grid'))
 
+    def hyper_parameter_search(self, k, mode='grid', n_iter=20, result_file=None):
+        """Searches hyper-parameters with k-fold cross validation.
+
+        Every (configuration, fold) pair is an independent task in the process pool.
+        Finished tasks are appended to result_file immediately, and tasks already
+        found there are skipped, so an interrupted search resumes where it stopped.
+        Results are only resumed by searches of the same backend, k, data files and
+        dates, which are saved next to result_file.
+        """
+        setup = {'backend': self.backend, 'k': k, 'data_files': [os.path.abspath(data_file)
+                                                                 for data_file in self.data_files],
+                 'start_date': self.start_date, 'end_date': self.end_date}
+        setup_key = hashlib.md5(_config_key(setup).encode()).hexdigest()[:16]
+        result_file = result_file or os.path.join(self.root_dir, utils.OUTPUTS_DIR, 'ml',
+                                                  'search_%s_%s_%s.csv' % (self.backend, mode, setup_key))
+        os.makedirs(os.path.dirname(result_file), exist_ok=True)
+        setup_file = result_file + '.setup.json'
+        if os.path.isfile(result_file) and os.path.isfile(setup_file):
+            with open(setup_file) as f:
+                saved_setup = json.loads(f.read())
+            if saved_setup != setup:
+                raise ValueError('Search results in %s are of another setup %s' % (result_file, saved_setup))
+        else:
+            with open(setup_file, 'w') as f:
+                f.write(json.dumps(setup))
+        configs = get_search_configs(mode, n_iter, self.backend)
+        finished = {}
+        if os.path.isfile(result_file):
+            for row in pd.read_csv(result_file).to_dict('records'):
+                finished[(row['Parameters'], row['Fold'])] = row
+            logging.info('%d finished tasks loaded from %s', len(finished), result_file)
+        tasks = [(self.backend, config, k, fold) for config in configs for fold in range(1, k + 1)
+                 if (_config_key(config), fold) not in finished]
+        logging.info('%d configurations, %d tasks to run', len(configs), len(tasks))
+
+        write_header = not os.path.isfile(result_file)
+        with open(result_file, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SEARCH_RESULT_COLUMNS, extrasaction='ignore')
+            if write_header:
+                writer.writeheader()
+            for result in self._run_fold_tasks(tasks):
+                writer.writerow(result)
+                f.flush()
+                finished[(result['Parameters'], result['Fold'])] = result
+
+        summary = {}
+        for (key, _), row in finished.items():
+            summary.setdefault(key, []).append(row)
+        search_table = []
+        for config in configs:
+            rows = summary.get(_config_key(config), [])
+            if len(rows) < k:
+                continue
+            search_table.append([_config_key(config),
+                                 np.mean([row['Accuracy'] for row in rows]),
+                                 np.mean([row['Gain'] for row in rows]),
+                                 np.sum([row['Fit Seconds'] for row in rows])])
+        search_table.sort(key=lambda row: row[1], reverse=True)
+        logging.info(utils.get_header('Hyper-parameter Search') + '\n' +
+                     tabulate([[row[0], '%.2f%%' % (row[1] * 100,), '%+.2f%%' % (row[2] * 100,),
+                                '%.1f' % (row[3],)] for row in search_table],
+                              headers=['Parameters', 'Accuracy', 'Gain', 'Fit Seconds'],
+                              tablefmt='grid'))
+        logging.info('Results saved at %s', result_file)
+        return json.loads(search_table[0][0]) if search_table else None
+
+    def _run_fold_tasks(self, tasks):
+        """Runs fold tasks in a process pool sized to the machine. Yields results as they finish."""
+        if not tasks:
+            return
+        X, y, w, r = process_data(self.df)
+        data_dir = os.path.join(self.root_dir, utils.CACHE_DIR, 'ml_shared_%d' % (os.getpid(),))
+        os.makedirs(data_dir, exist_ok=True)
+        try:
+            for name, array in zip(['X', 'y', 'w', 'r'], [X, y, w, r]):
+                np.save(os.path.join(data_dir, name + '.npy'), array)
+            del X, y, w, r
+            processes = min(self.n_jobs, len(tasks))
+            with multiprocessing.Pool(processes, initializer=_init_fold_worker,
+                                      initargs=(data_dir,)) as pool:
+                for result in pool.imap_unordered(_evaluate_fold, tasks):
+                    yield result
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
     def _get_model_paths(self, suffix):
         main_model_path = os.path.join(self.root_dir, utils.MODELS_DIR, 'main_%s.p' % (suffix,))
         meta_model_path = os.path.join(self.root_dir, utils.MODELS_DIR, 'meta_%s.p' % (suffix,))
@@ -139,15 +356,17 @@ class ML(object):
     def train(self, X=None, y=None, w=None, save_model=False):
         if X is None:
             X, y, w, _ = process_data(self.df)
-        main_model = ensemble.RandomForestClassifier(**self.hyper_parameters)
-        meta_model = ensemble.RandomForestRegressor(**self.hyper_parameters)
+        main_model, meta_model = make_models(self.backend, self.hyper_parameters, self.n_jobs)
         logging.info('Fitting main model...')
-        main_model.fit(X, y, sample_weight=w)
-        y_pred = main_model.predict(X)
+        with profiling.phase('fit'):
+            main_model.fit(X, y, sample_weight=w)
+        with profiling.phase('predict'):
+            y_pred = main_model.predict(X)
         y_diff = y == y_pred
         y_diff = y_diff.astype(np.int)
         logging.info('Fitting meta model...')
-        meta_model.fit(X, y_diff)
+        with profiling.phase('fit'):
+            meta_model.fit(X, y_diff)
         if save_model:
             y_meta = meta_model.predict(X)
             accuracy = print_metrics(y, y_pred, y_meta, 'Training ')
@@ -159,6 +378,109 @@ class ML(object):
             logging.info('Model saved at\n%s\n%s', main_model_path, meta_model_path)
         return main_model, meta_model
 
+    def train_out_of_core(self, test_every=5, compare=False, save_model=False):
+        """Trains on data streamed in chunks with bounded memory.
+
+        A forest pair is fitted on each chunk and the pairs are averaged. Every
+        test_every-th row is held out, and predictions on held-out rows are
+        collected in a second pass.
+        """
+        main_model, meta_model = ChunkEnsemble(True), ChunkEnsemble(False)
+        start_time = time.time()
+        row_offset = 0
+        for i, chunk in enumerate(iter_data_chunks(self.data_files, self.chunk_size,
+                                                   self.start_date, self.end_date)):
+            X, y, w, _ = process_data(chunk)
+            train_mask = (np.arange(row_offset, row_offset + len(X)) % test_every) != 0
+            row_offset += len(X)
+            X, y, w = X[train_mask], y[train_mask], w[train_mask]
+            main_chunk_model, meta_chunk_model = self.train(X, y, w)
+            main_model.add(main_chunk_model)
+            meta_model.add(meta_chunk_model)
+            logging.info('[Chunk %d] Fitted on %d samples. Peak memory: %.1f MB',
+                         i + 1, len(X), utils.get_peak_memory_mb())
+        if not main_model.estimators:
+            logging.info('No training performed')
+            return None, None
+
+        y_true, y_pred, y_meta, r_true = [], [], [], []
+        row_offset = 0
+        for chunk in iter_data_chunks(self.data_files, self.chunk_size,
+                                      self.start_date, self.end_date):
+            X, y, _, r = process_data(chunk)
+            test_mask = (np.arange(row_offset, row_offset + len(X)) % test_every) == 0
+            row_offset += len(X)
+            y_true.append(y[test_mask])
+            y_pred.append(main_model.predict(X[test_mask]))
+            y_meta.append(meta_model.predict(X[test_mask]))
+            r_true.append(r[test_mask])
+        y_true, y_pred = np.concatenate(y_true), np.concatenate(y_pred)
+        y_meta, r_true = np.concatenate(y_meta), np.concatenate(r_true)
+        accuracy, gain = print_metrics(y_true, y_pred, y_meta, 'Out-of-core Testing ', r_true)
+        comparison_table = [['Out-of-core (%d chunks)' % (len(main_model.estimators),),
+                             '%.2f%%' % (accuracy * 100,), '%+.2f%%' % (gain * 100,),
+                             '%.1f' % (utils.get_peak_memory_mb(),),
+                             '%.1f' % (time.time() - start_time,)]]
+
+        if compare:
+            # The in-memory baseline loads everything, so its peak memory is reported after it.
+            start_time = time.time()
+            df = pd.concat(iter_data_chunks(self.data_files, self.chunk_size,
+                                            self.start_date, self.end_date))
+            X, y, w, r = process_data(df)
+            del df
+            test_mask = (np.arange(len(X)) % test_every) == 0
+            main_baseline, meta_baseline = self.train(X[~test_mask], y[~test_mask], w[~test_mask])
+            baseline_accuracy, baseline_gain = print_metrics(
+                y[test_mask], main_baseline.predict(X[test_mask]),
+                meta_baseline.predict(X[test_mask]), 'In-memory Testing ', r[test_mask])
+            comparison_table.append(['In-memory',
+                                     '%.2f%%' % (baseline_accuracy * 100,),
+                                     '%+.2f%%' % (baseline_gain * 100,),
+                                     '%.1f' % (utils.get_peak_memory_mb(),),
+                                     '%.1f' % (time.time() - start_time,)])
+        logging.info(utils.get_header('Out-of-core Training') + '\n' +
+                     tabulate(comparison_table,
+                              headers=['Mode', 'Accuracy', 'Gain', 'Peak Memory (MB)', 'Seconds'],
+                              tablefmt='grid'))
+
+        if save_model:
+            main_model_path, meta_model_path = self._get_model_paths(str(int(round(accuracy * 1E4))))
+            with open(main_model_path, 'wb') as f_main:
+                pickle.dump(main_model, f_main)
+            with open(meta_model_path, 'wb') as f_meta:
+                pickle.dump(meta_model, f_meta)
+            logging.info('Model saved at\n%s\n%s', main_model_path, meta_model_path)
+        return main_model, meta_model
+
+    def compare_backends(self, test_every=5):
+        """Fits every backend on the same split and tabulates fit time and accuracy."""
+        X, y, w, r = process_data(self.df)
+        test_mask = (np.arange(len(X)) % test_every) == 0
+        X_train, y_train, w_train = X[~test_mask], y[~test_mask], w[~test_mask]
+        X_test, y_test, r_test = X[test_mask], y[test_mask], r[test_mask]
+        comparison_table = []
+        for backend in BACKENDS:
+            hyper_parameters = (self.hyper_parameters if backend == self.backend
+                                else DEFAULT_HYPER_PARAMETERS[backend])
+            main_model, meta_model = make_models(backend, hyper_parameters, self.n_jobs)
+            fit_start = time.time()
+            main_model.fit(X_train, y_train, sample_weight=w_train)
+            y_diff = (y_train == main_model.predict(X_train)).astype(np.int)
+            meta_model.fit(X_train, y_diff)
+            fit_seconds = time.time() - fit_start
+            accuracy, gain = print_metrics(y_test, main_model.predict(X_test), meta_model.predict(X_test),
+                                           '%s Testing ' % (backend.capitalize(),), r_test)
+            accuracy_main = metrics.accuracy_score(y_test, main_model.predict(X_test))
+            comparison_table.append([backend, '%.1f' % (fit_seconds,),
+                                     '%.2f%%' % (accuracy_main * 100,),
+                                     '%.2f%%' % (accuracy * 100,), '%+.2f%%' % (gain * 100,)])
+        logging.info(utils.get_header('Backend Comparison') + '\n' +
+                     tabulate(comparison_table,
+                              headers=['Backend', 'Fit Seconds', 'Accuracy Main',
+                                       'Accuracy Final', 'Gain'],
+                              tablefmt='grid'))
+
     def evaluate(self):
         X, y, _, _ = process_data(self.df)
         main_model_path, meta_model_path = self._get_model_paths(self.model_suffix)
@@ -232,11 +554,51 @@ def main():
                         help='Start date of the data.')
     parser.add_argument('--end_date', default=None,
                         help='End date of the data.')
-    parser.add_argument('--action', default='dev', choices=['dev', 'train', 'eval', 'cont'])
+    parser.add_argument('--action', default='dev',
+                        choices=['dev', 'train', 'eval', 'cont', 'search', 'compare'])
+    parser.add_argument('--backend', default='forest', choices=BACKENDS,
+                        help='Learner backend: random forests or histogram gradient boosting.')
+    parser.add_argument('--max_depth', default=None, type=int, help='Max depth of trees.')
+    parser.add_argument('--min_samples_leaf', default=None, type=_count_or_fraction,
+                        help='Min samples in a leaf. A count, or a fraction of samples for forests.')
+    parser.add_argument('--n_estimators', default=None, type=int, help='Number of trees (forest).')
+    parser.add_argument('--max_iter', default=None, type=int, help='Number of boosting iterations (hist).')
+    parser.add_argument('--learning_rate', default=None, type=float, help='Boosting learning rate (hist).')
+    parser.add_argument('--n_jobs', default=None, type=int,
+                        help='Number of worker processes. Default to the number of CPUs.')
+    parser.add_argument('--search_mode', default='grid', choices=['grid', 'random'],
+                        help='Hyper-parameter search mode.')
+    parser.add_argument('--search_iter', default=20, type=int,
+                        help='Number of configurations sampled in random search.')
+    parser.add_argument('--search_results', default=None,
+                        help='CSV file of search results. Existing results are resumed.')
+    parser.add_argument('--chunk_size', default=None, type=int,
+                        help='Train out of core by streaming data in chunks of this many rows.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare out-of-core training with in-memory training.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile phases and sample stacks into the output directory.')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='Also trace memory high-water marks of phases with --profile. Slows down allocations.')
     args = parser.parse_args()
     utils.logging_config()
-    ml = ML(args.data_files, args.start_date, args.end_date, args.model_suffix)
-    if args.action == 'train':
+    if args.profile:
+        profiling.start(args.profile_memory)
+    hyper_parameters = {key: getattr(args, key)
+                        for key in ['max_depth', 'min_samples_leaf', 'n_estimators',
+                                    'max_iter', 'learning_rate']
+                        if getattr(args, key) is not None and key in DEFAULT_HYPER_PARAMETERS[args.backend]}
+    if args.backend == 'hist' and 'min_samples_leaf' in hyper_parameters:
+        min_samples_leaf = hyper_parameters['min_samples_leaf']
+        if not isinstance(min_samples_leaf, int) or min_samples_leaf < 1:
+            raise ValueError('min_samples_leaf of hist must be a count, got %s' % (min_samples_leaf,))
+    ml = ML(args.data_files, args.start_date, args.end_date, args.model_suffix,
+            hyper_parameters, args.n_jobs, args.chunk_size, args.backend)
+    if args.chunk_size:
+        if args.action != 'train':
+            raise ValueError('Out-of-core mode only supports the train action')
+        ml.train_out_of_core(compare=args.compare, save_model=True)
+    elif args.action == 'train':
         ml.train(save_model=True)
     elif args.action == 'dev':
         ml.k_fold_cross_validation(5)
@@ -244,8 +606,15 @@ def main():
         ml.evaluate()
     elif args.action == 'cont':
         ml.continuous_training(20, 1, 1)
+    elif args.action == 'search':
+        ml.hyper_parameter_search(5, args.search_mode, args.search_iter, args.search_results)
+    elif args.action == 'compare':
+        ml.compare_backends()
     else:
         raise ValueError('Invalid action')
+    if args.profile:
+        profiling.write(os.path.join(ml.root_dir, utils.OUTPUTS_DIR, 'ml',
+                                     datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+import ml
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import unittest
+import unittest.mock as mock
+import utils
+from parameterized import parameterized
+
+SEARCH_SPACES = {'forest': {'max_depth': [2, 3],
+                            'min_samples_leaf': [0.1],
+                            'n_estimators': [5]},
+                 'hist': {'max_depth': [2],
+                          'min_samples_leaf': [20],
+                          'max_iter': [5],
+                          'learning_rate': [0.1]}}
+
+
+class MLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        n = 200
+        df = pd.DataFrame(rng.normal(size=(n, len(utils.ML_FEATURES))), columns=utils.ML_FEATURES)
+        df['Gain'] = rng.normal(scale=0.02, size=n)
+        df['Symbol'] = 'SYMA'
+        df['Date'] = ['2020-01-%02d' % (i % 28 + 1,) for i in range(n)]
+        self.data_file = os.path.join(self.dir.name, 'data.csv')
+        df.to_csv(self.data_file, index=False)
+        self.result_file = os.path.join(self.dir.name, 'search.csv')
+        patcher = mock.patch.dict(ml.SEARCH_SPACES, SEARCH_SPACES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    @parameterized.expand([('forest',), ('hist',)])
+    def test_k_fold_cross_validation(self, backend):
+        hyper_parameters = {key: values[0] for key, values in SEARCH_SPACES[backend].items()}
+        ml_instance = ml.ML([self.data_file], n_jobs=2, backend=backend, hyper_parameters=hyper_parameters)
+        ml_instance.k_fold_cross_validation(2)
+
+    def test_evaluate_fold(self):
+        X = np.random.normal(size=(50, 3))
+        y = (X[:, 0] > 0).astype(int)
+        w = np.abs(X[:, 1])
+        r = X[:, 2]
+        for name, array in zip(['X', 'y', 'w', 'r'], [X, y, w, r]):
+            np.save(os.path.join(self.dir.name, name + '.npy'), array)
+        with mock.patch.object(ml, 'threadpool_limits') as threadpool_limits:
+            ml._init_fold_worker(self.dir.name)
+        threadpool_limits.assert_called_once_with(1)
+        hyper_parameters = {'max_depth': 2, 'min_samples_leaf': 0.1, 'n_estimators': 5}
+        with mock.patch.object(ml, 'print_metrics', return_value=(0.5, 0.01)) as print_metrics:
+            result = ml._evaluate_fold(('forest', hyper_parameters, 2, 1))
+        self.assertEqual(result['Fold'], 1)
+        self.assertEqual(result['Parameters'], ml._config_key(hyper_parameters))
+        self.assertEqual(result['Accuracy'], 0.5)
+        self.assertEqual(result['Gain'], 0.01)
+        self.assertEqual([call[0][3] for call in print_metrics.call_args_list],
+                         ['Fold 1 Training ', 'Fold 1 Testing '])
+
+    def test_hyper_parameter_search(self):
+        ml_instance = ml.ML([self.data_file], n_jobs=2)
+        best = ml_instance.hyper_parameter_search(2, result_file=self.result_file)
+        self.assertIn(best, ml.get_search_configs('grid', 0))
+        results = pd.read_csv(self.result_file)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(set(results['Fold']), {1, 2})
+
+    def test_hyper_parameter_search_resume(self):
+        ml_instance = ml.ML([self.data_file], n_jobs=2)
+        best = ml_instance.hyper_parameter_search(2, result_file=self.result_file)
+        with mock.patch.object(ml.multiprocessing, 'Pool') as pool:
+            self.assertEqual(ml_instance.hyper_parameter_search(2, result_file=self.result_file), best)
+        pool.assert_not_called()
+
+        # Drop one finished task, as if the search was interrupted before it
+        results = pd.read_csv(self.result_file)
+        results.iloc[:-1].to_csv(self.result_file, index=False)
+        dropped = results.iloc[-1]
+        ml_instance.hyper_parameter_search(2, result_file=self.result_file)
+        resumed = pd.read_csv(self.result_file)
+        self.assertEqual(len(resumed), 4)
+        self.assertEqual(resumed.iloc[-1]['Parameters'], dropped['Parameters'])
+        self.assertEqual(resumed.iloc[-1]['Fold'], dropped['Fold'])
+
+    def test_hyper_parameter_search_rejects_other_setup(self):
+        ml_instance = ml.ML([self.data_file], n_jobs=2)
+        ml_instance.hyper_parameter_search(2, result_file=self.result_file)
+        with mock.patch.object(ml.multiprocessing, 'Pool') as pool, self.assertRaises(ValueError):
+            ml_instance.hyper_parameter_search(3, result_file=self.result_file)
+        pool.assert_not_called()
+
+    def test_hyper_parameter_search_default_result_file(self):
+        ml_instance = ml.ML([self.data_file], n_jobs=2)
+        ml_instance.root_dir = self.dir.name
+        ml_instance.hyper_parameter_search(2)
+        # Searches of another k do not resume from the same default file
+        ml_instance.hyper_parameter_search(3)
+        result_files = [file_name for file_name in os.listdir(os.path.join(self.dir.name, utils.OUTPUTS_DIR, 'ml'))
+                        if file_name.endswith('.csv')]
+        self.assertEqual(len(result_files), 2)
+
+    def test_train_out_of_core(self):
+        ml_instance = ml.ML([self.data_file], chunk_size=80, n_jobs=1,
+                            hyper_parameters={'n_estimators': 5})
+        main_model, meta_model = ml_instance.train_out_of_core(compare=True)
+        self.assertIsInstance(main_model, ml.ChunkEnsemble)
+        self.assertEqual(len(main_model.estimators), 3)
+        self.assertEqual(len(meta_model.estimators), 3)
+        X = np.random.normal(size=(10, len(utils.ML_FEATURES)))
+        self.assertTrue(set(main_model.predict(X)) <= {0, 1})
+        self.assertEqual(meta_model.predict(X).shape, (10,))
+
+    def test_chunk_ensemble(self):
+        models = [mock.Mock(classes_=np.array([0, 1])) for _ in range(2)]
+        models[0].predict_proba.return_value = np.array([[0.9, 0.1], [0.2, 0.8]])
+        models[1].predict_proba.return_value = np.array([[0.3, 0.7], [0.4, 0.6]])
+        ensemble = ml.ChunkEnsemble(True)
+        for model in models:
+            ensemble.add(model)
+        np.testing.assert_array_equal(ensemble.predict(np.zeros((2, 1))), [0, 1])
+
+    def test_compare_backends(self):
+        ml_instance = ml.ML([self.data_file], n_jobs=1, hyper_parameters={'n_estimators': 5})
+        with mock.patch.object(ml, 'print_metrics', return_value=(0.5, 0.01)) as print_metrics:
+            ml_instance.compare_backends()
+        self.assertEqual([call[0][3] for call in print_metrics.call_args_list],
+                         ['Forest Testing ', 'Hist Testing '])
+
+    @parameterized.expand([('forest', '100', 100), ('forest', '0.05', 0.05), ('hist', '20', 20)])
+    def test_main_min_samples_leaf(self, backend, min_samples_leaf, expected):
+        argv = ['ml.py', '--data_files', self.data_file, '--backend', backend,
+                '--min_samples_leaf', min_samples_leaf]
+        with mock.patch('sys.argv', argv), mock.patch.object(ml, 'ML') as ml_class:
+            ml.main()
+        hyper_parameters = ml_class.call_args[0][4]
+        self.assertEqual(hyper_parameters['min_samples_leaf'], expected)
+        self.assertIs(type(hyper_parameters['min_samples_leaf']), type(expected))
+
+    @parameterized.expand([('0.1',), ('0',)])
+    def test_main_rejects_hist_leaf_fraction(self, min_samples_leaf):
+        argv = ['ml.py', '--data_files', self.data_file, '--backend', 'hist',
+                '--min_samples_leaf', min_samples_leaf]
+        with mock.patch('sys.argv', argv), mock.patch.object(ml, 'ML') as ml_class:
+            with self.assertRaises(ValueError):
+                ml.main()
+        ml_class.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
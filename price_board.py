@@ -0,0 +1,121 @@
+import json
+import numpy as np
+import os
+import utils
+
+HUB_DIR = 'hub'
+PRICES_FILE = 'prices.npy'
+SUBSCRIPTIONS_DIR = 'subscriptions'
+
+
+def get_hub_dir(root_dir, day=None):
+    """Gets the directory the price hub of a trading day publishes to."""
+    return os.path.join(root_dir, utils.OUTPUTS_DIR, 'realtime', day or utils.get_business_day(0), HUB_DIR)
+
+
+class PriceBoard(object):
+    """Latest prices and their times in a memory-mapped matrix shared across processes.
+
+    Row 0 holds prices and row 1 holds their timestamps, in the symbol order of
+    the series matrices in directory. Missing prices are NaN. The publisher
+    creates the board with create=True, and subscribers map it read-only.
+    Subscribers remap the board when the publisher replaces its file.
+    """
+
+    def __init__(self, directory, create=False):
+        self.directory = directory
+        self.prices_file = os.path.join(directory, PRICES_FILE)
+        if create:
+            self.create()
+        else:
+            self.map()
+
+    def load_symbols(self):
+        """Loads the symbol order of the board."""
+        with open(os.path.join(self.directory, 'symbols.json')) as f:
+            self.symbols = json.loads(f.read())
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def create(self):
+        """Creates the board, or reopens it in place when its layout matches.
+
+        Subscribers keep mapping the file of a restarted publisher when it is
+        reopened in place. A board of a different layout is replaced, which
+        subscribers detect on their next read.
+        """
+        self.load_symbols()
+        shape = (2, len(self.symbols))
+        if os.path.isfile(self.prices_file):
+            matrix = np.load(self.prices_file, mmap_mode='r+')
+            if matrix.shape == shape and matrix.dtype == np.float64:
+                self.matrix = matrix
+                self.inode = os.stat(self.prices_file).st_ino
+                return
+            del matrix
+        # Subscribers only ever see a fully initialized board
+        tmp_file = self.prices_file + '.tmp'
+        self.matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float64, shape=shape)
+        self.matrix[:] = np.nan
+        self.matrix.flush()
+        os.replace(tmp_file, self.prices_file)
+        self.inode = os.stat(self.prices_file).st_ino
+
+    def map(self):
+        """Maps the board read-only, along with its symbols."""
+        self.load_symbols()
+        self.inode = os.stat(self.prices_file).st_ino
+        self.matrix = np.load(self.prices_file, mmap_mode='r')
+
+    def publish(self, records):
+        """Publishes (timestamp, symbol, price) records. Unknown symbols are ignored."""
+        for timestamp, symbol, price in records:
+            i = self.index.get(symbol)
+            if i is None:
+                continue
+            # Price goes first, so a reader seeing a new time also sees its price
+            self.matrix[0, i] = price
+            self.matrix[1, i] = timestamp
+
+    def read(self, since=None):
+        """Reads (timestamp, symbol, price) records newer than times in the since dict."""
+        since = since or {}
+        if os.stat(self.prices_file).st_ino != self.inode:
+            # The publisher replaced the board, so the old mapping is no longer written to
+            self.map()
+        times = np.array(self.matrix[1])
+        prices = np.array(self.matrix[0])
+        records = []
+        for i in np.flatnonzero(~np.isnan(times)):
+            symbol = self.symbols[i]
+            if times[i] > since.get(symbol, 0):
+                records.append((float(times[i]), symbol, float(prices[i])))
+        return records
+
+
+def subscribe(directory, name, trading_list):
+    """Tells the publisher which symbols the subscriber name is about to trade."""
+    subscriptions_dir = os.path.join(directory, SUBSCRIPTIONS_DIR)
+    os.makedirs(subscriptions_dir, exist_ok=True)
+    subscription_file = os.path.join(subscriptions_dir, name + '.json')
+    tmp_file = subscription_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps([[symbol, proportion, float(np.squeeze(weight)), side]
+                            for symbol, proportion, weight, side in trading_list]))
+    os.replace(tmp_file, subscription_file)
+
+
+def read_subscriptions(directory):
+    """Merges trading lists of all subscribers, keeping the highest weight of each symbol."""
+    subscriptions_dir = os.path.join(directory, SUBSCRIPTIONS_DIR)
+    if not os.path.isdir(subscriptions_dir):
+        return []
+    merged = {}
+    for file_name in sorted(os.listdir(subscriptions_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(subscriptions_dir, file_name)) as f:
+            trading_list = json.loads(f.read())
+        for symbol, proportion, weight, side in trading_list:
+            if symbol not in merged or merged[symbol][2] < weight:
+                merged[symbol] = (symbol, max(proportion, merged.get(symbol, (None, 0))[1]), weight, side)
+    return sorted(merged.values(), key=lambda s: s[2], reverse=True)
@@ -0,0 +1,58 @@
+import json
+import numpy as np
+import os
+import price_board
+import tempfile
+import unittest
+
+
+class PriceBoardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.dir.name, 'symbols.json'), 'w') as f:
+            f.write(json.dumps(['^VIX', 'SYMA', 'SYMB']))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_publish_and_read(self):
+        publisher = price_board.PriceBoard(self.dir.name, create=True)
+        subscriber = price_board.PriceBoard(self.dir.name)
+        self.assertEqual(subscriber.read(), [])
+        publisher.publish([(1.0, 'SYMA', 10.5), (2.0, '^VIX', 20.0), (3.0, 'SYMX', 30.0)])
+        self.assertEqual(sorted(subscriber.read()), [(1.0, 'SYMA', 10.5), (2.0, '^VIX', 20.0)])
+        publisher.publish([(4.0, 'SYMA', 11.0)])
+        # Only prices newer than the given times
+        self.assertEqual(subscriber.read(since={'SYMA': 1.0, '^VIX': 2.0}), [(4.0, 'SYMA', 11.0)])
+
+    def test_publisher_restart(self):
+        publisher = price_board.PriceBoard(self.dir.name, create=True)
+        subscriber = price_board.PriceBoard(self.dir.name)
+        publisher.publish([(1.0, 'SYMA', 10.5)])
+        # A restarted publisher reopens the board in place, keeping published prices
+        publisher = price_board.PriceBoard(self.dir.name, create=True)
+        publisher.publish([(2.0, 'SYMB', 20.5)])
+        self.assertEqual(sorted(subscriber.read()), [(1.0, 'SYMA', 10.5), (2.0, 'SYMB', 20.5)])
+
+    def test_read_replaced_board(self):
+        price_board.PriceBoard(self.dir.name, create=True)
+        subscriber = price_board.PriceBoard(self.dir.name)
+        # A board of another layout is replaced, and subscribers remap it
+        with open(os.path.join(self.dir.name, 'symbols.json'), 'w') as f:
+            f.write(json.dumps(['^VIX', 'SYMA', 'SYMB', 'SYMC']))
+        publisher = price_board.PriceBoard(self.dir.name, create=True)
+        publisher.publish([(1.0, 'SYMC', 30.5)])
+        self.assertEqual(subscriber.read(), [(1.0, 'SYMC', 30.5)])
+
+    def test_read_subscriptions(self):
+        self.assertEqual(price_board.read_subscriptions(self.dir.name), [])
+        price_board.subscribe(self.dir.name, 'paper', [('SYMA', 0.5, np.array([60]), 'long'),
+                                                       ('SYMB', 0, np.array([40]), 'long')])
+        price_board.subscribe(self.dir.name, 'live', [('SYMB', 1, 70, 'long')])
+        self.assertEqual(price_board.read_subscriptions(self.dir.name),
+                         [('SYMB', 1, 70, 'long'), ('SYMA', 0.5, 60, 'long')])
+
+
+if __name__ == '__main__':
+    unittest.main()
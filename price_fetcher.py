@@ -0,0 +1,235 @@
+import aiohttp
+import aiohttp.web as web
+import argparse
+import asyncio
+import logging
+import numpy as np
+import requests
+import threading
+import time
+import utils
+from concurrent import futures
+from tabulate import tabulate
+
+DEFAULT_CONCURRENCY = 50
+DEFAULT_TIMEOUT = 5
+# Symbols per snapshot request. Long enough to cut request count by two orders
+# of magnitude while keeping the URL short.
+SNAPSHOT_BATCH_SIZE = 200
+SNAPSHOT_PATH = '/v2/snapshot/locale/us/markets/stocks/tickers'
+
+
+class AsyncPriceFetcher(object):
+    """Fetches realtime prices concurrently over a persistent connection pool.
+
+    An asyncio event loop runs in a background thread, so that get_prices can
+    be called from the existing threaded refresh loops.
+    """
+
+    def __init__(self, api_key, base_url=utils.POLYGON_API_BASE_URL,
+                 concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 batch_size=SNAPSHOT_BATCH_SIZE, rate_limiter=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter
+        self.request_count = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='AsyncPriceFetcher')
+        self.thread.daemon = True
+        self.thread.start()
+        self.session, self.semaphore = self._run(self._create_session())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _create_session(self):
+        # Connections are kept alive and reused across refresh cycles
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector,
+                                        timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return session, asyncio.Semaphore(self.concurrency)
+
+    async def _get_json(self, path, params=None):
+        params = dict(params or {}, apiKey=self.api_key)
+        if self.rate_limiter:
+            # Wait without blocking the event loop
+            await asyncio.sleep(self.rate_limiter.reserve())
+        async with self.semaphore:
+            self.request_count += 1
+            async with self.session.get(self.base_url + path, params=params) as response:
+                if response.status == 429 and self.rate_limiter:
+                    self.rate_limiter.on_throttle()
+                if response.status != 200:
+                    raise utils.NetworkError('[%s] status %d' % (path, response.status))
+                if self.rate_limiter:
+                    self.rate_limiter.on_success()
+                return await response.json()
+
+    async def _get_last_trade(self, symbol):
+        content = await self._get_json('/v1/last/stocks/%s' % (symbol,))
+        return float(content['last']['price'])
+
+    async def _get_snapshot(self, symbols):
+        content = await self._get_json(SNAPSHOT_PATH, {'tickers': ','.join(symbols)})
+        prices = {}
+        for ticker in content.get('tickers') or []:
+            last_trade = ticker.get('lastTrade') or {}
+            if last_trade.get('p'):
+                prices[ticker['ticker']] = float(last_trade['p'])
+        return prices
+
+    async def _get_batch(self, symbols):
+        """Gets prices of a batch of symbols with one snapshot request.
+
+        Symbols missing from the snapshot, or all symbols if the snapshot request
+        fails, fall back to single-symbol requests.
+        """
+        prices = {}
+        if len(symbols) > 1:
+            try:
+                prices = await self._get_snapshot(symbols)
+            except Exception as e:
+                logging.warning('Snapshot of %d symbols failed: %s. Fall back to single-symbol requests.',
+                                len(symbols), e)
+        missing = [symbol for symbol in symbols if symbol not in prices]
+        results = await asyncio.gather(*[self._get_last_trade(symbol) for symbol in missing],
+                                       return_exceptions=True)
+        errors = {}
+        for symbol, result in zip(missing, results):
+            if isinstance(result, Exception):
+                errors[symbol] = result
+            else:
+                prices[symbol] = result
+        return prices, errors
+
+    async def _get_prices(self, symbols):
+        batch_size = max(self.batch_size, 1)
+        batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+        prices, errors = {}, {}
+        for batch_prices, batch_errors in await asyncio.gather(*[self._get_batch(batch)
+                                                                 for batch in batches]):
+            prices.update(batch_prices)
+            errors.update(batch_errors)
+        return prices, errors
+
+    def get_prices(self, symbols):
+        """Gets prices of symbols. Blocks until all requests finish or time out.
+
+        Returns a dict of prices and a dict of exceptions for failed symbols.
+        """
+        return self._run(self._get_prices(list(symbols)))
+
+    def close(self):
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class QuoteServer(object):
+    """Local stand-in for the quote API, for offline tests and benchmarks."""
+
+    def __init__(self, latency=0.05, seed=0, fail_snapshot=False):
+        self.latency = latency
+        self.rng = np.random.RandomState(seed)
+        self.fail_snapshot = fail_snapshot
+        self.request_count = 0
+        self.port = utils.get_free_port()
+        self.base_url = 'http://localhost:%d' % (self.port,)
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+
+    def get_price(self, symbol):
+        return round(100 + self.rng.random_sample() * 10, 2)
+
+    async def _last_trade(self, request):
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+        symbol = request.match_info['symbol']
+        return web.json_response({'status': 'success', 'symbol': symbol,
+                                  'last': {'price': self.get_price(symbol),
+                                           'timestamp': int(time.time() * 1000)}})
+
+    async def _snapshot(self, request):
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+        if self.fail_snapshot:
+            return web.json_response({'status': 'ERROR'}, status=500)
+        symbols = request.query['tickers'].split(',')
+        return web.json_response({'status': 'OK',
+                                  'tickers': [{'ticker': symbol,
+                                               'lastTrade': {'p': self.get_price(symbol),
+                                                             't': int(time.time() * 1E9)}}
+                                              for symbol in symbols]})
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/v1/last/stocks/{symbol}', self._last_trade)
+        app.router.add_get(SNAPSHOT_PATH, self._snapshot)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, 'localhost', self.port).start()
+
+    def start(self):
+        thread = threading.Thread(target=self.loop.run_forever, name='QuoteServer')
+        thread.daemon = True
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def benchmark(n_symbols, concurrency, latency):
+    """Compares quote throughput of the async fetcher and blocking per-symbol requests."""
+    server = QuoteServer(latency=latency)
+    server.start()
+    symbols = ['SYM%d' % (i,) for i in range(n_symbols)]
+    benchmark_table = []
+
+    def get_blocking(symbol):
+        r = requests.get('%s/v1/last/stocks/%s' % (server.base_url, symbol), timeout=DEFAULT_TIMEOUT)
+        return r.json()['last']['price']
+
+    start_time = time.time()
+    with futures.ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(get_blocking, symbols))
+    elapsed = time.time() - start_time
+    benchmark_table.append(['Blocking, 3 threads', n_symbols, n_symbols, '%.2f' % (elapsed,),
+                            '%.1f' % (n_symbols / elapsed,)])
+
+    for batch_size in [1, SNAPSHOT_BATCH_SIZE]:
+        fetcher = AsyncPriceFetcher('fake_api_key', server.base_url, concurrency=concurrency,
+                                    batch_size=batch_size)
+        start_time = time.time()
+        prices, errors = fetcher.get_prices(symbols)
+        elapsed = time.time() - start_time
+        mode = ('Async, concurrency %d' % (concurrency,) if batch_size == 1 else
+                'Async snapshot, batch %d' % (batch_size,))
+        benchmark_table.append([mode, len(prices), fetcher.request_count,
+                                '%.2f' % (elapsed,), '%.1f' % (len(prices) / elapsed,)])
+        if errors:
+            logging.warning('%d requests failed in async fetcher', len(errors))
+        fetcher.close()
+    server.stop()
+    logging.info(utils.get_header('Quote Fetch Benchmark') + '\n' +
+                 tabulate(benchmark_table, headers=['Mode', 'Quotes', 'Requests', 'Seconds', 'Quotes/sec'],
+                          tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark realtime price fetching offline.')
+    parser.add_argument('--symbols', default=1000, type=int, help='Number of symbols to fetch.')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, type=int,
+                        help='Max concurrent requests of the async fetcher.')
+    parser.add_argument('--latency', default=0.05, type=float,
+                        help='Simulated server latency in seconds.')
+    args = parser.parse_args()
+    utils.logging_config()
+    benchmark(args.symbols, args.concurrency, args.latency)
+
+
+if __name__ == '__main__':
+    main()
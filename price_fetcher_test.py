@@ -0,0 +1,52 @@
+import price_fetcher
+import unittest
+
+
+class AsyncPriceFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = price_fetcher.QuoteServer(latency=0)
+        self.server.start()
+        self.fetcher = price_fetcher.AsyncPriceFetcher('fake_api_key', self.server.base_url,
+                                                       concurrency=5)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.stop()
+
+    def test_get_prices(self):
+        symbols = ['SYM%d' % (i,) for i in range(20)]
+        self.fetcher.batch_size = 1
+        prices, errors = self.fetcher.get_prices(symbols)
+        self.assertEqual(sorted(prices.keys()), sorted(symbols))
+        self.assertEqual(errors, {})
+        self.assertEqual(self.server.request_count, 20)
+
+    def test_get_prices_snapshot(self):
+        symbols = ['SYM%d' % (i,) for i in range(20)]
+        self.fetcher.batch_size = 8
+        prices, errors = self.fetcher.get_prices(symbols)
+        self.assertEqual(sorted(prices.keys()), sorted(symbols))
+        self.assertEqual(errors, {})
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_get_prices_snapshot_fallback(self):
+        symbols = ['SYM%d' % (i,) for i in range(10)]
+        self.server.fail_snapshot = True
+        self.fetcher.batch_size = 5
+        prices, errors = self.fetcher.get_prices(symbols)
+        self.assertEqual(sorted(prices.keys()), sorted(symbols))
+        # 2 failed snapshots and 10 single-symbol requests
+        self.assertEqual(self.server.request_count, 12)
+
+    def test_get_prices_error(self):
+        self.server.stop()
+        prices, errors = self.fetcher.get_prices(['SYMA'])
+        self.assertEqual(prices, {})
+        self.assertIn('SYMA', errors)
+        self.server = price_fetcher.QuoteServer(latency=0)
+        self.server.start()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import alpaca_trade_api as tradeapi
+import alpaca_trade_api.polygon as polygonapi
+import argparse
+import logging
+import os
+import price_board
+import price_fetcher
+import price_stream
+import realtime
+import time
+import utils
+import warmup
+
+
+class PriceHub(realtime.PriceTracker):
+    """Loads histories and refreshes prices once for all traders of the day.
+
+    Histories and precomputed inputs are published as a shared warm-up artifact,
+    and prices as a price board, both in the hub directory. Traders subscribe
+    with realtime.py --hub, each with its own account and model. Refresh tiers
+    are ordered by the merged trading lists of all subscribers, so the number of
+    upstream requests does not grow with the number of subscribers. The hub
+    neither scores nor trades, so it loads no model.
+    """
+
+    def __init__(self, alpaca, polygon, fetcher=None, hub_dir=None):
+        hub_dir = hub_dir or price_board.get_hub_dir(os.path.dirname(os.path.realpath(__file__)))
+        self.board = None
+        super(PriceHub, self).__init__(alpaca, polygon, fetcher, hub_dir,
+                                       os.path.join(hub_dir, 'durations.json'),
+                                       warmup_dir=hub_dir, use_model=False)
+        self.hub_dir = hub_dir
+        if not warmup.has_artifact(hub_dir):
+            warmup.write_artifact(hub_dir, self, (self.thresholds, self.volatilities, self.feature_components),
+                                  shared=True)
+        self.board = price_board.PriceBoard(hub_dir, create=True)
+        self.board.publish([(self.price_times.get(symbol, 0), symbol, price)
+                            for symbol, price in self.prices.items()])
+        logging.info('Price hub of %d symbols published to %s', len(self.closes), hub_dir)
+
+    def set_prices(self, records):
+        super(PriceHub, self).set_prices(records)
+        if self.board:
+            self.board.publish(records)
+
+    def update_trading_list(self):
+        """Keeps merging trading lists of subscribers, in place of scoring."""
+        while time.time() < self.next_market_close:
+            self.trading_list = price_board.read_subscriptions(self.hub_dir)
+            self.maybe_write_metrics()
+            if not self.active:
+                return
+            if time.time() > self.next_market_close - 60 * 5:
+                time.sleep(1)
+            else:
+                time.sleep(10)
+
+    def trade_clock_watcher(self):
+        """Keeps publishing until market close, since subscribers re-check prices before buying."""
+        while True:
+            remaining = self.next_market_close - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 60))
+        self.active = False
+        logging.info(utils.get_header('Rate Limiters') + '\n' + utils.get_rate_limiter_table())
+        self.write_metrics()
+        self.stop_price_feeds()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stock price hub shared by realtime traders.')
+    parser.add_argument('--api_key', default=None, help='Alpaca API key.')
+    parser.add_argument('--api_secret', default=None, help='Alpaca API secret.')
+    parser.add_argument('--real_trade', help='Use the live trading API for market data.',
+                        action="store_true")
+    parser.add_argument('-f', '--force', help='Force to run even at market close.',
+                        action="store_true")
+    parser.add_argument('--sync_fetch', help='Fetch prices one symbol at a time instead of with the async '
+                        'connection pool, which retries its failed symbols that way.', action="store_true")
+    parser.add_argument('--stream', help='Receive pushed prices from the trade stream.',
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.api_key and args.api_secret or args.real_trade:
+        api_key = args.api_key or os.environ['ALPACA_API_KEY']
+        api_secret = args.api_secret or os.environ['ALPACA_API_SECRET']
+        base_url = utils.ALPACA_API_BASE_URL
+    else:
+        api_key = os.environ['ALPACA_PAPER_API_KEY']
+        api_secret = os.environ['ALPACA_PAPER_API_SECRET']
+        base_url = utils.ALPACA_PAPER_API_BASE_URL
+    alpaca = tradeapi.REST(api_key, api_secret, base_url, 'v2')
+    polygon = polygonapi.REST(api_key)
+    fetcher = (None if args.sync_fetch else
+               price_fetcher.AsyncPriceFetcher(api_key, rate_limiter=utils.RATE_LIMITERS['polygon']))
+
+    if alpaca.get_clock().is_open or args.force:
+        hub = PriceHub(alpaca, polygon, fetcher)
+        if args.stream:
+            hub.start_stream(price_stream.PriceStream(api_key))
+        hub.run()
+    else:
+        print('Market is closed. Use "-f" flag to force run.')
+
+
+if __name__ == '__main__':
+    main()
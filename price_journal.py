@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import threading
+
+# Number of appended records between two compactions
+COMPACT_EVERY = 20000
+# Bytes read at a time when looking for the last complete line
+READ_BLOCK_SIZE = 4096
+
+
+def parse_line(line):
+    """Parses a journal line into a (timestamp, symbol, price) record.
+
+    Returns None for a malformed line, e.g. one partially written in a crash.
+    """
+    if not line.endswith('\n'):
+        return None
+    try:
+        timestamp, symbol, price = line.rstrip('\n').split(',')
+        return float(timestamp), symbol, float(price)
+    except ValueError:
+        return None
+
+
+class PriceJournal(object):
+    """Append-only journal of realtime prices.
+
+    Each price is appended as a "timestamp,symbol,price" line, which is cheap
+    and never corrupts earlier records. Compaction writes a snapshot of the
+    latest prices with the journal offset it covers and atomically replaces the
+    previous snapshot, so replay only reads the journal tail. The journal is
+    never truncated and doubles as the intraday price history.
+    """
+
+    def __init__(self, journal_file, snapshot_file, compact_every=COMPACT_EVERY):
+        self.journal_file = journal_file
+        self.snapshot_file = snapshot_file
+        self.compact_every = compact_every
+        self.prices, self.times = {}, {}
+        self.lock = threading.Lock()
+        self.uncompacted = 0
+        # Byte offset of the journal end
+        self.offset = 0
+        self.f = None
+
+    def exists(self):
+        return os.path.isfile(self.journal_file) or self._read_snapshot() is not None
+
+    def _read_snapshot(self):
+        """Reads the snapshot, or returns None if there is none.
+
+        Cached prices of earlier versions, a plain dict from symbol to price
+        in the same file, are not snapshots.
+        """
+        if not os.path.isfile(self.snapshot_file):
+            return None
+        with open(self.snapshot_file) as f:
+            snapshot = json.loads(f.read())
+        if not all(key in snapshot for key in ['prices', 'times', 'offset']):
+            logging.warning('Ignore %s, which is not a price journal snapshot', self.snapshot_file)
+            return None
+        return snapshot
+
+    def replay(self):
+        """Restores the latest prices and their timestamps from snapshot and journal."""
+        offset = 0
+        snapshot = self._read_snapshot()
+        if snapshot is not None:
+            self.prices, self.times = snapshot['prices'], snapshot['times']
+            offset = snapshot['offset']
+        replayed = 0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    record = parse_line(line.decode(errors='replace'))
+                    if record is None:
+                        continue
+                    timestamp, symbol, price = record
+                    self.prices[symbol] = price
+                    self.times[symbol] = timestamp
+                    replayed += 1
+        logging.info('%d prices restored with %d records replayed from journal',
+                     len(self.prices), replayed)
+        return dict(self.prices), dict(self.times)
+
+    def append(self, records):
+        """Appends (timestamp, symbol, price) records."""
+        lines = ''.join('%.3f,%s,%r\n' % (timestamp, symbol, float(price))
+                        for timestamp, symbol, price in records)
+        with self.lock:
+            if self.f is None:
+                self._open()
+            self.f.write(lines)
+            self.f.flush()
+            self.offset += len(lines.encode())
+            for timestamp, symbol, price in records:
+                self.prices[symbol] = price
+                self.times[symbol] = timestamp
+            self.uncompacted += len(records)
+            if self.uncompacted >= self.compact_every:
+                self._compact()
+
+    def _open(self):
+        """Opens the journal for appending after its last complete line.
+
+        A line partially written in a crash is dropped, so that new records do
+        not join it.
+        """
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file, 'rb+') as f:
+                size = f.seek(0, os.SEEK_END)
+                end = size
+                while end > 0:
+                    start = max(end - READ_BLOCK_SIZE, 0)
+                    f.seek(start)
+                    i = f.read(end - start).rfind(b'\n')
+                    if i >= 0:
+                        end = start + i + 1
+                        break
+                    end = start
+                if end < size:
+                    logging.warning('Drop partially written line at the end of %s', self.journal_file)
+                    f.truncate(end)
+            self.offset = end
+        self.f = open(self.journal_file, 'a')
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        if self.f is None:
+            return
+        snapshot = {'prices': self.prices, 'times': self.times, 'offset': self.offset}
+        tmp_file = self.snapshot_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(snapshot))
+        os.replace(tmp_file, self.snapshot_file)
+        self.uncompacted = 0
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self._compact()
+                self.f.close()
+                self.f = None
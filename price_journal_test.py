@@ -0,0 +1,63 @@
+import os
+import price_journal
+import tempfile
+import unittest
+
+
+class PriceJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.dir.name, 'prices.journal')
+        self.snapshot_file = os.path.join(self.dir.name, 'prices.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_replay(self):
+        journal = price_journal.PriceJournal(self.journal_file, self.snapshot_file, compact_every=3)
+        journal.append([(1.0, 'SYMA', 10.5), (1.0, 'SYMB', 20.25)])
+        journal.append([(2.0, 'SYMA', 11.0), (3.0, 'SYMC', 30.0)])
+        journal.append([(4.0, 'SYMB', 21.0)])
+        self.assertTrue(os.path.isfile(self.snapshot_file))
+        prices, times = price_journal.PriceJournal(self.journal_file, self.snapshot_file).replay()
+        self.assertEqual(prices, {'SYMA': 11.0, 'SYMB': 21.0, 'SYMC': 30.0})
+        self.assertEqual(times, {'SYMA': 2.0, 'SYMB': 4.0, 'SYMC': 3.0})
+
+    def test_replay_partial_line(self):
+        journal = price_journal.PriceJournal(self.journal_file, self.snapshot_file)
+        journal.append([(1.0, 'SYMA', 10.5)])
+        with open(self.journal_file, 'a') as f:
+            f.write('2.000,SYMA,1')
+        prices, _ = price_journal.PriceJournal(self.journal_file, self.snapshot_file).replay()
+        self.assertEqual(prices, {'SYMA': 10.5})
+
+    def test_append_after_partial_line(self):
+        with open(self.journal_file, 'w') as f:
+            f.write('1.000,SYMA,10.5\n2.000,SYMA,1')
+        journal = price_journal.PriceJournal(self.journal_file, self.snapshot_file)
+        journal.replay()
+        journal.append([(3.0, 'SYMB', 20.0)])
+        journal.close()
+        with open(self.journal_file) as f:
+            self.assertEqual(f.read(), '1.000,SYMA,10.5\n3.000,SYMB,20.0\n')
+        prices, times = price_journal.PriceJournal(self.journal_file, self.snapshot_file).replay()
+        self.assertEqual(prices, {'SYMA': 10.5, 'SYMB': 20.0})
+        self.assertEqual(times, {'SYMA': 1.0, 'SYMB': 3.0})
+
+    def test_replay_malformed_line(self):
+        with open(self.journal_file, 'w') as f:
+            f.write('1.000,SYMA,10.5\n2.000,SYMA,13.000,SYMB,20.0\n3.000,SYMB,21.0\n')
+        prices, _ = price_journal.PriceJournal(self.journal_file, self.snapshot_file).replay()
+        self.assertEqual(prices, {'SYMA': 10.5, 'SYMB': 21.0})
+
+    def test_legacy_snapshot(self):
+        with open(self.snapshot_file, 'w') as f:
+            f.write('{"SYMA": 10.5}')
+        journal = price_journal.PriceJournal(self.journal_file, self.snapshot_file)
+        self.assertFalse(journal.exists())
+        self.assertEqual(journal.replay(), ({}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import aiohttp
+import aiohttp.web as web
+import argparse
+import asyncio
+import collections
+import csv
+import json
+import logging
+import numpy as np
+import threading
+import time
+import utils
+from tabulate import tabulate
+
+# Symbols per subscribe message
+SUBSCRIBE_BATCH_SIZE = 500
+# Number of latest event latencies kept for statistics
+LATENCY_HISTORY = 100000
+RECONNECT_WAIT_SECS = 1
+MAX_RECONNECT_WAIT_SECS = 60
+
+Tick = collections.namedtuple('Tick', ['timestamp', 'symbol', 'price'])
+
+
+class PriceStream(object):
+    """Subscribes to a realtime trade stream over a websocket.
+
+    Trades are reported with on_trade(symbol, price, timestamp) from a
+    background thread. The connection is re-established with backoff if it
+    drops.
+    """
+
+    def __init__(self, api_key, url=utils.POLYGON_STREAM_URL):
+        self.api_key = api_key
+        self.url = url
+        self.symbols = []
+        self.on_trade = None
+        self.active = False
+        self.connected = threading.Event()
+        self.event_count = 0
+        # Seconds between event time and receive time
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.loop = asyncio.new_event_loop()
+        self.task = None
+        self.thread = None
+
+    def start(self, symbols, on_trade):
+        self.symbols = list(symbols)
+        self.on_trade = on_trade
+        self.active = True
+        self.task = self.loop.create_task(self._run())
+        self.thread = threading.Thread(target=self._run_loop, name='PriceStream')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Closes the connection and waits for the stream thread to exit."""
+        self.active = False
+        if self.thread:
+            # The connection may be idle, so the task is cancelled rather than left to notice
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            self.thread.join()
+            self.thread = None
+
+    def _run_loop(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        wait_secs = RECONNECT_WAIT_SECS
+        async with aiohttp.ClientSession() as session:
+            while self.active:
+                try:
+                    await self._consume(session)
+                    wait_secs = RECONNECT_WAIT_SECS
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error('Price stream disconnected: %s', e)
+                self.connected.clear()
+                if self.active:
+                    await asyncio.sleep(wait_secs)
+                    wait_secs = min(wait_secs * 2, MAX_RECONNECT_WAIT_SECS)
+
+    async def _consume(self, session):
+        async with session.ws_connect(self.url, heartbeat=30) as ws:
+            await ws.send_str(json.dumps({'action': 'auth', 'params': self.api_key}))
+            for i in range(0, len(self.symbols), SUBSCRIBE_BATCH_SIZE):
+                params = ','.join('T.' + symbol for symbol in self.symbols[i:i + SUBSCRIBE_BATCH_SIZE])
+                await ws.send_str(json.dumps({'action': 'subscribe', 'params': params}))
+            self.connected.set()
+            logging.info('Price stream subscribed to %d symbols', len(self.symbols))
+            async for message in ws:
+                if not self.active:
+                    return
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                self._handle(json.loads(message.data))
+
+    def _handle(self, events):
+        receive_time = time.time()
+        for event in events:
+            if event.get('ev') != 'T':
+                continue
+            # Event timestamps are in milliseconds
+            timestamp = event['t'] / 1000
+            self.event_count += 1
+            self.latencies.append(receive_time - timestamp)
+            self.on_trade(event['sym'], float(event['p']), timestamp)
+
+    def get_latency_percentiles(self, percentiles=(50, 90, 99)):
+        if not self.latencies:
+            return [np.nan] * len(percentiles)
+        return list(np.percentile(self.latencies, percentiles))
+
+
+class ReplayServer(object):
+    """Local stand-in stream server that replays recorded ticks.
+
+    Gaps between ticks are kept, divided by speed. Events are stamped with the
+    time they are sent, so that client latency measures end-to-end delivery.
+    """
+
+    def __init__(self, ticks, speed=1.0):
+        self.ticks = sorted(ticks, key=lambda tick: tick.timestamp)
+        self.speed = speed
+        self.port = utils.get_free_port()
+        self.url = 'http://localhost:%d/stocks' % (self.port,)
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.sent_count = 0
+
+    async def _stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscribed = set()
+        await ws.send_str(json.dumps([{'ev': 'status', 'status': 'connected'}]))
+        # Wait for auth and subscribe messages before replaying
+        message = await ws.receive()
+        while message.type == aiohttp.WSMsgType.TEXT:
+            content = json.loads(message.data)
+            if content.get('action') == 'subscribe':
+                subscribed.update(param[2:] for param in content['params'].split(','))
+            try:
+                message = await ws.receive(timeout=0.1)
+            except asyncio.TimeoutError:
+                break
+        start_time = time.time()
+        first_timestamp = self.ticks[0].timestamp if self.ticks else 0
+        for tick in self.ticks:
+            if tick.symbol not in subscribed:
+                continue
+            delay = (tick.timestamp - first_timestamp) / self.speed - (time.time() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if ws.closed:
+                break
+            await ws.send_str(json.dumps([{'ev': 'T', 'sym': tick.symbol, 'p': tick.price,
+                                           't': int(time.time() * 1000)}]))
+            self.sent_count += 1
+        await ws.close()
+        return ws
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/stocks', self._stream)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, 'localhost', self.port).start()
+
+    def start(self):
+        thread = threading.Thread(target=self.loop.run_forever, name='ReplayServer')
+        thread.daemon = True
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def read_ticks(tick_file):
+    """Reads recorded ticks from a CSV file of timestamp, symbol and price."""
+    ticks = []
+    with open(tick_file) as f:
+        for row in csv.reader(f):
+            try:
+                ticks.append(Tick(float(row[0]), row[1], float(row[2])))
+            except (IndexError, ValueError):
+                # Header or partially written row
+                continue
+    return ticks
+
+
+def generate_ticks(n_symbols, n_ticks, duration):
+    rng = np.random.RandomState(0)
+    return [Tick(rng.random_sample() * duration, 'SYM%d' % (rng.randint(n_symbols),),
+                 round(100 + rng.random_sample() * 10, 2))
+            for _ in range(n_ticks)]
+
+
+def benchmark(ticks, speed):
+    """Replays ticks through a local server and reports delivery latency."""
+    server = ReplayServer(ticks, speed)
+    server.start()
+    received = []
+    stream = PriceStream('fake_api_key', server.url)
+    start_time = time.time()
+    stream.start(sorted(set(tick.symbol for tick in ticks)),
+                 lambda symbol, price, timestamp: received.append(symbol))
+    duration = (ticks[-1].timestamp - ticks[0].timestamp) / speed if ticks else 0
+    deadline = start_time + duration + 10
+    while len(received) < len(ticks) and time.time() < deadline:
+        time.sleep(0.1)
+    elapsed = time.time() - start_time
+    stream.stop()
+    server.stop()
+    p50, p90, p99 = stream.get_latency_percentiles()
+    logging.info(utils.get_header('Price Stream Benchmark') + '\n' +
+                 tabulate([['Ticks Sent', server.sent_count],
+                           ['Ticks Received', len(received)],
+                           ['Events/sec', '%.1f' % (len(received) / elapsed,)],
+                           ['Latency P50 (ms)', '%.2f' % (p50 * 1000,)],
+                           ['Latency P90 (ms)', '%.2f' % (p90 * 1000,)],
+                           ['Latency P99 (ms)', '%.2f' % (p99 * 1000,)]], tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded ticks through a local stream server.')
+    parser.add_argument('--ticks', default=None,
+                        help='CSV file of recorded ticks. Random ticks are generated if not set.')
+    parser.add_argument('--speed', default=1.0, type=float, help='Replay speed factor.')
+    args = parser.parse_args()
+    utils.logging_config()
+    ticks = read_ticks(args.ticks) if args.ticks else generate_ticks(100, 10000, 10)
+    benchmark(sorted(ticks, key=lambda tick: tick.timestamp), args.speed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import price_stream
+import time
+import unittest
+
+
+class PriceStreamTest(unittest.TestCase):
+
+    def test_replay(self):
+        ticks = [price_stream.Tick(i * 0.01, symbol, 100 + i)
+                 for i, symbol in enumerate(['SYMA', 'SYMB', 'SYMC'] * 5)]
+        server = price_stream.ReplayServer(ticks, speed=10)
+        server.start()
+        received = []
+        stream = price_stream.PriceStream('fake_api_key', server.url)
+        stream.start(['SYMA', 'SYMB'], lambda symbol, price, timestamp: received.append((symbol, price)))
+        for _ in range(50):
+            if len(received) == 10:
+                break
+            time.sleep(0.1)
+        thread = stream.thread
+        stream.stop()
+        server.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, [(tick.symbol, tick.price) for tick in ticks if tick.symbol != 'SYMC'])
+        self.assertEqual(len(stream.latencies), 10)
+
+    def test_stop_idle_stream(self):
+        ticks = [price_stream.Tick(0, 'SYMA', 100), price_stream.Tick(2, 'SYMA', 101)]
+        server = price_stream.ReplayServer(ticks)
+        server.start()
+        received = []
+        stream = price_stream.PriceStream('fake_api_key', server.url)
+        stream.start(['SYMA'], lambda symbol, price, timestamp: received.append((symbol, price)))
+        for _ in range(50):
+            if received:
+                break
+            time.sleep(0.1)
+        thread = stream.thread
+        start = time.monotonic()
+        stream.stop()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(thread.is_alive())
+        server.stop()
+        self.assertEqual(received, [('SYMA', 100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import collections
+import contextlib
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from tabulate import tabulate
+
+PROFILE_DIR = 'profile'
+# Seconds between stack samples of all threads
+SAMPLE_INTERVAL_SECS = 0.01
+# Innermost frames kept per sampled stack
+MAX_STACK_DEPTH = 64
+# Same header as utils.get_header, which is not imported since utils imports this module
+PHASES_HEADER = '== [ Profile Phases ] '.ljust(80, '=')
+
+PhaseStats = collections.namedtuple('PhaseStats', ['count', 'seconds', 'max_seconds', 'memory_peak'])
+
+
+class Profiler(object):
+    """Named phase timers, a sampling profiler and optional per-phase memory high-water marks.
+
+    Phases may overlap across threads. Memory is traced for the whole process,
+    so high-water marks of overlapping phases are approximate. Before Python
+    3.9, the high-water mark of a phase is the one since start. Tracing memory
+    slows down allocations, so it is only done if asked for.
+    """
+
+    def __init__(self, sample_interval=SAMPLE_INTERVAL_SECS):
+        self.sample_interval = sample_interval
+        self.enabled = False
+        self.trace_memory = False
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.stacks = collections.Counter()
+        self.sample_count = 0
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.start_time = None
+
+    def start(self, trace_memory=False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.start_time = time.monotonic()
+        if trace_memory:
+            tracemalloc.start()
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self.sample, name='Profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.stop_event.set()
+        self.sampler.join()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times a block as the named phase. Does nothing unless started."""
+        if not self.enabled:
+            yield
+            return
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            memory_peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+            with self.lock:
+                stats = self.phases.get(name, PhaseStats(0, 0, 0, 0))
+                self.phases[name] = PhaseStats(stats.count + 1, stats.seconds + seconds,
+                                               max(stats.max_seconds, seconds),
+                                               max(stats.memory_peak, memory_peak))
+
+    def sample(self):
+        """Counts stacks of all other threads until stopped."""
+        sampler_id = threading.get_ident()
+        while not self.stop_event.wait(self.sample_interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(stacks)
+                self.sample_count += 1
+
+    def get_phase_table(self):
+        with self.lock:
+            return [[name, stats.count, '%.3f' % (stats.seconds,), '%.3f' % (stats.max_seconds,),
+                     '%.1f' % (stats.memory_peak / 2 ** 20,) if self.trace_memory else '-']
+                    for name, stats in self.phases.items()]
+
+    def write(self, output_dir):
+        """Stops profiling and writes phase times and sampled stacks into output_dir.
+
+        Sampled stacks are written in the collapsed format of flame graph tools.
+        """
+        self.stop()
+        profile_dir = os.path.join(output_dir, PROFILE_DIR)
+        os.makedirs(profile_dir, exist_ok=True)
+        phase_output = (PHASES_HEADER + '\n' +
+                        tabulate(self.get_phase_table(),
+                                 headers=['Phase', 'Count', 'Seconds', 'Max Seconds', 'Memory Peak (MB)'],
+                                 tablefmt='grid'))
+        with open(os.path.join(profile_dir, 'phases.txt'), 'w') as f:
+            f.write(phase_output + '\n')
+        with open(os.path.join(profile_dir, 'stacks.txt'), 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+        logging.info(phase_output)
+        logging.info('%d stack samples over %.1f seconds written to %s',
+                     self.sample_count, time.monotonic() - self.start_time, profile_dir)
+
+
+PROFILER = Profiler()
+
+
+def start(trace_memory=False):
+    PROFILER.start(trace_memory)
+
+
+def phase(name):
+    return PROFILER.phase(name)
+
+
+def timed(name):
+    """Decorates a function to time its calls as the named phase."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def write(output_dir):
+    PROFILER.write(output_dir)
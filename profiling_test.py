@@ -0,0 +1,66 @@
+import os
+import profiling
+import tempfile
+import time
+import tracemalloc
+import unittest
+import unittest.mock as mock
+
+
+def busy(seconds):
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        pass
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = profiling.Profiler(sample_interval=0.001)
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.dir.cleanup()
+
+    def test_phase_disabled(self):
+        with self.profiler.phase('features'):
+            busy(0.01)
+        self.assertEqual(self.profiler.phases, {})
+
+    def test_phase_and_write(self):
+        self.profiler.start(trace_memory=True)
+        for _ in range(2):
+            with self.profiler.phase('features'):
+                data = [0] * 100000
+                busy(0.05)
+        del data
+        stats = self.profiler.phases['features']
+        self.assertEqual(stats.count, 2)
+        self.assertGreaterEqual(stats.seconds, 0.1)
+        self.assertGreater(stats.memory_peak, 0)
+        self.profiler.write(self.dir.name)
+        self.assertFalse(self.profiler.enabled)
+        with open(os.path.join(self.dir.name, profiling.PROFILE_DIR, 'phases.txt')) as f:
+            self.assertIn('features', f.read())
+        with open(os.path.join(self.dir.name, profiling.PROFILE_DIR, 'stacks.txt')) as f:
+            self.assertIn('profiling_test.py:busy', f.read())
+
+    def test_phase_without_memory(self):
+        self.profiler.start()
+        self.assertFalse(tracemalloc.is_tracing())
+        with self.profiler.phase('features'):
+            busy(0.01)
+        self.assertEqual(self.profiler.phases['features'].memory_peak, 0)
+        self.assertEqual(self.profiler.get_phase_table()[0][-1], '-')
+
+    def test_timed(self):
+        timed_busy = profiling.timed('predict')(busy)
+        self.profiler.start()
+        with mock.patch.object(profiling, 'PROFILER', self.profiler):
+            timed_busy(0.01)
+        self.assertEqual(self.profiler.phases['predict'].count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import argparse
+import http.server
+import logging
+import os
+import requests
+import socketserver
+import threading
+import time
+import utils
+from tabulate import tabulate
+
+FIXTURES_DIR = 'fixtures'
+VIX_PAGE_FIXTURE = 'vix_quote_page.html'
+VIX_PREFIXES = ['"currentPrice"', '"regularMarketPrice"']
+
+
+def parse_quote_legacy(content, prefixes):
+    """Former parser of utils.web_scraping, kept as the benchmark baseline."""
+    c = str(content)
+    for prefix in prefixes:
+        prefix_pos = c.find(prefix)
+        if prefix_pos >= 0:
+            pos = prefix_pos + len(prefix)
+            s = ''
+            while c[pos] > '9' or c[pos] < '0':
+                pos += 1
+            while '9' >= c[pos] >= '0' or c[pos] in ['.', ',']:
+                if c[pos] != ',':
+                    s += c[pos]
+                pos += 1
+            if pos - prefix_pos < 100:
+                return s
+    return None
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class PageServer(object):
+    """Local stand-in serving a saved page with ETag validation and keep-alive."""
+
+    def __init__(self, content):
+        self.content = content
+        self.etag = '"%x"' % (hash(content) & 0xffffffff,)
+        self.request_count = 0
+        self.port = utils.get_free_port()
+        self.url = 'http://localhost:%d/quote/^VIX' % (self.port,)
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.request_count += 1
+                if self.headers.get('If-None-Match') == server.etag:
+                    self.send_response(304)
+                    self.send_header('ETag', server.etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', server.etag)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(server.content)))
+                self.end_headers()
+                self.wfile.write(server.content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer(('localhost', self.port), Handler)
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever, name='PageServer')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def read_fixture(name):
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def benchmark(iterations):
+    """Compares the former and current VIX quote paths on a saved page."""
+    content = read_fixture(VIX_PAGE_FIXTURE)
+    expected = utils.parse_quote(content, VIX_PREFIXES)
+    if parse_quote_legacy(content, VIX_PREFIXES) != expected:
+        raise ValueError('Parsers disagree on %s' % (VIX_PAGE_FIXTURE,))
+    benchmark_table = []
+
+    def measure(mode, func):
+        start = time.monotonic()
+        for _ in range(iterations):
+            func()
+        elapsed = time.monotonic() - start
+        benchmark_table.append([mode, iterations, '%.3f' % (elapsed / iterations * 1000,)])
+
+    measure('Parse: str + character scan', lambda: parse_quote_legacy(content, VIX_PREFIXES))
+    measure('Parse: compiled regex on bytes', lambda: utils.parse_quote(content, VIX_PREFIXES))
+
+    server = PageServer(content)
+    server.start()
+    try:
+        measure('Fetch: new connection per request',
+                lambda: parse_quote_legacy(requests.get(server.url, timeout=5).content, VIX_PREFIXES))
+        session = requests.Session()
+        measure('Fetch: persistent session',
+                lambda: utils.parse_quote(session.get(server.url, timeout=5).content, VIX_PREFIXES))
+        scraper = utils.QuoteScraper(rate_limiter=None)
+        measure('Fetch: session + conditional requests',
+                lambda: scraper.get_quote(server.url, VIX_PREFIXES))
+        scraper = utils.QuoteScraper(rate_limiter=None)
+        measure('Fetch: session + 1s cache',
+                lambda: scraper.get_quote(server.url, VIX_PREFIXES, max_age=1))
+    finally:
+        server.stop()
+    logging.info(utils.get_header('VIX Quote Benchmark') + '\n' +
+                 tabulate(benchmark_table, headers=['Mode', 'Quotes', 'Milliseconds/quote'], tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VIX quote scraping on saved pages.')
+    parser.add_argument('--iterations', default=200, type=int, help='Quotes per mode.')
+    args = parser.parse_args()
+    utils.logging_config()
+    benchmark(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
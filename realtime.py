@@ -1,100 +1,303 @@
 import alpaca_trade_api as tradeapi
 import alpaca_trade_api.polygon as polygonapi
 import argparse
+import asyncio
+import collections
 import datetime
-import json
 import logging
+import metrics
 import numpy as np
 import os
+import pickle
+import price_board
+import price_fetcher
+import price_journal
+import price_stream
+import profiling
 import sys
 import threading
 import time
 import requests
 import retrying
+import scheduler
+import scoring
 import utils
+import warmup
 from concurrent import futures
 from tabulate import tabulate
 from tqdm import tqdm
 
 ERROR_TOLERANCE = 10
+# (number of top symbols, seconds between refreshes) of each refresh tier
+UPDATE_FREQUENCIES = [(10, 120), (100, 600), (None, 2400)]
+# Snapshot requests cover many symbols each, so tiers refresh much more often
+SNAPSHOT_UPDATE_FREQUENCIES = [(10, 5), (100, 15), (None, 120)]
+# Streamed prices younger than this are not polled
+STREAM_FRESH_SECS = 60
+# Minimum seconds between two re-scorings triggered by streamed prices
+STREAM_RESCORE_SECS = 1
+# Seconds before market close to start trading
+TRADE_START_SECS = 90
+# Default seconds before market close to stop waiting for limit orders
+SELL_LIMIT_DEADLINE_SECS = 60
+BUY_LIMIT_DEADLINE_SECS = 30
+# Seconds kept in reserve when fitting steps before deadlines
+DEADLINE_MARGIN_SECS = 5
+# Max number of orders submitted concurrently
+ORDER_WORKERS = 10
+# Seconds between polls of open orders. Polls are a fallback with trade updates.
+ORDER_POLL_SECS = 2
+ORDER_POLL_SECS_WITH_UPDATES = 5
+# Max age of prices of symbols to buy. Older prices are re-fetched before buying.
+BUY_PRICE_MAX_AGE_SECS = 10
+# VIX is requested by several refresh loops. Reuse quotes younger than this.
+VIX_MAX_AGE_SECS = 1
+# Minimum seconds between two writes of the metrics file
+METRICS_WRITE_SECS = 60
+# Minimum seconds between two snapshots of the realtime state
+STATE_SNAPSHOT_SECS = 30
+# Directory of series and inputs of state snapshots, if no warm-up artifact is used
+STATE_SERIES_DIR = 'state'
+# Market-wide price moves of what-if scenarios scored before close
+SCENARIO_MARKET_MOVES = [-0.02, -0.01, -0.005, 0, 0.005, 0.01, 0.02]
+# Seconds before market close to start scoring what-if scenarios
+SCENARIO_START_SECS = 60 * 5
+# Largest price deviation from a scenario for its trading list to be looked up
+SCENARIO_TOLERANCE = 0.0025
+FINAL_ORDER_EVENTS = ('fill', 'canceled', 'expired', 'rejected', 'done_for_day')
+# Alpaca error code of an order whose client order ID was already used
+DUPLICATE_CLIENT_ORDER_ID_CODE = 40010001
+# Retries of an order submission that failed on the network
+ORDER_SUBMIT_RETRIES = 2
 
+OrderRequest = collections.namedtuple('OrderRequest', ['symbol', 'qty', 'side', 'type', 'limit_price'])
+
+
+def get_client_order_id(order, attempt):
+    """Gets the idempotency key of a placement attempt of an order.
+
+    Network retries of a submission reuse the key, so that the broker rejects
+    duplicates. Placing the order again, e.g. after its limit order is
+    cancelled, is a new attempt with a new key.
+    """
+    return '%s-%s-%s-%s-%d' % (utils.get_business_day(0), order.side, order.type, order.symbol, attempt)
+
+
+def submit_orders(alpaca, orders, client_order_ids, max_workers=ORDER_WORKERS):
+    """Submits orders concurrently.
+
+    Returns a dict from client order ID to the submitted order or the exception raised.
+    An order rejected as duplicate was already submitted by a retry and counts as success.
+    """
+
+    def submit(order, client_order_id):
+        kwargs = {'client_order_id': client_order_id}
+        if order.type == 'limit':
+            kwargs['limit_price'] = order.limit_price
+        for retry in range(ORDER_SUBMIT_RETRIES + 1):
+            try:
+                return alpaca.submit_order(order.symbol, order.qty, order.side, order.type, 'day', **kwargs)
+            except tradeapi.rest.APIError as e:
+                if e.code == DUPLICATE_CLIENT_ORDER_ID_CODE:
+                    logging.info('Order %s was already submitted', client_order_id)
+                    return None
+                return e
+            except requests.exceptions.RequestException as e:
+                # The order may have reached the broker, so it is retried with the same key
+                if retry == ORDER_SUBMIT_RETRIES:
+                    return e
+                logging.warning('Retry order %s after network error: %s', client_order_id, e)
+
+    results = {}
+    if not orders:
+        return results
+    with futures.ThreadPoolExecutor(max_workers=min(max_workers, len(orders))) as pool:
+        for client_order_id, result in zip(client_order_ids, pool.map(submit, orders, client_order_ids)):
+            results[client_order_id] = result
+    return results
 
-class TradingRealTime(utils.TradingBase):
-    """Tracks daily stock price changes and make transactions on Alpaca."""
 
-    def __init__(self, alpaca, polygon):
+class PriceTracker(utils.TradingBase):
+    """Keeps realtime prices of tracked symbols fresh until market close.
+
+    Symbols are refreshed in tiers, ordered by how likely they are to be
+    traded, from upstream, a price stream or the price hub. Prices are
+    journaled. Subclasses define trade_clock_watcher and update_trading_list,
+    which run next to the refresh loops.
+    """
+
+    def __init__(self, alpaca, polygon, fetcher, output_dir, durations_file, warmup_dir=None, hub_dir=None,
+                 restore_state=False, model=None, use_model=True):
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
-        output_dir = os.path.join(self.root_dir, utils.OUTPUTS_DIR, 'realtime',
-                                  utils.get_business_day(0))
         os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
         utils.logging_config(os.path.join(output_dir, 'log.txt'))
-        super(TradingRealTime, self).__init__(alpaca)
+        # Subscribers of a price hub start from the artifact of the hub
+        if hub_dir and not warmup.has_artifact(hub_dir):
+            raise ValueError('Price hub has not published to %s yet' % (hub_dir,))
+        self.warmup_dir = hub_dir or warmup_dir or warmup.get_warmup_dir(self.root_dir)
+        # Histories are not needed when restarting from a state snapshot or a warm-up artifact
+        self.restore_state = restore_state
+        self.use_warmup = not self.restore_state and warmup.has_artifact(self.warmup_dir)
         self.active = True
-        self.equity, self.cash = 0, 0
         self.polygon = polygon
-        self.update_account()
+        self.fetcher = fetcher
+        self.stream = None
+        # Set once price feeds are stopped at the end of the session
+        self.feeds_stopped = False
+        self.stream_updates = {}
         self.lock = threading.RLock()
         self.thresholds = {}
+        self.volatilities = {}
+        self.feature_components = {}
         self.prices = {}
+        self.price_times = {}
         self.ordered_symbols = []
+        self.trading_list = []
+        self.last_updates = {}
+        self.metrics = metrics.MetricsRegistry()
+        self.last_metrics_write = None
+        self.series_dir = None
+        self.price_board = price_board.PriceBoard(hub_dir) if hub_dir else None
         self.errors = []
 
-        self.price_cache_file = os.path.join(output_dir, 'prices.json')
-        self.drop_low_volume_symbols()
+        self.price_journal = price_journal.PriceJournal(os.path.join(output_dir, 'prices.journal'),
+                                                        os.path.join(output_dir, 'prices.json'))
+        self.read_cache = self.price_journal.exists()
+        self.scheduler = scheduler.DeadlineScheduler(durations_file)
+
+        super(PriceTracker, self).__init__(alpaca, model=model, use_model=use_model,
+                                           load_history=not (self.restore_state or self.use_warmup))
+
+        self.update_ordered_symbols()
+
+        self.update_frequencies = [(length or len(self.ordered_symbols), sleep_secs)
+                                   for length, sleep_secs in (SNAPSHOT_UPDATE_FREQUENCIES if self.fetcher
+                                                              else UPDATE_FREQUENCIES)]
+        if not self.read_cache and not self.restore_state:
+            self.last_updates[self.update_frequencies[-1][0]] = datetime.datetime.now()
+        self.next_market_close = self.clock.next_close.timestamp()
+
+    def get_startup_stages(self, load_history):
+        """Adds stages of series, inputs and current prices to initialization.
+
+        Current prices are fetched while inputs are prepared.
+        """
+        stages = super(PriceTracker, self).get_startup_stages(load_history)
+        if self.use_warmup:
+            stages.append(utils.Stage('warmup', self.load_warmup_or_series, ['clock']))
+        elif not self.restore_state:
+            stages.append(utils.Stage('drop_low_volume', self.drop_low_volume_symbols, ['series']))
+        # Only one of the stages of series is in the graph. Subclasses restore series in a state stage.
+        series_stages = ['state', 'warmup', 'drop_low_volume']
+        stages.append(utils.Stage('prices', self.load_prices, series_stages))
+        if not self.restore_state:
+            stages.append(utils.Stage('inputs', self.load_inputs, series_stages))
+        return stages
 
-        read_cache = os.path.isfile(self.price_cache_file)
-        if read_cache:
+    def load_warmup_or_series(self):
+        """Maps the warm-up artifact, or loads histories if it cannot be used."""
+        if not self.load_warmup():
+            self.use_warmup = False
+            self.load_all_series()
+            self.drop_low_volume_symbols()
+
+    def load_prices(self):
+        """Loads current prices from the price journal, the price hub or upstream."""
+        if self.read_cache:
             logging.info('Reading cached stock prices...')
-            with open(self.price_cache_file) as f:
-                self.prices = json.loads(f.read())
-        else:
+            # The journal is at least as recent as the state snapshot
+            prices, price_times = self.price_journal.replay()
+            self.prices.update(prices)
+            self.price_times.update(price_times)
+        elif not self.restore_state and not self.price_board:
             logging.info('Loading current stock prices...')
             self.update_prices(self.closes.keys(), use_tqdm=True)
+        if self.price_board:
+            self.sync_price_board()
 
-        for symbol in self.closes.keys():
-            threshold = self.get_threshold(symbol)
-            self.thresholds[symbol] = threshold
+    def load_inputs(self):
+        """Prepares price-independent inputs, unless mapped from the warm-up artifact."""
+        if not self.use_warmup:
+            self.thresholds, self.volatilities, self.feature_components = warmup.prepare_inputs(self)
 
-        self.update_ordered_symbols()
+    def get_feature_components(self, symbol, cutoff=None):
+        if cutoff is None and symbol in self.feature_components:
+            return self.feature_components[symbol]
+        return super(PriceTracker, self).get_feature_components(symbol, cutoff)
 
-        self.update_frequencies = [(10, 120), (100, 600),
-                                   (len(self.ordered_symbols), 2400)]
-        self.last_updates = ({self.update_frequencies[-1][0]: datetime.datetime.now()}
-                             if not read_cache else {})
-        self.trading_list = []
-        self.next_market_close = self.alpaca.get_clock().next_close.timestamp()
-
-    def drop_low_volume_symbols(self):
-        """Drops to-be-tracked symbols with low volumes."""
-        dropped_keys = []
-        for symbol in self.closes.keys():
-            avg_trading_volume = np.average(np.multiply(
-                self.closes[symbol][-20:], self.volumes[symbol][-20:]))
-            if avg_trading_volume < utils.VOLUME_FILTER_THRESHOLD and symbol != '^VIX':
-                dropped_keys.append(symbol)
-        for symbol in dropped_keys:
-            self.closes.pop(symbol)
-            self.volumes.pop(symbol)
-        logging.info('%d loaded symbols after drop symbols with cash volume lower than $%.1E',
-                     len(self.closes), utils.VOLUME_FILTER_THRESHOLD)
+    def load_warmup(self):
+        """Maps the pre-market warm-up artifact of the day.
 
-    def trade_clock_watcher(self):
-        """Makes transactions near market close."""
-        while time.time() < self.next_market_close - 90:
-            time.sleep(1)
-        self.active = False
-        # Wait for all printing done
-        time.sleep(1)
-        self.trade()
+        Returns whether the artifact was used. It is ignored if built for a different model.
+        """
+        closes, volumes, meta = warmup.read_artifact(self.warmup_dir)
+        if meta['model'] is not None and meta['model'] != os.path.basename(self.model_path or ''):
+            logging.warning('Ignore warm-up artifact built for model %s', meta['model'])
+            return False
+        self.closes, self.volumes = closes, volumes
+        self.symbols = list(self.closes.keys())
+        self.thresholds = meta['thresholds']
+        self.volatilities = meta['volatilities']
+        self.feature_components = meta['feature_components']
+        self.history_dates = meta['history_dates']
+        self.history_length = len(self.history_dates)
+        self.series_dir = self.warmup_dir
+        logging.info('Warm-up artifact of %d symbols mapped', len(self.closes))
+        return True
+
+    def write_metrics(self):
+        """Writes metrics in Prometheus text format and a summary next to the log."""
+        for rate_limiter in utils.RATE_LIMITERS.values():
+            rate_limiter_metrics = rate_limiter.get_metrics()
+            for key in ['rate', 'requests', 'throttled', 'wait_secs']:
+                self.metrics.set('rate_limiter_' + key, rate_limiter_metrics[key],
+                                 upstream=rate_limiter_metrics['name'])
+        self.metrics.write(os.path.join(self.output_dir, 'metrics.prom'),
+                           os.path.join(self.output_dir, 'summary.txt'))
+        self.last_metrics_write = time.monotonic()
+
+    def maybe_write_metrics(self):
+        if (self.last_metrics_write is None or
+                time.monotonic() - self.last_metrics_write >= METRICS_WRITE_SECS):
+            self.write_metrics()
+
+    def start_stream(self, stream):
+        """Subscribes to pushed prices of all tracked symbols. Polling continues as a fallback."""
+        self.stream = stream
+        self.stream.start([symbol for symbol in self.closes.keys() if symbol != '^VIX'],
+                          self.on_trade)
+
+    def on_trade(self, symbol, price, timestamp):
+        """Updates a streamed price."""
+        if symbol not in self.closes:
+            return
+        self.set_prices([(timestamp, symbol, price)])
+        self.stream_updates[symbol] = timestamp
+
+    def get_trade_start_time(self):
+        return self.next_market_close - TRADE_START_SECS
 
     def update_stats(self, length, sleep_secs):
         """Keeps updating a subset of symbols in self.ordered_symbols."""
         while time.time() < self.next_market_close:
             with self.lock:
                 symbols = [symbol for symbol in self.ordered_symbols[:length]]
-            self.update_prices(symbols)
-            self.update_ordered_symbols()
-            self.last_updates[length] = datetime.datetime.now()
+            if self.stream:
+                # Only poll symbols with gaps in the stream
+                now = time.time()
+                symbols = [symbol for symbol in symbols
+                           if now - self.stream_updates.get(symbol, 0) > STREAM_FRESH_SECS]
+            symbols = self.fit_refresh_scope(length, symbols)
+            if symbols:
+                start = time.monotonic()
+                self.update_prices(symbols)
+                self.scheduler.record('refresh_%d' % (length,), time.monotonic() - start)
+                self.metrics.observe('refresh_cycle_seconds', time.monotonic() - start,
+                                     'Time to refresh prices of a refresh tier.', tier=length)
+                self.scheduler.record('quote', (time.monotonic() - start) / len(symbols))
+                self.update_ordered_symbols()
+                self.last_updates[length] = datetime.datetime.now()
             if not self.active:
                 return
             if time.time() > self.next_market_close - 60 * 5:
@@ -102,10 +305,36 @@ class TradingRealTime(utils.TradingBase):
             else:
                 time.sleep(sleep_secs)
 
+    def fit_refresh_scope(self, length, symbols):
+        """Cuts a refresh down to what can finish before trading starts.
+
+        The top tier is never cut. Lower tiers are cut to the number of quotes
+        expected to fit in the remaining time, and are skipped entirely while
+        the top tier is falling behind its schedule.
+        """
+        top_length, top_sleep_secs = self.update_frequencies[0]
+        if length <= top_length or not symbols:
+            return symbols
+        top_lag = self.scheduler.seconds_since('refresh_%d' % (top_length,))
+        if top_lag is not None and top_lag > 2 * top_sleep_secs:
+            logging.info('Skip refreshing TOP %d since TOP %d is %.0f seconds behind',
+                         length, top_length, top_lag - top_sleep_secs)
+            return []
+        quote_secs = self.scheduler.estimate('quote')
+        if not quote_secs:
+            return symbols
+        remaining = self.get_trade_start_time() - time.time()
+        scope = max(int(remaining / quote_secs), 0)
+        if scope < len(symbols):
+            logging.info('Refresh %d out of TOP %d symbols to finish in %.0f seconds',
+                         scope, length, remaining)
+            symbols = symbols[:scope]
+        return symbols
+
     def update_trading_list_prices(self):
         """Keeps updating stock prices of symbols in the trading list."""
         while time.time() < self.next_market_close:
-            self.update_prices(['^VIX'] + [symbol for symbol, _, _ in self.trading_list])
+            self.update_prices(['^VIX'] + [symbol for symbol, _, _, _ in self.trading_list])
             if not self.active:
                 return
             if time.time() > self.next_market_close - 60 * 5:
@@ -113,6 +342,25 @@ class TradingRealTime(utils.TradingBase):
             else:
                 time.sleep(60)
 
+    def sync_price_board(self):
+        """Takes prices published by the price hub since the last sync."""
+        records = self.price_board.read(since=self.price_times)
+        if records:
+            self.set_prices(records)
+
+    def follow_price_board(self):
+        """Keeps taking prices from the price hub and subscribing to symbols on the trading list."""
+        name = os.path.basename(self.output_dir)
+        while time.time() < self.next_market_close:
+            self.sync_price_board()
+            price_board.subscribe(self.price_board.directory, name, self.trading_list)
+            if not self.active:
+                return
+            if time.time() > self.next_market_close - 60 * 5:
+                time.sleep(1)
+            else:
+                time.sleep(10)
+
     def get_realtime_price(self, symbol):
         """Obtains realtime price for a symbol."""
 
@@ -120,21 +368,42 @@ class TradingRealTime(utils.TradingBase):
         def _get_realtime_price_impl(sym):
             if sym == '^VIX':
                 p = float(utils.web_scraping('https://finance.yahoo.com/quote/^VIX',
-                                             ['"currentPrice"', '"regularMarketPrice"']))
+                                             ['"currentPrice"', '"regularMarketPrice"'],
+                                             max_age=VIX_MAX_AGE_SECS))
             else:
-                p = self.polygon.last_trade(sym).price
+                p = utils.RATE_LIMITERS['polygon'].call(self.polygon.last_trade, sym).price
             return p
 
+        start = time.monotonic()
         try:
             price = _get_realtime_price_impl(symbol)
         except requests.exceptions.RequestException as e:
             logging.error('Exception raised in get_realtime_price for %s: %s', symbol, e)
             self.errors.append(sys.exc_info())
         else:
+            self.metrics.observe('quote_fetch_seconds', time.monotonic() - start,
+                                 'Latency of single-symbol quote fetches, including retries.',
+                                 source='yahoo' if symbol == '^VIX' else 'polygon')
+            self.set_prices([(time.time(), symbol, price)])
+
+    def set_prices(self, records):
+        """Sets prices from (timestamp, symbol, price) records and journals them."""
+        for timestamp, symbol, price in records:
             self.prices[symbol] = price
+            self.price_times[symbol] = timestamp
+        with self.lock:
+            # Prices fetched in flight when the session ends are not journaled
+            if not self.feeds_stopped:
+                self.price_journal.append(records)
 
     def update_prices(self, symbols, use_tqdm=False):
         """Updates realtime prices for a list of symbols."""
+        # Refresh loops end when trading starts, after which the fetcher is closed
+        if not self.active:
+            return
+        if self.fetcher:
+            self.update_prices_async(symbols)
+            return
         threads = []
         with futures.ThreadPoolExecutor(max_workers=3) as pool:
             for symbol in symbols:
@@ -148,30 +417,95 @@ class TradingRealTime(utils.TradingBase):
                 if not self.active:
                     return
                 t.result()
-        with self.lock:
-            with open(self.price_cache_file, 'w') as f:
-                f.write(json.dumps(self.prices))
+
+    def update_prices_async(self, symbols):
+        """Updates realtime prices with the async fetcher.
+
+        Symbols failed in the async fetcher are retried one by one with get_realtime_price.
+        """
+        symbols = list(symbols)
+        if '^VIX' in symbols:
+            symbols.remove('^VIX')
+            self.get_realtime_price('^VIX')
+        request_count = self.fetcher.request_count
+        start = time.monotonic()
+        prices, errors = self.fetcher.get_prices(symbols)
+        self.metrics.observe('quote_batch_seconds', time.monotonic() - start,
+                             'Latency of async fetcher batches.')
+        logging.debug('%d prices fetched with %d requests', len(prices),
+                      self.fetcher.request_count - request_count)
+        now = time.time()
+        self.set_prices([(now, symbol, price) for symbol, price in prices.items()])
+        for symbol, e in errors.items():
+            if not self.active:
+                return
+            logging.warning('Async fetcher failed for %s: %s. Retry with get_realtime_price.', symbol, e)
+            self.get_realtime_price(symbol)
 
     def update_ordered_symbols(self):
-        """Re-orders self.ordered_symbols based on how likely symbols will be selected."""
-        self.ordered_symbols = list(self.prices.keys())
+        """Re-orders self.ordered_symbols based on how likely symbols will be selected.
 
-    @retrying.retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000)
-    def update_account(self):
-        account = self.alpaca.get_account()
-        self.equity = float(account.equity)
-        self.cash = float(account.cash)
+        Symbols already on the trading list come first, ordered by model weight.
+        Other symbols follow, ordered by how far their current weekly return is
+        above the buy threshold, in units of weekly volatility.
+        """
+        weights = {symbol: float(np.squeeze(weight)) for symbol, _, weight, _ in self.trading_list}
+        distances = {}
+        for symbol, price in list(self.prices.items()):
+            if symbol in weights:
+                continue
+            if symbol not in self.thresholds or symbol == '^VIX':
+                distances[symbol] = np.inf
+                continue
+            weekly_return = np.log(price / self.closes[symbol][-utils.DAYS_IN_A_WEEK])
+            distances[symbol] = ((weekly_return - self.thresholds[symbol]) /
+                                 max(self.volatilities.get(symbol, 0), 1E-6))
+        ordered_symbols = (sorted(weights.keys(), key=lambda symbol: weights[symbol], reverse=True) +
+                           sorted(distances.keys(), key=lambda symbol: distances[symbol]))
+        with self.lock:
+            self.ordered_symbols = ordered_symbols
+
+    def get_tier_staleness(self, now=None):
+        """Gets the median and 90th percentile of price ages in seconds of each refresh tier."""
+        now = now or time.time()
+        with self.lock:
+            ordered_symbols = list(self.ordered_symbols)
+        staleness = []
+        for length, _ in self.update_frequencies:
+            ages = [now - self.price_times[symbol] for symbol in ordered_symbols[:length]
+                    if symbol in self.price_times]
+            staleness.append((length,
+                              np.percentile(ages, 50) if ages else np.nan,
+                              np.percentile(ages, 90) if ages else np.nan))
+        return staleness
+
+    def stop_price_feeds(self):
+        """Stops the price stream and the async fetcher, and closes the price journal.
+
+        The stream is stopped first, since its thread journals every pushed price.
+        """
+        if self.stream:
+            self.stream.stop()
+        if self.fetcher:
+            self.fetcher.close()
+        with self.lock:
+            self.feeds_stopped = True
+            self.price_journal.close()
 
     def run(self):
-        for args in self.update_frequencies:
-            t = threading.Thread(target=self.update_stats, args=args)
-            t.daemon = True
-            t.start()
+        if self.price_board:
+            # The price hub refreshes prices for all subscribers
+            targets = [self.follow_price_board]
+        else:
+            for args in self.update_frequencies:
+                t = threading.Thread(target=self.update_stats, args=args)
+                t.daemon = True
+                t.start()
+            targets = [self.update_trading_list_prices]
 
         main_threads = []
-        for target in [self.update_trading_list_prices,
-                       self.trade_clock_watcher,
-                       self.update_trading_list]:
+        for target in targets + [self.trade_clock_watcher,
+                                 self.update_trading_list]:
             t = threading.Thread(target=target)
             t.daemon = True
             t.start()
@@ -191,73 +525,536 @@ class TradingRealTime(utils.TradingBase):
         for t in main_threads:
             t.join()
 
+
+class TradingRealTime(PriceTracker):
+    """Tracks daily stock price changes and make transactions on Alpaca."""
+
+    def __init__(self, alpaca, polygon, fetcher=None, output_dir=None, warmup_dir=None, hub_dir=None,
+                 model=None, name=None):
+        day_dir = output_dir or os.path.join(os.path.dirname(os.path.realpath(__file__)), utils.OUTPUTS_DIR,
+                                             'realtime', utils.get_business_day(0))
+        # Traders of several accounts or models on one day each have their own directory
+        output_dir = os.path.join(day_dir, name) if name else day_dir
+        self.state_file = os.path.join(output_dir, 'state.pickle')
+        self.equity, self.cash = 0, 0
+        self.rescore_symbols = set()
+        self.rescore_event = threading.Event()
+        # Client order IDs of submitted orders without final trade updates
+        self.pending_orders = set()
+        # Placement attempts of each (side, type, symbol) order, which key client order IDs
+        self.order_attempts = {}
+        self.order_event = threading.Event()
+        self.trade_updates_connected = False
+        self.last_state_snapshot = None
+        # Artifact of series and inputs that state snapshots refer to
+        self.state_series_dir = None
+        # Monotonic submit times and sides of orders by client order ID
+        self.order_submit_times = {}
+        self.scoring_worker = None
+        # Prices and time of the latest what-if scenario grid, and its trading lists
+        self.scenario_prices = {}
+        self.scenario_time = None
+        self.scenario_trading_lists = []
+        # Durations are kept across days, since the close sequence runs once a day. Each trader keeps its own.
+        durations_file = os.path.join(os.path.dirname(day_dir),
+                                      'durations-%s.json' % (name,) if name else 'durations.json')
+        super(TradingRealTime, self).__init__(alpaca, polygon, fetcher, output_dir, durations_file,
+                                              warmup_dir=warmup_dir, hub_dir=hub_dir,
+                                              restore_state=os.path.isfile(self.state_file), model=model)
+
+    def get_startup_stages(self, load_history):
+        """Adds realtime stages to initialization.
+
+        The account is fetched while the model and series load. A state
+        snapshot, if any, is restored in place of series and inputs.
+        """
+        stages = super(TradingRealTime, self).get_startup_stages(load_history)
+        stages.append(utils.Stage('account', self.update_account, []))
+        if self.restore_state:
+            stages.append(utils.Stage('state', self.load_state, []))
+        else:
+            stages.append(utils.Stage('state_series', self.write_state_series, ['inputs']))
+        return stages
+
+    def write_state_series(self):
+        """Writes series and precomputed inputs that state snapshots refer to.
+
+        They do not change during the session, so they are written once at
+        startup as an artifact like the warm-up one, away from order deadlines.
+        The warm-up artifact in use is referred to instead if there is one.
+        """
+        if self.series_dir:
+            self.state_series_dir = self.series_dir
+            return
+        state_series_dir = os.path.join(self.output_dir, STATE_SERIES_DIR)
+        warmup.write_artifact(state_series_dir, self, (self.thresholds, self.volatilities, self.feature_components))
+        # The scoring worker maps the artifact as well
+        self.state_series_dir = self.series_dir = state_series_dir
+
+    def save_state(self):
+        """Snapshots the realtime state for a fast restart in the same session.
+
+        Each snapshot only holds the changing state, and refers to series and
+        inputs written at startup. It is written to a temporary file and
+        renamed, so a crash while writing never leaves a corrupted snapshot behind.
+        """
+        with self.lock:
+            state = {'series_dir': self.state_series_dir,
+                     'prices': dict(self.prices),
+                     'price_times': dict(self.price_times),
+                     'trading_list': list(self.trading_list),
+                     'last_updates': dict(self.last_updates),
+                     'pending_orders': set(self.pending_orders),
+                     'order_attempts': dict(self.order_attempts)}
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.state_file)
+        self.last_state_snapshot = time.monotonic()
+
+    def load_state(self):
+        """Restores the realtime state saved by save_state."""
+        with open(self.state_file, 'rb') as f:
+            state = pickle.load(f)
+        self.state_series_dir = self.series_dir = state['series_dir']
+        self.closes, self.volumes, meta = warmup.read_artifact(self.state_series_dir)
+        self.symbols = list(self.closes.keys())
+        self.thresholds = meta['thresholds']
+        self.volatilities = meta['volatilities']
+        self.feature_components = meta['feature_components']
+        self.history_dates = meta['history_dates']
+        self.history_length = len(self.history_dates)
+        self.prices = state['prices']
+        self.price_times = state['price_times']
+        self.trading_list = state['trading_list']
+        self.last_updates = state['last_updates']
+        self.pending_orders = state['pending_orders']
+        self.order_attempts = state['order_attempts']
+        logging.info('Realtime state of %d symbols restored with %d pending orders',
+                     len(self.closes), len(self.pending_orders))
+
+    def maybe_save_state(self):
+        if (self.last_state_snapshot is None or
+                time.monotonic() - self.last_state_snapshot >= STATE_SNAPSHOT_SECS):
+            self.save_state()
+
+    def start_scoring_worker(self):
+        """Moves scoring into a worker process, away from the GIL of the price refresh threads."""
+        if not self.series_dir:
+            self.series_dir = os.path.join(self.output_dir, 'series')
+            utils.write_series_matrix(self.series_dir, self.closes, self.volumes)
+        self.scoring_worker = scoring.ScoringWorker(self.series_dir, self.model_path)
+        self.scoring_worker.start()
+
+    def score(self):
+        """Gets the trading list of current prices.
+
+        Falls back to scoring in-process if the scoring worker fails.
+        """
+        # The worker may be stopped by the close sequence while scoring
+        with self.lock:
+            scoring_worker = self.scoring_worker
+        if scoring_worker:
+            try:
+                return scoring_worker.score(self.prices)
+            except Exception as e:
+                logging.error('Scoring worker failed: %s. Fall back to scoring in-process.', e)
+                self.stop_scoring_worker()
+        return self.get_trading_list(prices=self.prices)
+
+    def stop_scoring_worker(self):
+        """Stops the scoring worker if it is running. Later scoring is in-process."""
+        with self.lock:
+            scoring_worker, self.scoring_worker = self.scoring_worker, None
+        if scoring_worker:
+            scoring_worker.stop()
+
+    def on_trade(self, symbol, price, timestamp):
+        """Updates a streamed price and marks the symbol for re-scoring."""
+        if symbol not in self.closes:
+            return
+        super(TradingRealTime, self).on_trade(symbol, price, timestamp)
+        with self.lock:
+            self.rescore_symbols.add(symbol)
+        self.rescore_event.set()
+
+    def get_sell_limit_deadline(self):
+        """Gets deadline of sell limit orders.
+
+        Remaining positions must be sold with market orders and cash must settle
+        before the buy limit deadline.
+        """
+        return min(self.next_market_close - SELL_LIMIT_DEADLINE_SECS,
+                   self.get_buy_limit_deadline() - self.scheduler.estimate('sell_market') -
+                   self.scheduler.estimate('settle') - DEADLINE_MARGIN_SECS)
+
+    def get_buy_limit_deadline(self):
+        """Gets deadline of buy limit orders, leaving time for market orders before close."""
+        return min(self.next_market_close - BUY_LIMIT_DEADLINE_SECS,
+                   self.next_market_close - self.scheduler.estimate('buy_market') - DEADLINE_MARGIN_SECS)
+
+    def plan_close_sequence(self):
+        """Plans the timeline of the close sequence with measured durations."""
+        sell_limit_deadline = self.get_sell_limit_deadline()
+        buy_limit_deadline = self.get_buy_limit_deadline()
+        self.scheduler.plan('Trade Start', self.get_trade_start_time())
+        self.scheduler.plan('Sell Limit Done', sell_limit_deadline)
+        self.scheduler.plan('Sell Market Done', sell_limit_deadline + self.scheduler.estimate('sell_market'))
+        self.scheduler.plan('Cash Settled', sell_limit_deadline + self.scheduler.estimate('sell_market') +
+                            self.scheduler.estimate('settle'))
+        self.scheduler.plan('Buy Limit Done', buy_limit_deadline)
+        self.scheduler.plan('Buy Market Done', buy_limit_deadline + self.scheduler.estimate('buy_market'))
+        self.scheduler.plan('Market Close', self.next_market_close)
+
+    def start_trade_updates(self, create_stream_conn):
+        """Tracks order fills from the trade update stream in a background thread.
+
+        The stream connection binds to the event loop of the thread creating it,
+        so a factory is passed in and called in the thread.
+        """
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            conn = create_stream_conn()
+
+            @conn.on(r'^trade_updates$')
+            async def on_trade_updates(_, __, data):
+                self.on_trade_update(data.event, data.order)
+
+            # Orders are polled often until the broker confirms the subscription
+            @conn.on(r'^listening$')
+            async def on_listening(_, __, data):
+                self.trade_updates_connected = 'trade_updates' in getattr(data, 'streams', [])
+
+            try:
+                conn.run(['trade_updates'])
+            finally:
+                self.trade_updates_connected = False
+
+        t = threading.Thread(target=run, name='TradeUpdates')
+        t.daemon = True
+        t.start()
+
+    def on_trade_update(self, event, order):
+        if event not in FINAL_ORDER_EVENTS:
+            return
+        client_order_id = order.get('client_order_id')
+        submitted = self.order_submit_times.pop(client_order_id, None)
+        if event == 'fill' and submitted is not None:
+            submit_time, side = submitted
+            self.metrics.observe('order_fill_seconds', time.monotonic() - submit_time,
+                                 'Time from order submission to fill.', side=side)
+        with self.lock:
+            self.pending_orders.discard(client_order_id)
+            if not self.pending_orders:
+                self.order_event.set()
+
+    def place_orders(self, orders):
+        """Submits orders concurrently and tracks them until final trade updates.
+
+        Returns orders that were submitted successfully.
+        """
+        with self.lock:
+            self.order_event.clear()
+            client_order_ids = []
+            for order in orders:
+                key = (order.side, order.type, order.symbol)
+                self.order_attempts[key] = self.order_attempts.get(key, 0) + 1
+                client_order_ids.append(get_client_order_id(order, self.order_attempts[key]))
+            self.pending_orders.update(client_order_ids)
+        submit_time = time.monotonic()
+        # Recorded before submitting, since trade updates of fast fills may arrive first
+        for order, client_order_id in zip(orders, client_order_ids):
+            self.order_submit_times[client_order_id] = (submit_time, order.side)
+        results = submit_orders(self.alpaca, orders, client_order_ids)
+        self.metrics.observe('order_submit_seconds', time.monotonic() - submit_time,
+                             'Time to submit a batch of orders concurrently.')
+        placed = []
+        for order, client_order_id in zip(orders, client_order_ids):
+            result = results[client_order_id]
+            if isinstance(result, Exception):
+                logging.error('Failed to %s %s: %s', order.side, order.symbol, result)
+                with self.lock:
+                    self.pending_orders.discard(client_order_id)
+                self.order_submit_times.pop(client_order_id, None)
+            else:
+                placed.append(order)
+        # Open orders must survive a restart in the middle of the close sequence
+        self.save_state()
+        return placed
+
+    def trade_clock_watcher(self):
+        """Makes transactions near market close."""
+        self.plan_close_sequence()
+        while True:
+            # Sleep until the trade start, but wake up at least every minute in
+            # case the clock jumps
+            remaining = self.get_trade_start_time() - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 60))
+        self.active = False
+        # Wait for all printing done
+        time.sleep(1)
+        self.trade()
+
+    def get_tier_coverage(self):
+        """Gets the fraction of symbols to buy that are covered by each refresh tier."""
+        buy_symbols = [symbol for symbol, proportion, _, _ in self.trading_list if proportion > 0]
+        with self.lock:
+            ranks = {symbol: i for i, symbol in enumerate(self.ordered_symbols)}
+        coverage = []
+        for length, _ in self.update_frequencies[:-1]:
+            hits = sum(1 for symbol in buy_symbols if ranks.get(symbol, length) < length)
+            coverage.append((length, hits / len(buy_symbols) if buy_symbols else np.nan))
+        return coverage
+
+    def refresh_stale_buy_prices(self, max_rounds=3):
+        """Re-fetches stale prices of symbols to buy and re-scores.
+
+        Re-scoring may bring in other symbols with stale prices, so this repeats
+        until all symbols to buy have fresh prices, or for at most max_rounds.
+        Subscribers of a price hub take the latest published prices first.
+        """
+        for _ in range(max_rounds):
+            if self.price_board:
+                self.sync_price_board()
+            now = time.time()
+            symbols = ['^VIX'] + [symbol for symbol, proportion, _, _ in self.trading_list if proportion > 0]
+            stale_symbols = [symbol for symbol in symbols
+                             if now - self.price_times.get(symbol, 0) > BUY_PRICE_MAX_AGE_SECS]
+            if not stale_symbols:
+                return
+            logging.info('Re-fetch %d stale prices before buying: %s',
+                         len(stale_symbols), ', '.join(stale_symbols))
+            with futures.ThreadPoolExecutor(max_workers=3) as pool:
+                list(pool.map(self.get_realtime_price, stale_symbols))
+            self.trading_list = self.lookup_trading_list() or self.score()
+
+    def scenarios_due(self):
+        """Checks if the what-if scenario grid is due, once per cycle of the top refresh tier.
+
+        Without refreshes of the top tier, e.g. with the price hub, the grid is
+        due once per interval of the top tier.
+        """
+        grid_age = self.scheduler.seconds_since('scenarios')
+        if grid_age is None:
+            return True
+        top_length, top_sleep_secs = self.update_frequencies[0]
+        top_lag = self.scheduler.seconds_since('refresh_%d' % (top_length,))
+        if top_lag is None:
+            return grid_age >= top_sleep_secs
+        return top_lag < grid_age
+
+    def update_scenarios(self):
+        """Scores trading lists of market-wide what-if moves from current prices.
+
+        The grid is scored in the scoring worker if it runs.
+        """
+        start = time.monotonic()
+        prices = dict(self.prices)
+        scenarios = [utils.Scenario('Market %+.1f%%' % (move * 100,), move, {})
+                     for move in SCENARIO_MARKET_MOVES]
+        with self.lock:
+            scoring_worker = self.scoring_worker
+        scenario_trading_lists = None
+        if scoring_worker:
+            try:
+                scenario_trading_lists = scoring_worker.score_scenarios(prices, scenarios)
+            except Exception as e:
+                logging.error('Scoring worker failed: %s. Fall back to scoring in-process.', e)
+                self.stop_scoring_worker()
+        if scenario_trading_lists is None:
+            scenario_trading_lists = self.get_scenario_trading_lists(scenarios, prices)
+        self.scheduler.record('scenarios', time.monotonic() - start)
+        with self.lock:
+            self.scenario_prices = prices
+            self.scenario_time = time.time()
+            self.scenario_trading_lists = scenario_trading_lists
+        self.metrics.observe('scenario_seconds', time.monotonic() - start,
+                             'Time to score the what-if scenario grid.')
+
+    def lookup_trading_list(self):
+        """Looks up the trading list of the scenario matching prices updated since the grid.
+
+        Prices not updated since the grid are unknown rather than unmoved, so
+        only updated prices are checked. Returns None if no scenario is within
+        SCENARIO_TOLERANCE of the updated prices.
+        """
+        with self.lock:
+            if not self.scenario_trading_lists:
+                return None
+            base_prices, scenario_time = self.scenario_prices, self.scenario_time
+            scenario_trading_lists = self.scenario_trading_lists
+            moves = {symbol: self.prices[symbol] / base_price - 1
+                     for symbol, base_price in base_prices.items()
+                     if self.price_times.get(symbol, 0) > scenario_time and symbol in self.prices}
+        market_move = np.median([move for symbol, move in moves.items() if symbol != '^VIX'] or [0])
+        scenario, trading_list = min(scenario_trading_lists,
+                                     key=lambda item: abs(item[0].market_move - market_move))
+        for symbol, move in moves.items():
+            expected_move = 0 if symbol == '^VIX' else scenario.market_move
+            if abs(move - expected_move) > SCENARIO_TOLERANCE:
+                logging.info('Price of %s moved %+.2f%% from scenario %s. Re-score trading list.',
+                             symbol, (move - expected_move) * 100, scenario.name)
+                return None
+        logging.info('Use trading list of scenario %s for a market move of %+.2f%%.',
+                     scenario.name, market_move * 100)
+        return trading_list
+
+    @retrying.retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000)
+    def update_account(self):
+        account = self.alpaca.get_account()
+        self.equity = float(account.equity)
+        self.cash = float(account.cash)
+
     def update_trading_list(self):
         """Keeps updating trading list with ML models."""
         print_all = False
         while time.time() < self.next_market_close:
             # Update trading list
-            trading_list = self.get_trading_list(prices=self.prices)
+            start = time.monotonic()
+            with self.scheduler.measure('score'):
+                trading_list = self.score()
+            self.metrics.observe('score_seconds', time.monotonic() - start,
+                                 'Time to compute features and score the trading list.',
+                                 mode='worker' if self.scoring_worker else 'in_process')
             if not self.active:
                 return
 
             self.trading_list = trading_list
+            if time.time() > self.next_market_close - SCENARIO_START_SECS and self.scenarios_due():
+                self.update_scenarios()
             self.update_account()
+            self.maybe_save_state()
+            self.maybe_write_metrics()
 
             # Print
-            self.print_trading_list(print_all)
+            with profiling.phase('reporting'):
+                self.print_trading_list(print_all)
             if not self.active:
                 return
 
             # Wait for next update
             if time.time() > self.next_market_close - 60 * 2:
-                time.sleep(1)
+                self.wait_for_rescore(1)
             elif time.time() > self.next_market_close - 60 * 5:
                 print_all = True
-                time.sleep(10)
+                self.wait_for_rescore(10)
             elif time.time() > self.next_market_close - 60 * 20:
-                time.sleep(100)
+                self.wait_for_rescore(100)
             else:
-                time.sleep(300)
+                self.wait_for_rescore(300)
+
+    def wait_for_rescore(self, timeout):
+        """Waits until the next scoring round.
+
+        With a price stream, the round starts early once a streamed price can
+        change the trading list.
+        """
+        if not self.stream:
+            time.sleep(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            time.sleep(STREAM_RESCORE_SECS)
+            self.rescore_event.wait(max(deadline - time.monotonic(), 0))
+            self.rescore_event.clear()
+            with self.lock:
+                rescore_symbols, self.rescore_symbols = self.rescore_symbols, set()
+            if self.can_change_trading_list(rescore_symbols):
+                logging.debug('Re-scoring after %d streamed price updates', len(rescore_symbols))
+                return
+            if time.monotonic() >= deadline:
+                return
+
+    def can_change_trading_list(self, symbols):
+        """Checks if current prices of symbols can change the trading list.
+
+        A symbol matters if it is on the list or its weekly return is at or below
+        its buy threshold. Symbols without a known threshold are assumed to matter.
+        """
+        listed_symbols = set(symbol for symbol, _, _, _ in self.trading_list)
+        for symbol in symbols:
+            if symbol in listed_symbols or symbol not in self.thresholds:
+                return True
+            weekly_return = np.log(self.prices[symbol] / self.closes[symbol][-utils.DAYS_IN_A_WEEK])
+            if weekly_return <= self.thresholds[symbol]:
+                return True
+        return False
 
     def trade(self):
         """Performs sell and buy transactions."""
+        logging.info('Buy symbols covered by refresh tiers: %s',
+                     ', '.join('TOP %d: %.0f%%' % (length, fraction * 100)
+                               for length, fraction in self.get_tier_coverage()))
+        quote_secs = self.scheduler.estimate('quote')
+        logging.info('Scoring took %.3f seconds %s. Prices refreshed at %.1f quotes per second.',
+                     self.scheduler.estimate('score'),
+                     'in the worker process' if self.scoring_worker else 'in-process',
+                     1 / quote_secs if quote_secs else 0)
+        self.stop_scoring_worker()
+        self.mark_step('Trade Start')
         # Sell all current positions with limit orders
-        self.sell('limit', deadline=self.next_market_close - 60)
+        self.sell('limit', deadline=self.get_sell_limit_deadline())
+        self.mark_step('Sell Limit Done')
         # Sell remaining positions with market orders
-        self.sell('market')
+        with self.scheduler.measure('sell_market'):
+            self.sell('market')
+        self.mark_step('Sell Market Done')
 
-        for _ in range(10):
-            self.update_account()
-            if self.equity == self.cash:
-                break
-            time.sleep(1)
+        with self.scheduler.measure('settle'):
+            for _ in range(10):
+                self.update_account()
+                if self.equity == self.cash:
+                    break
+                time.sleep(1)
+            else:
+                logging.warning(
+                    'Timeout while waiting for cash to settle. Equity: %s; Cash: %s.', self.equity, self.cash)
+        self.mark_step('Cash Settled')
+
+        # Re-fetching is skipped if it would eat into the time for buy limit orders to fill
+        if self.scheduler.fits('refresh_buy', time.time(), self.get_buy_limit_deadline()):
+            with self.scheduler.measure('refresh_buy'):
+                self.refresh_stale_buy_prices()
         else:
-            logging.warning(
-                'Timeout while waiting for cash to settle. Equity: %s; Cash: %s.', self.equity, self.cash)
+            logging.warning('Skip re-fetching stale buy prices, which takes %.1f seconds.',
+                            self.scheduler.estimate('refresh_buy'))
 
         # Buy with limit orders
-        self.buy('limit', deadline=self.next_market_close - 30)
+        self.buy('limit', deadline=self.get_buy_limit_deadline())
+        self.mark_step('Buy Limit Done')
         # Buy with market orders
-        self.buy('market')
+        with self.scheduler.measure('buy_market'):
+            self.buy('market')
+        self.mark_step('Buy Market Done')
+        self.scheduler.log_timeline()
+        self.scheduler.save()
+        logging.info(utils.get_header('Rate Limiters') + '\n' + utils.get_rate_limiter_table())
+        self.write_metrics()
+        self.stop_price_feeds()
+
+    def mark_step(self, step):
+        """Marks a step of the close sequence and records the time left before market close."""
+        self.scheduler.mark(step)
+        self.metrics.set('close_step_seconds_left', self.next_market_close - time.time(),
+                         'Seconds left before market close at steps of the close sequence.', step=step)
 
     @retrying.retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000)
     def sell(self, order_type, deadline=None):
         """Sells all current positions."""
-        positions = self.alpaca.list_positions()
+        if order_type not in ('limit', 'market'):
+            raise NotImplementedError('Order type %s not recognized' % (order_type,))
+        positions = {position.symbol: position for position in self.alpaca.list_positions()}
+        orders = [OrderRequest(position.symbol, int(position.qty), 'sell', order_type,
+                               float(position.current_price))
+                  for position in positions.values()]
         positions_table = []
-        for position in positions:
-            try:
-                if order_type == 'limit':
-                    self.alpaca.submit_order(position.symbol, int(position.qty), 'sell', 'limit', 'day',
-                                             limit_price=float(position.current_price))
-                elif order_type == 'market':
-                    self.alpaca.submit_order(position.symbol, int(position.qty), 'sell', 'market', 'day')
-                else:
-                    raise NotImplementedError('Order type %s not recognized' % (order_type,))
-                positions_table.append([position.symbol, position.current_price, position.qty,
-                                        float(position.market_value) - float(position.cost_basis)])
-            except tradeapi.rest.APIError as e:
-                logging.error('Failed to sell %s: %s', position.symbol, e)
+        for order in self.place_orders(orders):
+            position = positions[order.symbol]
+            positions_table.append([position.symbol, position.current_price, position.qty,
+                                    float(position.market_value) - float(position.cost_basis)])
         outputs = [utils.get_header('Place ' + order_type.capitalize() + ' Sell Order')]
         if positions_table:
             outputs.append(tabulate(positions_table,
@@ -269,7 +1066,10 @@ class TradingRealTime(utils.TradingBase):
     @retrying.retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000)
     def buy(self, order_type, deadline=None):
         """Buys stocks in the trading list."""
+        if order_type not in ('limit', 'market'):
+            raise NotImplementedError('Order type %s not recognized' % (order_type,))
         orders_table = []
+        orders = []
         positions = self.alpaca.list_positions()
         existing_positions = {position.symbol: int(position.qty) for position in positions}
         for symbol, proportion, _, _ in self.trading_list:
@@ -281,16 +1081,8 @@ class TradingRealTime(utils.TradingBase):
                 qty -= existing_positions[symbol]
             if qty > 0:
                 orders_table.append([symbol, self.prices[symbol], qty, self.prices[symbol] * qty])
-                try:
-                    if order_type == 'limit':
-                        self.alpaca.submit_order(symbol, qty, 'buy', 'limit', 'day',
-                                                 limit_price=self.prices[symbol])
-                    elif order_type == 'market':
-                        self.alpaca.submit_order(symbol, qty, 'buy', 'market', 'day')
-                    else:
-                        raise NotImplementedError('Order type %s not recognized' % (order_type,))
-                except tradeapi.rest.APIError as e:
-                    logging.error('Failed to buy %s: %s', symbol, e)
+                orders.append(OrderRequest(symbol, qty, 'buy', order_type, self.prices[symbol]))
+        self.place_orders(orders)
         outputs = [utils.get_header('Place ' + order_type.capitalize() + ' Buy Order')]
         if orders_table:
             outputs.append(tabulate(orders_table,
@@ -301,12 +1093,24 @@ class TradingRealTime(utils.TradingBase):
 
     @retrying.retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000)
     def wait_for_order_to_fill(self, timeout=20, deadline=None):
+        """Waits for open orders to fill and cancels the rest.
+
+        With trade updates, wakes up as soon as all tracked orders are final and
+        polls open orders less often as a fallback.
+        """
+        poll_secs = ORDER_POLL_SECS_WITH_UPDATES if self.trade_updates_connected else ORDER_POLL_SECS
         orders = self.alpaca.list_orders(status='open')
         wait_time = 0
         while orders:
             logging.info('Wait for orders to fill. %d open orders remaining...', len(orders))
-            time.sleep(2)
-            wait_time += 2
+            if self.trade_updates_connected:
+                start = time.monotonic()
+                self.order_event.wait(poll_secs)
+                self.order_event.clear()
+                wait_time += time.monotonic() - start
+            else:
+                time.sleep(poll_secs)
+                wait_time += poll_secs
             if wait_time >= timeout:
                 break
             if deadline and time.time() >= deadline:
@@ -314,6 +1118,12 @@ class TradingRealTime(utils.TradingBase):
             orders = self.alpaca.list_orders(status='open')
         if not orders:
             logging.info('All orders filled')
+            if not self.trade_updates_connected:
+                # Without trade updates, fills are only seen by polls
+                now = time.monotonic()
+                for submit_time, side in self.order_submit_times.values():
+                    self.metrics.observe('order_fill_seconds', now - submit_time,
+                                         'Time from order submission to fill.', side=side)
         else:
             logging.info('Cancel %d remaining orders', len(orders))
             self.alpaca.cancel_all_orders()
@@ -324,10 +1134,14 @@ class TradingRealTime(utils.TradingBase):
                 logging.info('Wait for orders to cancel. %d open orders remaining...', len(orders))
                 time.sleep(1)
                 orders = self.alpaca.list_orders(status='open')
+        with self.lock:
+            self.pending_orders.clear()
+        self.order_submit_times.clear()
 
     def print_trading_list(self, print_all=False):
         trading_table = []
         cost = 0
+        now = time.time()
         for symbol, proportion, weight, _ in self.trading_list[:100]:
             if proportion == 0 and not print_all:
                 continue
@@ -340,10 +1154,11 @@ class TradingRealTime(utils.TradingBase):
             cost += share_cost
             trading_row.extend(['%+.2f%%' % (change * 100,),
                                 '%+.2f%%' % (self.thresholds[symbol] * 100,), price,
+                                '%.0fs' % (now - self.price_times.get(symbol, now),),
                                 share_cost, qty])
             trading_table.append(trading_row)
         headers = ['Symbol', 'Proportion', 'Weight', 'Today Change',
-                   'Threshold', 'Price', 'Cost', 'Quantity']
+                   'Threshold', 'Price', 'Price Age', 'Cost', 'Quantity']
         outputs = []
         if trading_table:
             outputs.append(tabulate(trading_table, headers=headers, tablefmt='grid'))
@@ -355,7 +1170,13 @@ class TradingRealTime(utils.TradingBase):
               'Price Updates',
               ', '.join(['TOP ' + str(update_length) + ': ' + update_time.strftime('%T')
                          for update_length, update_time in
-                         sorted(self.last_updates.items(), key=lambda t: t[0])])]], tablefmt='grid'))
+                         sorted(self.last_updates.items(), key=lambda t: t[0])]),
+              'Tier Coverage',
+              ', '.join(['TOP %d: %.0f%%' % (length, fraction * 100)
+                         for length, fraction in self.get_tier_coverage()]),
+              'Price Age P50 / P90',
+              ', '.join(['TOP %d: %.0fs / %.0fs' % (length, p50, p90)
+                         for length, p50, p90 in self.get_tier_staleness(now)])]], tablefmt='grid'))
         logging.info('\n'.join(outputs))
 
 
@@ -367,7 +1188,24 @@ def main():
                         action="store_true")
     parser.add_argument('-f', '--force', help='Force to run even at market close.',
                         action="store_true")
+    parser.add_argument('--sync_fetch', help='Fetch prices one symbol at a time instead of with the async '
+                        'connection pool, which retries its failed symbols that way.', action="store_true")
+    parser.add_argument('--stream', help='Receive pushed prices from the trade stream.',
+                        action="store_true")
+    parser.add_argument('--scoring_worker', help='Score trading lists in a worker process.',
+                        action="store_true")
+    parser.add_argument('--hub', help='Subscribe to prices of the price hub instead of fetching them.',
+                        action="store_true")
+    parser.add_argument('--name', default=None,
+                        help='Name of this trader, to run several accounts or models on one day.')
+    parser.add_argument('--model', default=None, help='Model file name.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile phases and sample stacks into the output directory.')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='Also trace memory high-water marks of phases with --profile. Slows down allocations.')
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(args.profile_memory)
 
     if args.api_key and args.api_secret or args.real_trade:
         print('-' * 80)
@@ -386,10 +1224,20 @@ def main():
     sys.stdout.flush()
     alpaca = tradeapi.REST(api_key, api_secret, base_url, 'v2')
     polygon = polygonapi.REST(api_key)
+    fetcher = (None if args.sync_fetch else
+               price_fetcher.AsyncPriceFetcher(api_key, rate_limiter=utils.RATE_LIMITERS['polygon']))
 
     if alpaca.get_clock().is_open or args.force:
-        trading = TradingRealTime(alpaca, polygon)
+        hub_dir = price_board.get_hub_dir(os.path.dirname(os.path.realpath(__file__))) if args.hub else None
+        trading = TradingRealTime(alpaca, polygon, fetcher, hub_dir=hub_dir, model=args.model, name=args.name)
+        if args.stream:
+            trading.start_stream(price_stream.PriceStream(api_key))
+            trading.start_trade_updates(lambda: tradeapi.StreamConn(api_key, api_secret, base_url))
+        if args.scoring_worker:
+            trading.start_scoring_worker()
         trading.run()
+        if args.profile:
+            profiling.write(trading.output_dir)
     else:
         print('Market is closed. Use "-f" flag to force run.')
 
@@ -1,19 +1,25 @@
 import alpaca_trade_api as tradeapi
 import alpaca_trade_api.polygon as polygonapi
 import argparse
+import asyncio
 import collections
 import datetime
+import fake_broker
 import itertools
 import numpy as np
 import pandas as pd
 import realtime
 import requests
 import os
+import pickle
+import price_fetcher
 import tensorflow.keras as keras
+import threading
 import time
 import unittest
 import unittest.mock as mock
 import utils
+import warmup
 import yfinance as yf
 from parameterized import parameterized
 
@@ -39,8 +45,16 @@ class TradingRealTimeTest(unittest.TestCase):
         self.patch_keras.start()
         self.patch_mkdirs = mock.patch.object(os, 'makedirs')
         self.patch_mkdirs.start()
+        self.patch_replace = mock.patch.object(os, 'replace')
+        self.patch_replace.start()
+        # Rate limits are covered by utils_test. Do not let calls in other tests drain the buckets.
+        self.patch_rate_limiters = mock.patch.dict(utils.RATE_LIMITERS, {
+            name: utils.RateLimiter(name, 1E6) for name in utils.RATE_LIMITERS.keys()})
+        self.patch_rate_limiters.start()
         self.patch_to_csv = mock.patch.object(pd.DataFrame, 'to_csv')
         self.patch_to_csv.start()
+        self.patch_write_artifact = mock.patch.object(warmup, 'write_artifact')
+        self.mock_write_artifact = self.patch_write_artifact.start()
         self.patch_sleep = mock.patch.object(time, 'sleep')
         self.mock_sleep = self.patch_sleep.start()
         self.patch_web_scraping = mock.patch.object(utils, 'web_scraping', return_value='50')
@@ -71,10 +85,30 @@ class TradingRealTimeTest(unittest.TestCase):
         self.patch_isfile.stop()
         self.patch_keras.stop()
         self.patch_mkdirs.stop()
+        self.patch_replace.stop()
+        self.patch_rate_limiters.stop()
         self.patch_history.stop()
         self.patch_sleep.stop()
         self.patch_web_scraping.stop()
         self.patch_to_csv.stop()
+        self.patch_write_artifact.stop()
+
+    def test_init_named_trader(self):
+        trading = realtime.TradingRealTime(self.alpaca, self.polygon, output_dir='day', name='paper')
+        self.assertEqual(trading.output_dir, os.path.join('day', 'paper'))
+        # Durations are not shared by traders of the day
+        self.assertEqual(trading.scheduler.durations_file, 'durations-paper.json')
+        self.assertEqual(self.trading.scheduler.durations_file,
+                         os.path.join(os.path.dirname(self.trading.output_dir), 'durations.json'))
+
+    def test_init_price_tracker_without_model(self):
+        with mock.patch.object(keras.models, 'load_model') as load_model:
+            tracker = realtime.PriceTracker(self.alpaca, self.polygon, None, 'hub', 'durations.json',
+                                            use_model=False)
+        load_model.assert_not_called()
+        self.assertIsNone(tracker.model)
+        self.assertNotIn('model', tracker.startup_times)
+        self.assertIn('inputs', tracker.startup_times)
 
     def test_trade_clock_watcher(self):
         with mock.patch.object(realtime.TradingRealTime, 'trade') as trade, \
@@ -94,6 +128,154 @@ class TradingRealTimeTest(unittest.TestCase):
             self.trading.update_trading_list()
         self.assertEqual(len(self.trading.trading_list), 4)
 
+    def test_update_ordered_symbols(self):
+        self.trading.thresholds.update({'SYMA': -0.2, 'SYMB': -0.2, 'SYMC': -0.2})
+        self.trading.volatilities.update({'SYMA': 0.1, 'SYMB': 0.1, 'SYMC': 0.001})
+        self.trading.prices.update({'SYMA': 80, 'SYMB': 70, 'SYMC': 80})
+        self.trading.trading_list = [('SYMA', 0.25, 10, 'long')]
+        self.trading.update_ordered_symbols()
+        ordered_symbols = self.trading.ordered_symbols
+        # On the trading list
+        self.assertEqual(ordered_symbols[0], 'SYMA')
+        # Further below threshold in volatility units
+        self.assertLess(ordered_symbols.index('SYMC'), ordered_symbols.index('SYMB'))
+        self.assertEqual(ordered_symbols[-1], '^VIX')
+
+    def test_get_tier_coverage(self):
+        self.trading.update_frequencies = [(1, 1), (2, 1), (4, 1)]
+        self.trading.ordered_symbols = ['SYMA', 'SYMB', 'SYMC']
+        self.trading.trading_list = [('SYMB', 0.5, 1, 'long'), ('SYMC', 0.5, 1, 'long'),
+                                     ('SYMA', 0, 1, 'long')]
+        self.assertEqual(self.trading.get_tier_coverage(), [(1, 0), (2, 0.5)])
+
+    def test_get_tier_staleness(self):
+        self.trading.update_frequencies = [(2, 5), (4, 15)]
+        self.trading.ordered_symbols = ['SYMA', 'SYMB', 'SYMC', '^VIX']
+        self.trading.price_times = {'SYMA': 990, 'SYMB': 980, 'SYMC': 900, '^VIX': 800}
+        staleness = self.trading.get_tier_staleness(now=1000)
+        self.assertEqual([length for length, _, _ in staleness], [2, 4])
+        self.assertEqual(staleness[0][1], 15)
+        self.assertEqual(staleness[1][1], 60)
+
+    def test_refresh_stale_buy_prices(self):
+        self.trading.trading_list = [('SYMA', 0.5, 50, 'long'), ('SYMB', 0.5, 50, 'long'),
+                                     ('SYMC', 0, 50, 'long')]
+        now = time.time()
+        self.trading.price_times.update({'SYMA': now, 'SYMB': now - 600, 'SYMC': now - 600, '^VIX': now})
+        self.polygon.last_trade.reset_mock()
+        with mock.patch.object(realtime.TradingRealTime, 'score', return_value=[('SYMA', 1, 50, 'long')]):
+            self.trading.refresh_stale_buy_prices()
+        # Only the stale symbol to buy is re-fetched
+        self.polygon.last_trade.assert_called_once_with('SYMB')
+        self.assertEqual(self.trading.trading_list, [('SYMA', 1, 50, 'long')])
+
+    def test_get_scenario_trading_lists(self):
+        scenarios = [utils.Scenario('Flat', 0, {}), utils.Scenario('Down', -0.01, {'SYMA': -0.5})]
+        self.fake_model.predict.reset_mock()
+        scenario_trading_lists = self.trading.get_scenario_trading_lists(scenarios, self.trading.prices)
+        # All scenarios are scored in one batch
+        self.fake_model.predict.assert_called_once()
+        self.assertEqual([scenario for scenario, _ in scenario_trading_lists], scenarios)
+        self.assertEqual(scenario_trading_lists[0][1], self.trading.get_trading_list(prices=self.trading.prices))
+
+    def test_lookup_trading_list(self):
+        self.assertIsNone(self.trading.lookup_trading_list())
+        self.trading.scenario_prices = {'SYMA': 100, 'SYMB': 100, '^VIX': 20}
+        self.trading.scenario_time = 1000
+        self.trading.scenario_trading_lists = [
+            (utils.Scenario('Flat', 0, {}), [('SYMA', 1, 50, 'long')]),
+            (utils.Scenario('Down', -0.01, {}), [('SYMB', 1, 50, 'long')])]
+        self.trading.prices.update({'SYMA': 99, 'SYMB': 99.1, '^VIX': 20})
+        self.trading.price_times.update({'SYMA': 1001, 'SYMB': 1001, '^VIX': 1001})
+        self.assertEqual(self.trading.lookup_trading_list(), [('SYMB', 1, 50, 'long')])
+        # Too far from any scenario
+        self.trading.prices['SYMB'] = 97
+        self.assertIsNone(self.trading.lookup_trading_list())
+
+    def test_lookup_trading_list_partial_refresh(self):
+        symbols = ['SYM%d' % (i,) for i in range(10)]
+        self.trading.scenario_prices = dict({symbol: 100 for symbol in symbols}, **{'^VIX': 20})
+        self.trading.scenario_time = 1000
+        self.trading.scenario_trading_lists = [
+            (utils.Scenario('Flat', 0, {}), [('SYM0', 1, 50, 'long')]),
+            (utils.Scenario('Down', -0.01, {}), [('SYM1', 1, 50, 'long')])]
+        self.trading.prices.update(self.trading.scenario_prices)
+        self.trading.price_times.update({symbol: 900 for symbol in self.trading.scenario_prices})
+        # Only the top symbols are refreshed during a market-wide drop
+        for symbol in symbols[:3]:
+            self.trading.prices[symbol] = 99
+            self.trading.price_times[symbol] = 1001
+        self.assertEqual(self.trading.lookup_trading_list(), [('SYM1', 1, 50, 'long')])
+
+    def test_get_ml_feature_matrix(self):
+        prices = np.array([80, 88, 95])
+        matrix = self.trading.get_ml_feature_matrix('SYMA', prices, 50)
+        expected = [[self.trading.get_ml_feature('SYMA', prices={'SYMA': price, '^VIX': 50})[key]
+                     for key in utils.ML_FEATURES] for price in prices]
+        np.testing.assert_allclose(matrix, expected)
+
+    def test_scenarios_due(self):
+        top_length = self.trading.update_frequencies[0][0]
+        self.assertTrue(self.trading.scenarios_due())
+        self.trading.scheduler.record('refresh_%d' % (top_length,), 1)
+        self.trading.scheduler.record('scenarios', 1)
+        self.assertFalse(self.trading.scenarios_due())
+        # Due again after the top tier refreshes
+        self.trading.scheduler.last_finishes['refresh_%d' % (top_length,)] += 1
+        self.assertTrue(self.trading.scenarios_due())
+
+    def test_update_scenarios_in_scoring_worker(self):
+        scoring_worker = mock.Mock()
+        scoring_worker.score_scenarios.return_value = [(utils.Scenario('Flat', 0, {}), [('SYMA', 1, 50, 'long')])]
+        self.trading.scoring_worker = scoring_worker
+        with mock.patch.object(utils.TradingBase, 'get_scenario_trading_lists') as get_scenario_trading_lists:
+            self.trading.update_scenarios()
+        get_scenario_trading_lists.assert_not_called()
+        self.assertEqual(self.trading.scenario_trading_lists, scoring_worker.score_scenarios.return_value)
+
+    def test_fit_refresh_scope(self):
+        self.trading.update_frequencies = [(1, 10), (2, 100), (4, 1000)]
+        symbols = ['SYMA', 'SYMB', 'SYMC']
+        # Top tier is never cut
+        self.assertEqual(self.trading.fit_refresh_scope(1, symbols[:1]), symbols[:1])
+        # No estimate yet
+        self.assertEqual(self.trading.fit_refresh_scope(4, symbols), symbols)
+        self.trading.scheduler.record('quote', 2)
+        with mock.patch.object(time, 'time', return_value=self.trading.get_trade_start_time() - 5):
+            self.assertEqual(self.trading.fit_refresh_scope(4, symbols), symbols[:2])
+
+    def test_score_worker_fallback(self):
+        worker = mock.Mock()
+        worker.score.side_effect = RuntimeError('Test error')
+        self.trading.scoring_worker = worker
+        trading_list = self.trading.score()
+        self.assertEqual(trading_list, self.trading.get_trading_list(prices=self.trading.prices))
+        worker.stop.assert_called_once_with()
+        self.assertIsNone(self.trading.scoring_worker)
+
+    def test_score_worker_stopped_while_scoring(self):
+        worker = mock.Mock()
+
+        def stop_then_fail(_):
+            # The close sequence stops the worker in the middle of a request
+            self.trading.stop_scoring_worker()
+            raise RuntimeError('Test error')
+
+        worker.score.side_effect = stop_then_fail
+        self.trading.scoring_worker = worker
+        self.assertEqual(self.trading.score(), self.trading.get_trading_list(prices=self.trading.prices))
+        worker.stop.assert_called_once_with()
+        self.assertIsNone(self.trading.scoring_worker)
+
+    def test_sync_price_board(self):
+        board = mock.Mock()
+        board.read.return_value = [(2000, 'SYMA', 77)]
+        self.trading.price_board = board
+        self.trading.sync_price_board()
+        board.read.assert_called_once_with(since=self.trading.price_times)
+        self.assertEqual(self.trading.prices['SYMA'], 77)
+        self.assertEqual(self.trading.price_times['SYMA'], 2000)
+
     def test_update_trading_list_prices(self):
         with mock.patch.object(time, 'time', side_effect=itertools.count(999)), \
                 mock.patch.object(utils, 'web_scraping', return_value='35'):
@@ -108,6 +290,198 @@ class TradingRealTimeTest(unittest.TestCase):
         self.assertEqual(self.trading.prices['SYMB'], 666)
         self.assertEqual(self.trading.prices['SYMC'], 666)
 
+    def test_update_prices_async(self):
+        fetcher = mock.Mock(request_count=0)
+        fetcher.get_prices.return_value = ({'SYMA': 77}, {'SYMB': Exception('Test error')})
+        self.trading.fetcher = fetcher
+        self.trading.update_prices(['^VIX', 'SYMA', 'SYMB'])
+        fetcher.get_prices.assert_called_once_with(['SYMA', 'SYMB'])
+        self.assertEqual(self.trading.prices['SYMA'], 77)
+        # Failed symbol is retried with polygon
+        self.assertEqual(self.trading.prices['SYMB'], 88)
+        self.assertEqual(self.trading.prices['^VIX'], 50)
+
+    def test_on_trade(self):
+        self.trading.on_trade('SYMA', 66, 999)
+        self.trading.on_trade('SYMX', 66, 999)
+        self.assertEqual(self.trading.prices['SYMA'], 66)
+        self.assertNotIn('SYMX', self.trading.prices)
+        self.assertEqual(self.trading.rescore_symbols, {'SYMA'})
+        self.assertTrue(self.trading.rescore_event.is_set())
+
+    def test_can_change_trading_list(self):
+        self.trading.trading_list = [('SYMA', 1.0, 0.9, 'long')]
+        self.trading.thresholds['SYMB'] = -1
+        self.trading.prices['SYMB'] = self.trading.closes['SYMB'][-utils.DAYS_IN_A_WEEK]
+        self.assertTrue(self.trading.can_change_trading_list({'SYMA'}))
+        self.assertFalse(self.trading.can_change_trading_list({'SYMB'}))
+        self.trading.thresholds['SYMB'] = 0
+        self.assertTrue(self.trading.can_change_trading_list({'SYMB'}))
+
+    @parameterized.expand([('SYMA', False), ('SYMB', True)])
+    def test_wait_for_rescore(self, symbol, wait_until_timeout):
+        self.trading.stream = mock.Mock()
+        self.trading.trading_list = [('SYMA', 1.0, 0.9, 'long')]
+        self.trading.thresholds['SYMB'] = -1
+        self.trading.prices['SYMB'] = self.trading.closes['SYMB'][-utils.DAYS_IN_A_WEEK]
+        self.trading.rescore_symbols.add(symbol)
+        self.trading.rescore_event.set()
+        start = time.monotonic()
+        self.trading.wait_for_rescore(0.5)
+        self.assertEqual(time.monotonic() - start >= 0.5, wait_until_timeout)
+        self.assertEqual(self.trading.rescore_symbols, set())
+
+    def test_restore_state(self):
+        with mock.patch.object(time, 'time', side_effect=itertools.count(500, 50)):
+            self.trading.update_trading_list()
+        self.trading.pending_orders.add('fake_order_id')
+        self.trading.order_attempts[('buy', 'limit', 'SYMA')] = 1
+        # Series and inputs are written once at startup, and snapshots only hold the changing state
+        self.mock_write_artifact.assert_called_once()
+        self.mock_write_artifact.reset_mock()
+        with mock.patch.object(pickle, 'dump') as mock_dump:
+            self.trading.save_state()
+            self.trading.save_state()
+        self.mock_write_artifact.assert_not_called()
+        state = mock_dump.call_args[0][0]
+        self.assertNotIn('closes', state)
+        self.assertEqual(state['series_dir'], os.path.join(self.trading.output_dir, realtime.STATE_SERIES_DIR))
+        meta = {'model': utils.DEFAULT_MODEL,
+                'history_dates': self.trading.history_dates,
+                'thresholds': self.trading.thresholds,
+                'volatilities': self.trading.volatilities,
+                'feature_components': self.trading.feature_components}
+        with mock.patch.object(os.path, 'isfile', side_effect=lambda path: path.endswith('state.pickle')), \
+                mock.patch.object(pickle, 'load', return_value=state), \
+                mock.patch.object(warmup, 'read_artifact',
+                                  return_value=(self.trading.closes, self.trading.volumes, meta)), \
+                mock.patch.object(utils.TradingBase, 'load_history') as mock_load_history:
+            trading = realtime.TradingRealTime(self.alpaca, self.polygon)
+        mock_load_history.assert_not_called()
+        self.assertEqual(trading.trading_list, self.trading.trading_list)
+        self.assertEqual(trading.thresholds, self.trading.thresholds)
+        self.assertEqual(trading.pending_orders, {'fake_order_id'})
+        self.assertEqual(trading.order_attempts, {('buy', 'limit', 'SYMA'): 1})
+        self.assertEqual(trading.get_ml_feature('SYMA', prices=trading.prices),
+                         self.trading.get_ml_feature('SYMA', prices=self.trading.prices))
+
+    def test_save_state_with_warmup(self):
+        self.mock_write_artifact.reset_mock()
+        self.trading.series_dir = self.trading.warmup_dir
+        self.trading.write_state_series()
+        with mock.patch.object(pickle, 'dump') as mock_dump:
+            self.trading.save_state()
+        self.mock_write_artifact.assert_not_called()
+        self.assertEqual(mock_dump.call_args[0][0]['series_dir'], self.trading.warmup_dir)
+
+    def test_start_from_warmup(self):
+        meta = {'model': utils.DEFAULT_MODEL,
+                'history_dates': self.trading.history_dates,
+                'thresholds': self.trading.thresholds,
+                'volatilities': self.trading.volatilities,
+                'feature_components': self.trading.feature_components}
+        with mock.patch.object(warmup, 'has_artifact', return_value=True), \
+                mock.patch.object(warmup, 'read_artifact',
+                                  return_value=(self.trading.closes, self.trading.volumes, meta)), \
+                mock.patch.object(utils.TradingBase, 'load_history') as mock_load_history:
+            trading = realtime.TradingRealTime(self.alpaca, self.polygon)
+        mock_load_history.assert_not_called()
+        self.assertTrue(trading.history_dates.equals(self.trading.history_dates))
+        self.assertEqual(set(trading.closes.keys()), set(self.trading.closes.keys()))
+        self.assertEqual(trading.thresholds, self.trading.thresholds)
+
+    def test_update_stats_skip_streamed_symbols(self):
+        self.trading.stream = mock.Mock()
+        self.trading.on_trade('SYMA', 66, 990)
+        self.polygon.last_trade.return_value = LastTrade(666)
+        with mock.patch.object(time, 'time', side_effect=itertools.count(999)):
+            self.trading.update_stats(5, 1)
+        self.assertEqual(self.trading.prices['SYMA'], 66)
+        self.assertEqual(self.trading.prices['SYMB'], 666)
+
+    def test_submit_orders_idempotent(self):
+        broker = fake_broker.FakeBroker({'SYMA': 10.0}, latency=0, fill_delay=60)
+        orders = [realtime.OrderRequest('SYMA', 1, 'buy', 'limit', 10.0)]
+        realtime.submit_orders(broker, orders, ['fake_client_order_id'])
+        # Retried orders are rejected by the broker as duplicates
+        results = realtime.submit_orders(broker, orders, ['fake_client_order_id'])
+        self.assertEqual(len(broker.orders), 1)
+        self.assertEqual(results, {'fake_client_order_id': None})
+
+    def test_submit_orders_retry_network_error(self):
+        broker = mock.Mock()
+        broker.submit_order.side_effect = [requests.exceptions.ConnectionError('Test error'), 'fake_order']
+        orders = [realtime.OrderRequest('SYMA', 1, 'buy', 'market', None)]
+        results = realtime.submit_orders(broker, orders, ['fake_client_order_id'])
+        self.assertEqual(results, {'fake_client_order_id': 'fake_order'})
+        self.assertEqual([call[1]['client_order_id'] for call in broker.submit_order.call_args_list],
+                         ['fake_client_order_id'] * 2)
+
+    def test_submit_orders_error_code(self):
+        broker = mock.Mock()
+        # Only the error code tells a duplicate apart from other errors
+        broker.submit_order.side_effect = [
+            tradeapi.rest.APIError({'code': realtime.DUPLICATE_CLIENT_ORDER_ID_CODE, 'message': 'Duplicate'}),
+            tradeapi.rest.APIError({'code': 40310000, 'message': 'client_order_id is not unique enough'})]
+        orders = [realtime.OrderRequest('SYMA', 1, 'buy', 'market', None)]
+        self.assertEqual(realtime.submit_orders(broker, orders, ['id_1']), {'id_1': None})
+        self.assertIsInstance(realtime.submit_orders(broker, orders, ['id_2'])['id_2'], tradeapi.rest.APIError)
+
+    def test_place_orders_again(self):
+        broker = fake_broker.FakeBroker({'SYMA': 10.0}, latency=0, fill_delay=60)
+        self.trading.alpaca = broker
+        orders = [realtime.OrderRequest('SYMA', 1, 'buy', 'limit', 10.0)]
+        self.assertEqual(self.trading.place_orders(orders), orders)
+        broker.cancel_all_orders()
+        # An order placed again after cancellation is a new attempt
+        self.assertEqual(self.trading.place_orders(orders), orders)
+        self.assertEqual(len(set(order.client_order_id for order in broker.orders.values())), 2)
+        self.assertEqual(self.trading.order_attempts, {('buy', 'limit', 'SYMA'): 2})
+
+    def test_start_trade_updates(self):
+        connected = []
+        finished = threading.Event()
+        trading = self.trading
+
+        class FakeStreamConn(object):
+            handlers = {}
+
+            def on(self, pattern):
+                def decorator(func):
+                    self.handlers[pattern] = func
+                    return func
+                return decorator
+
+            def run(self, channels):
+                connected.append(trading.trade_updates_connected)
+                asyncio.get_event_loop().run_until_complete(
+                    self.handlers[r'^listening$'](None, 'listening', mock.Mock(streams=channels)))
+                connected.append(trading.trade_updates_connected)
+                finished.set()
+
+        self.trading.start_trade_updates(FakeStreamConn)
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(connected, [False, True])
+
+    def test_place_orders_with_trade_updates(self):
+        broker = fake_broker.FakeBroker({'SYMA': 10.0, 'SYMB': 20.0}, latency=0, fill_delay=0)
+        broker.subscribe(self.trading.on_trade_update)
+        self.trading.alpaca = broker
+        self.trading.trade_updates_connected = True
+        placed = self.trading.place_orders([realtime.OrderRequest('SYMA', 1, 'buy', 'market', None),
+                                            realtime.OrderRequest('SYMB', 1, 'buy', 'market', None)])
+        self.assertEqual(len(placed), 2)
+        self.assertTrue(self.trading.order_event.wait(5))
+        self.assertEqual(self.trading.pending_orders, set())
+        self.assertEqual(broker.positions, {'SYMA': 1, 'SYMB': 1})
+        self.assertEqual(len(self.trading.metrics.get_samples('order_fill_seconds', side='buy')), 2)
+
+    def test_wait_for_order_to_fill_without_trade_updates(self):
+        self.trading.order_submit_times['fake_client_order_id'] = (time.monotonic(), 'sell')
+        self.trading.wait_for_order_to_fill()
+        self.assertEqual(len(self.trading.metrics.get_samples('order_fill_seconds', side='sell')), 1)
+        self.assertEqual(self.trading.order_submit_times, {})
+
     @parameterized.expand([(20, None, 16), (1000, 999, 7)])
     def test_wait_for_order_to_fill(self, timeout, deadline, list_call_count):
         self.alpaca.list_orders.return_value = ['fake_order']
@@ -148,6 +522,35 @@ class TradingRealTimeTest(unittest.TestCase):
         # Sell 2 + 1, Buy 4 + 3
         self.assertEqual(self.alpaca.submit_order.call_count, 10)
 
+    @parameterized.expand([(0, True), (975, False)])
+    def test_trade_refresh_buy_prices_before_deadline(self, now, refresh):
+        self.trading.scheduler.record('refresh_buy', 10)
+        with mock.patch.object(time, 'time', return_value=now), \
+                mock.patch.object(realtime.TradingRealTime, 'sell'), \
+                mock.patch.object(realtime.TradingRealTime, 'buy'), \
+                mock.patch.object(realtime.TradingRealTime, 'refresh_stale_buy_prices') as refresh_stale_buy_prices:
+            self.trading.trade()
+        self.assertEqual(refresh_stale_buy_prices.called, refresh)
+
+    def test_trade_stops_price_feeds(self):
+        self.trading.stream = mock.Mock()
+        self.trading.fetcher = mock.Mock()
+        feeds = mock.Mock()
+        feeds.attach_mock(self.trading.stream.stop, 'stop_stream')
+        with mock.patch.object(time, 'time', return_value=0), \
+                mock.patch.object(realtime.TradingRealTime, 'sell'), \
+                mock.patch.object(realtime.TradingRealTime, 'buy'), \
+                mock.patch.object(self.trading.price_journal, 'append') as append, \
+                mock.patch.object(self.trading.price_journal, 'close') as close:
+            feeds.attach_mock(close, 'close_journal')
+            self.trading.trade()
+            append.reset_mock()
+            # Prices pushed or fetched after the session are not journaled
+            self.trading.on_trade('SYMA', 66, 1000)
+        self.assertEqual(feeds.mock_calls, [mock.call.stop_stream(), mock.call.close_journal()])
+        self.trading.fetcher.close.assert_called_once()
+        append.assert_not_called()
+
     def test_run_success(self):
         with mock.patch.object(time, 'time', side_effect=itertools.count(990)), \
                 mock.patch.object(realtime.TradingRealTime, 'update_stats') as mock_update_stats, \
@@ -172,8 +575,8 @@ class TradingRealTimeTest(unittest.TestCase):
         mock_update_trading_list.assert_called_once()
         trade_clock_watcher.assert_called_once()
 
-    @parameterized.expand([(True,), (False,)])
-    def test_main(self, real_trade):
+    @parameterized.expand([(True, False), (False, False), (False, True)])
+    def test_main(self, real_trade, sync_fetch):
         saved_environ = dict(os.environ)
         os.environ['ALPACA_API_KEY'] = 'fake_api_key'
         os.environ['ALPACA_API_SECRET'] = 'fake_api_secret'
@@ -183,11 +586,19 @@ class TradingRealTimeTest(unittest.TestCase):
         with mock.patch.object(tradeapi, 'REST', return_value=self.alpaca) as alpaca_init, \
                 mock.patch.object(polygonapi, 'REST', return_value=self.polygon) as polygon_init, \
                 mock.patch.object(realtime, 'TradingRealTime', return_value=mock_trading) as trading_init, \
+                mock.patch.object(price_fetcher, 'AsyncPriceFetcher') as fetcher_init, \
                 mock.patch.object(argparse.ArgumentParser, 'parse_args',
                                   return_value=argparse.Namespace(real_trade=real_trade,
                                                                   api_key=None,
                                                                   api_secret=None,
-                                                                  force=False)):
+                                                                  force=False,
+                                                                  sync_fetch=sync_fetch,
+                                                                  stream=False,
+                                                                  scoring_worker=False,
+                                                                  hub=False,
+                                                                  name=None,
+                                                                  model=None,
+                                                                  profile=False, profile_memory=False)):
             realtime.main()
         if real_trade:
             alpaca_init.assert_called_once_with('fake_api_key', 'fake_api_secret',
@@ -198,6 +609,8 @@ class TradingRealTimeTest(unittest.TestCase):
                                                 utils.ALPACA_PAPER_API_BASE_URL, 'v2')
             polygon_init.assert_called_once_with('fake_paper_api_key')
         trading_init.assert_called_once()
+        # Prices are fetched with the async fetcher unless --sync_fetch
+        self.assertEqual(trading_init.call_args[0][2], None if sync_fetch else fetcher_init.return_value)
         mock_trading.run.assert_called_once()
         os.environ.clear()
         os.environ.update(saved_environ)
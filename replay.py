@@ -0,0 +1,150 @@
+import argparse
+import bisect
+import collections
+import contextlib
+import datetime
+import fake_broker
+import logging
+import os
+import price_journal
+import realtime
+import requests
+import scheduler
+import shutil
+import time
+import unittest.mock as mock
+import utils
+from tabulate import tabulate
+
+LastTrade = collections.namedtuple('LastTrade', ['price'])
+
+
+class ReplayClock(object):
+    """Simulated clock that starts at start_time and runs speed times faster than real time."""
+
+    def __init__(self, start_time, speed=1):
+        self.start_time = start_time
+        self.speed = speed
+        self.real_start = time.monotonic()
+
+    def time(self):
+        return self.start_time + (time.monotonic() - self.real_start) * self.speed
+
+    def monotonic(self):
+        return self.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0) / self.speed)
+
+
+class RecordedPrices(object):
+    """Prices recorded in a price journal, looked up at the time of a clock.
+
+    Before the first record of a symbol, its first recorded price is used.
+    """
+
+    def __init__(self, journal_file, clock):
+        self.clock = clock
+        records = collections.defaultdict(list)
+        with open(journal_file, errors='replace') as f:
+            for line in f:
+                record = price_journal.parse_line(line)
+                if record is None:
+                    continue
+                timestamp, symbol, price = record
+                records[symbol].append((timestamp, price))
+        self.times, self.prices = {}, {}
+        for symbol, symbol_records in records.items():
+            symbol_records.sort()
+            self.times[symbol] = [timestamp for timestamp, _ in symbol_records]
+            self.prices[symbol] = [price for _, price in symbol_records]
+
+    def get_time_range(self):
+        return (min(times[0] for times in self.times.values()),
+                max(times[-1] for times in self.times.values()))
+
+    def __contains__(self, symbol):
+        return symbol in self.prices
+
+    def __getitem__(self, symbol):
+        i = bisect.bisect_right(self.times[symbol], self.clock.time())
+        return self.prices[symbol][max(i - 1, 0)]
+
+
+class ReplayPolygon(object):
+    """Stand-in for the Polygon REST API serving recorded prices."""
+
+    def __init__(self, prices):
+        self.prices = prices
+
+    def last_trade(self, symbol):
+        if symbol not in self.prices:
+            raise requests.exceptions.HTTPError('No recorded price of %s' % (symbol,))
+        return LastTrade(self.prices[symbol])
+
+
+@contextlib.contextmanager
+def replay_environment(clock, prices):
+    """Drives realtime trading with a simulated clock and recorded prices.
+
+    Rate limits are lifted, since recorded prices are served locally.
+    """
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(realtime, 'time', clock))
+        stack.enter_context(mock.patch.object(scheduler, 'time', clock))
+        stack.enter_context(mock.patch.object(
+            utils, 'web_scraping', side_effect=lambda url, prefixes, max_age=0: str(prices['^VIX'])))
+        stack.enter_context(mock.patch.dict(utils.RATE_LIMITERS, {
+            name: utils.RateLimiter(name, 1E6) for name in utils.RATE_LIMITERS.keys()}))
+        yield
+
+
+def replay(recorded_dir, output_dir, close_time, minutes_before_close, speed, cash, latency, fill_delay):
+    """Replays a recorded trading day through TradingRealTime.run.
+
+    recorded_dir is the output directory of a live day, holding its price
+    journal and warm-up artifact. Logs of the replay are written to output_dir.
+    """
+    clock = ReplayClock(close_time.timestamp() - minutes_before_close * 60, speed)
+    prices = RecordedPrices(os.path.join(recorded_dir, 'prices.journal'), clock)
+    # Replay starts from scratch. Do not restore state of a previous replay.
+    shutil.rmtree(output_dir, ignore_errors=True)
+    broker = fake_broker.FakeBroker(prices, cash=cash, latency=latency,
+                                    fill_delay=fill_delay / speed, next_close=close_time, clock=clock)
+    start = time.monotonic()
+    with replay_environment(clock, prices):
+        trading = realtime.TradingRealTime(broker, ReplayPolygon(prices), output_dir=output_dir,
+                                           warmup_dir=os.path.join(recorded_dir, 'warmup'))
+        trading.run()
+    elapsed = time.monotonic() - start
+    orders_table = [[datetime.datetime.fromtimestamp(order.submitted_at).strftime('%T'), order.symbol,
+                     order.side, order.type, order.qty, order.limit_price, order.status]
+                    for order in broker.orders.values()]
+    logging.info(utils.get_header('Replay Orders') + '\n' +
+                 tabulate(orders_table, headers=['Time', 'Symbol', 'Side', 'Type', 'Quantity',
+                                                 'Limit Price', 'Status'], tablefmt='grid'))
+    logging.info('Replayed %.0f minutes before close in %.1f seconds', minutes_before_close, elapsed)
+    return broker
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded trading day offline.')
+    parser.add_argument('--day', required=True, help='Recorded day in YYYY-MM-DD.')
+    parser.add_argument('--close', default='16:00',
+                        help='Market close of the recorded day, in the local time of the recording.')
+    parser.add_argument('--minutes', default=20, type=float, help='Minutes before close to replay.')
+    parser.add_argument('--speed', default=20, type=float, help='Simulated seconds per real second.')
+    parser.add_argument('--cash', default=100000, type=float, help='Starting cash of the fake broker.')
+    parser.add_argument('--latency', default=0.1, type=float, help='Simulated seconds of each broker call.')
+    parser.add_argument('--fill_delay', default=1, type=float, help='Simulated seconds for an order to fill.')
+    args = parser.parse_args()
+    root_dir = os.path.dirname(os.path.realpath(__file__))
+    recorded_dir = os.path.join(root_dir, utils.OUTPUTS_DIR, 'realtime', args.day)
+    output_dir = os.path.join(root_dir, utils.OUTPUTS_DIR, 'replay', args.day)
+    close_time = datetime.datetime.strptime('%s %s' % (args.day, args.close), '%Y-%m-%d %H:%M')
+    replay(recorded_dir, output_dir, close_time, args.minutes, args.speed, args.cash,
+           args.latency, args.fill_delay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import datetime
+import numpy as np
+import os
+import pandas as pd
+import replay
+import requests
+import socket
+import tempfile
+import tensorflow.keras as keras
+import time
+import unittest
+import unittest.mock as mock
+import utils
+import warmup
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.dir.name, 'prices.journal')
+        with open(self.journal_file, 'w') as f:
+            f.write('100.000,SYMA,10.0\n'
+                    '100.000,^VIX,30.0\n'
+                    # Records joined after a crash
+                    '130.000,SYMA,13.000,SYMB,20.0\n'
+                    '160.000,SYMA,11.0\n'
+                    '220.000,SYMA,12.0\n'
+                    '230.000,SYMA,1')
+        self.clock = mock.Mock()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_recorded_prices(self):
+        prices = replay.RecordedPrices(self.journal_file, self.clock)
+        self.assertEqual(prices.get_time_range(), (100, 220))
+        for now, price in [(50, 10.0), (100, 10.0), (159, 10.0), (160, 11.0), (1000, 12.0)]:
+            self.clock.time.return_value = now
+            self.assertEqual(prices['SYMA'], price)
+        self.assertIn('^VIX', prices)
+        self.assertNotIn('SYMB', prices)
+
+    def test_replay_polygon(self):
+        self.clock.time.return_value = 200
+        polygon = replay.ReplayPolygon(replay.RecordedPrices(self.journal_file, self.clock))
+        self.assertEqual(polygon.last_trade('SYMA').price, 11.0)
+        with self.assertRaises(requests.exceptions.RequestException):
+            polygon.last_trade('SYMB')
+
+    def test_replay_clock(self):
+        with mock.patch.object(time, 'monotonic', side_effect=[10, 12]), \
+                mock.patch.object(time, 'sleep') as mock_sleep:
+            clock = replay.ReplayClock(1000, speed=20)
+            self.assertEqual(clock.time(), 1040)
+            clock.sleep(60)
+        mock_sleep.assert_called_once_with(3)
+
+    def test_replay_offline(self):
+        close_time = datetime.datetime(2020, 6, 30, 16)
+        recorded_dir = os.path.join(self.dir.name, 'recorded')
+        os.makedirs(recorded_dir)
+        start = close_time.timestamp() - 600
+        with open(os.path.join(recorded_dir, 'prices.journal'), 'w') as f:
+            for i in range(10):
+                for symbol, price in [('SYMA', 100 - i), ('SYMB', 100 + i), ('^VIX', 20)]:
+                    f.write('%.3f,%s,%.1f\n' % (start + i * 60, symbol, price))
+        np.random.seed(0)
+        closes = {symbol: np.random.random(300) * 10 + 100 for symbol in ['^VIX', 'SYMA', 'SYMB']}
+        volumes = {symbol: np.full(300, 1E6) for symbol in closes.keys()}
+        trading = utils.TradingBase.from_series(closes, volumes)
+        trading.history_dates = pd.bdate_range(end=close_time.date(), periods=300)
+        warmup_dir = os.path.join(recorded_dir, 'warmup')
+        os.makedirs(warmup_dir)
+        warmup.write_artifact(warmup_dir, trading, warmup.prepare_inputs(trading), shared=True)
+        fake_model = mock.Mock()
+        fake_model.predict.side_effect = lambda x: [50] * len(x)
+        with mock.patch.object(socket.socket, 'connect', side_effect=OSError('Network is blocked')) as connect, \
+                mock.patch.object(keras.models, 'load_model', return_value=fake_model), \
+                mock.patch.object(utils, 'CACHE_DIR', os.path.join(self.dir.name, 'cache')):
+            broker = replay.replay(recorded_dir, os.path.join(self.dir.name, 'replay'), close_time,
+                                   minutes_before_close=2, speed=60, cash=10000, latency=0, fill_delay=1)
+        connect.assert_not_called()
+        self.assertTrue(broker.orders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import utils
+from tabulate import tabulate
+
+# Weight of the latest measurement in the moving average of durations
+SMOOTHING = 0.3
+
+Step = collections.namedtuple('Step', ['name', 'planned', 'actual'])
+
+
+class DeadlineScheduler(object):
+    """Measures durations of recurring tasks and plans them against deadlines.
+
+    Durations are exponential moving averages of monotonic-clock measurements,
+    and can be persisted so that rare tasks like the close sequence are
+    estimated from previous days. Planned and actual times of named steps form
+    a timeline for the log.
+    """
+
+    def __init__(self, durations_file=None):
+        self.durations_file = durations_file
+        self.durations = {}
+        self.last_finishes = {}
+        self.timeline = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if durations_file and os.path.isfile(durations_file):
+            with open(durations_file) as f:
+                self.durations = json.loads(f.read())
+
+    def record(self, name, seconds):
+        with self.lock:
+            previous = self.durations.get(name)
+            self.durations[name] = (seconds if previous is None else
+                                    SMOOTHING * seconds + (1 - SMOOTHING) * previous)
+            self.last_finishes[name] = time.monotonic()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def estimate(self, name, default=0):
+        return self.durations.get(name, default)
+
+    def fits(self, name, now, deadline, default=0):
+        """Tells whether a task started now is expected to finish before deadline."""
+        return now + self.estimate(name, default) <= deadline
+
+    def seconds_since(self, name):
+        """Gets seconds since a task last finished, or None if it never did."""
+        last_finish = self.last_finishes.get(name)
+        return time.monotonic() - last_finish if last_finish is not None else None
+
+    def plan(self, step, planned_time):
+        with self.lock:
+            self.timeline[step] = Step(step, planned_time, None)
+
+    def mark(self, step, actual_time=None):
+        actual_time = actual_time or time.time()
+        with self.lock:
+            planned_time = self.timeline[step].planned if step in self.timeline else None
+            self.timeline[step] = Step(step, planned_time, actual_time)
+
+    def save(self):
+        if not self.durations_file:
+            return
+        with self.lock:
+            content = json.dumps(self.durations)
+        with open(self.durations_file, 'w') as f:
+            f.write(content)
+
+    def format_timeline(self):
+        def format_time(t):
+            return datetime.datetime.fromtimestamp(t).strftime('%T.%f')[:-3] if t else '-'
+
+        timeline_table = []
+        for step in self.timeline.values():
+            slack = ('%+.1f' % (step.planned - step.actual,)
+                     if step.planned and step.actual else '-')
+            timeline_table.append([step.name, format_time(step.planned),
+                                   format_time(step.actual), slack])
+        return (utils.get_header('Timeline') + '\n' +
+                tabulate(timeline_table, headers=['Step', 'Planned', 'Actual', 'Slack (s)'],
+                         tablefmt='grid'))
+
+    def log_timeline(self):
+        logging.info(self.format_timeline())
@@ -0,0 +1,39 @@
+import os
+import scheduler
+import tempfile
+import unittest
+
+
+class DeadlineSchedulerTest(unittest.TestCase):
+
+    def test_record(self):
+        s = scheduler.DeadlineScheduler()
+        s.record('task', 10)
+        self.assertEqual(s.estimate('task'), 10)
+        s.record('task', 20)
+        self.assertAlmostEqual(s.estimate('task'), 13)
+        self.assertEqual(s.estimate('other', 5), 5)
+        self.assertTrue(s.fits('task', 100, 113))
+        self.assertFalse(s.fits('task', 100, 112))
+
+    def test_timeline(self):
+        s = scheduler.DeadlineScheduler()
+        s.plan('Step A', 1000)
+        s.mark('Step A', 998)
+        s.mark('Step B', 1001)
+        timeline = s.format_timeline()
+        self.assertIn('Step A', timeline)
+        self.assertIn('+2.0', timeline)
+        self.assertIn('Step B', timeline)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as d:
+            durations_file = os.path.join(d, 'durations.json')
+            s = scheduler.DeadlineScheduler(durations_file)
+            s.record('task', 3)
+            s.save()
+            self.assertEqual(scheduler.DeadlineScheduler(durations_file).estimate('task'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
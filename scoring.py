@@ -0,0 +1,188 @@
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import os
+import price_fetcher
+import requests
+import shutil
+import tempfile
+import tensorflow.keras as keras
+import threading
+import time
+import utils
+from concurrent import futures
+from tabulate import tabulate
+
+# Seconds to wait for a trading list from the worker
+SCORE_TIMEOUT_SECS = 60
+
+
+def _run_worker(series_dir, model_path, score_requests, score_results):
+    """Scores trading lists of the latest prices until None is received.
+
+    A request with scenarios scores trading lists of the what-if scenarios instead.
+    """
+    closes, volumes = utils.map_series_matrix(series_dir)
+    model = keras.models.load_model(model_path)
+    trading = utils.TradingBase.from_series(closes, volumes, model)
+    prices = {}
+    while True:
+        request = score_requests.get()
+        if request is None:
+            return
+        deltas, scenarios = request
+        prices.update(deltas)
+        start = time.monotonic()
+        try:
+            if scenarios:
+                result = trading.get_scenario_trading_lists(scenarios, prices)
+            else:
+                result = trading.get_trading_list(prices=prices)
+        except Exception as e:
+            score_results.put((None, 0, e))
+        else:
+            score_results.put((result, time.monotonic() - start, None))
+
+
+class ScoringWorker(object):
+    """Scores trading lists in a dedicated process.
+
+    Feature math and model inference are CPU-bound and would otherwise hold the
+    GIL against the price refresh threads. The worker maps the same series
+    matrices read-only, and only receives prices changed since the last request.
+    """
+
+    def __init__(self, series_dir, model_path, timeout=SCORE_TIMEOUT_SECS):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_run_worker, name='ScoringWorker',
+                                       args=(series_dir, model_path, self.requests, self.results))
+        self.process.daemon = True
+        self.timeout = timeout
+        self.sent_prices = {}
+        self.latencies = []
+
+    def start(self):
+        self.process.start()
+
+    def score(self, prices):
+        """Gets the trading list of prices. Blocks until the worker replies."""
+        return self._request(prices, None)
+
+    def score_scenarios(self, prices, scenarios):
+        """Gets (scenario, trading list) tuples of what-if scenarios from prices."""
+        return self._request(prices, scenarios)
+
+    def _request(self, prices, scenarios):
+        prices = dict(prices)
+        deltas = {symbol: price for symbol, price in prices.items()
+                  if self.sent_prices.get(symbol) != price}
+        self.requests.put((deltas, scenarios))
+        result, latency, error = self.results.get(timeout=self.timeout)
+        if error:
+            raise error
+        self.sent_prices = prices
+        self.latencies.append(latency)
+        return result
+
+    def stop(self):
+        self.requests.put(None)
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def generate_series(n_symbols, length, seed=0):
+    """Generates random-walk closes and volumes of liquid symbols."""
+    rng = np.random.RandomState(seed)
+    closes, volumes = {}, {}
+    for symbol in ['^VIX'] + ['SYM%d' % (i,) for i in range(n_symbols)]:
+        closes[symbol] = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, length)))
+        volumes[symbol] = rng.uniform(1E5, 1E6, length)
+    return closes, volumes
+
+
+def benchmark(n_symbols, duration, latency, model_path):
+    """Compares scoring latency and price refresh throughput with and without the worker.
+
+    Three threads keep refreshing quotes from a local quote server, as
+    update_stats does, while trading lists are scored back to back.
+    """
+    closes, volumes = generate_series(n_symbols, utils.DAYS_IN_A_YEAR + 50)
+    symbols = [symbol for symbol in closes.keys() if symbol != '^VIX']
+    rng = np.random.RandomState(1)
+    prices = {symbol: close[-utils.DAYS_IN_A_WEEK] * np.exp(rng.normal(0, 0.05))
+              for symbol, close in closes.items()}
+    series_dir = tempfile.mkdtemp()
+    utils.write_series_matrix(series_dir, closes, volumes)
+    server = price_fetcher.QuoteServer(latency=latency)
+    server.start()
+    benchmark_table = []
+    try:
+        for use_worker in [False, True]:
+            if use_worker:
+                worker = ScoringWorker(series_dir, model_path)
+                worker.start()
+                # Load the model before measuring
+                worker.score(prices)
+                score = worker.score
+            else:
+                trading = utils.TradingBase.from_series(closes, volumes, keras.models.load_model(model_path))
+                score = lambda p: trading.get_trading_list(prices=p)
+            quote_count = [0]
+            stop = threading.Event()
+
+            def refresh(offset):
+                session = requests.Session()
+                i = offset
+                while not stop.is_set():
+                    symbol = symbols[i % len(symbols)]
+                    r = session.get('%s/v1/last/stocks/%s' % (server.base_url, symbol),
+                                    timeout=price_fetcher.DEFAULT_TIMEOUT)
+                    float(r.json()['last']['price'])
+                    quote_count[0] += 1
+                    i += 3
+
+            latencies = []
+            with futures.ThreadPoolExecutor(max_workers=3) as pool:
+                threads = [pool.submit(refresh, offset) for offset in range(3)]
+                start = time.monotonic()
+                while time.monotonic() - start < duration:
+                    score_start = time.monotonic()
+                    score(prices)
+                    latencies.append(time.monotonic() - score_start)
+                elapsed = time.monotonic() - start
+                stop.set()
+                for t in threads:
+                    t.result()
+            if use_worker:
+                worker.stop()
+            benchmark_table.append(['Worker process' if use_worker else 'In-process', len(latencies),
+                                    '%.3f' % (np.median(latencies),), '%.3f' % (np.percentile(latencies, 95),),
+                                    '%.1f' % (quote_count[0] / elapsed,)])
+    finally:
+        server.stop()
+        shutil.rmtree(series_dir, ignore_errors=True)
+    logging.info(utils.get_header('Scoring Benchmark') + '\n' +
+                 tabulate(benchmark_table, headers=['Mode', 'Scorings', 'Median Seconds', 'P95 Seconds',
+                                                    'Quotes/sec'],
+                          tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark realtime scoring offline.')
+    parser.add_argument('--symbols', default=1000, type=int, help='Number of symbols to score.')
+    parser.add_argument('--duration', default=30, type=float, help='Seconds to run each mode.')
+    parser.add_argument('--latency', default=0.05, type=float,
+                        help='Simulated server latency in seconds.')
+    parser.add_argument('--model', default=utils.DEFAULT_MODEL, help='Model file name.')
+    args = parser.parse_args()
+    utils.logging_config()
+    model_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), utils.MODELS_DIR, args.model)
+    benchmark(args.symbols, args.duration, args.latency, model_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import queue
+import scoring
+import tensorflow.keras as keras
+import unittest
+import unittest.mock as mock
+import utils
+
+
+class ScoringTest(unittest.TestCase):
+
+    def setUp(self):
+        self.closes, self.volumes = scoring.generate_series(10, utils.DAYS_IN_A_YEAR + 10)
+        self.prices = {symbol: close[-utils.DAYS_IN_A_WEEK] * 0.5 for symbol, close in self.closes.items()}
+        self.fake_model = mock.Mock()
+        self.fake_model.predict.side_effect = lambda x: [50] * len(x)
+        self.patch_keras = mock.patch.object(keras.models, 'load_model', return_value=self.fake_model)
+        self.patch_keras.start()
+        self.patch_map = mock.patch.object(utils, 'map_series_matrix',
+                                           return_value=(self.closes, self.volumes))
+        self.patch_map.start()
+
+    def tearDown(self):
+        self.patch_keras.stop()
+        self.patch_map.stop()
+
+    def test_run_worker(self):
+        score_requests, score_results = queue.Queue(), queue.Queue()
+        scenarios = [utils.Scenario('Flat', 0, {}), utils.Scenario('Down', -0.01, {})]
+        score_requests.put((self.prices, None))
+        score_requests.put(({'SYM0': 1E10}, None))
+        score_requests.put(({}, scenarios))
+        score_requests.put(None)
+        scoring._run_worker('fake_series_dir', 'fake_model_path', score_requests, score_results)
+        trading = utils.TradingBase.from_series(self.closes, self.volumes, self.fake_model)
+        trading_list, _, error = score_results.get()
+        self.assertIsNone(error)
+        self.assertEqual(trading_list, trading.get_trading_list(prices=self.prices))
+        # Deltas are applied on top of earlier prices
+        trading_list, _, _ = score_results.get()
+        self.assertEqual(trading_list, trading.get_trading_list(prices=dict(self.prices, SYM0=1E10)))
+        scenario_trading_lists, _, _ = score_results.get()
+        self.assertEqual(scenario_trading_lists,
+                         trading.get_scenario_trading_lists(scenarios, dict(self.prices, SYM0=1E10)))
+
+    def test_score_sends_deltas(self):
+        worker = scoring.ScoringWorker('fake_series_dir', 'fake_model_path')
+        worker.requests, worker.results = mock.Mock(), mock.Mock()
+        worker.results.get.return_value = ([], 0.1, None)
+        worker.score({'SYMA': 10, 'SYMB': 20})
+        worker.score({'SYMA': 10, 'SYMB': 21})
+        scenarios = [utils.Scenario('Flat', 0, {})]
+        worker.score_scenarios({'SYMA': 11, 'SYMB': 21}, scenarios)
+        self.assertEqual([c[0][0] for c in worker.requests.put.call_args_list],
+                         [({'SYMA': 10, 'SYMB': 20}, None), ({'SYMB': 21}, None), ({'SYMA': 11}, scenarios)])
+        self.assertEqual(worker.latencies, [0.1, 0.1, 0.1])
+
+    def test_score_error(self):
+        worker = scoring.ScoringWorker('fake_series_dir', 'fake_model_path')
+        worker.requests, worker.results = mock.Mock(), mock.Mock()
+        worker.results.get.return_value = (None, 0, ValueError('Test error'))
+        with self.assertRaises(ValueError):
+            worker.score({'SYMA': 10})
+        self.assertEqual(worker.sent_prices, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
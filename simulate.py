@@ -1,16 +1,33 @@
 import alpaca_trade_api as tradeapi
 import argparse
 import datetime
+import hashlib
+import json
 import logging
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
+import pickle
+import profiling
+import shutil
 import signal
+import tensorflow.keras as keras
 import utils
 from tabulate import tabulate
 
+# Shards per worker process. More shards balance load better at the cost of
+# scheduling overhead.
+SHARDS_PER_PROCESS = 4
+# Number of simulated days between two checkpoints
+CHECKPOINT_INTERVAL = 20
+STATS_COLUMNS = ['Symbol', 'Date'] + utils.ML_FEATURES + ['Gain']
+
+# Simulation state of a worker process
+_shard_trading = None
+
 
 class TradingSimulate(utils.TradingBase):
     """Simulates trading transactions and outputs performances."""
@@ -21,7 +38,11 @@ class TradingSimulate(utils.TradingBase):
                  end_date=None,
                  model=None,
                  data_files=None,
-                 write_data=False):
+                 write_data=False,
+                 processes=1,
+                 resume=False,
+                 compact=False,
+                 float32_prices=False):
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
         self.output_dir = os.path.join(self.root_dir, utils.OUTPUTS_DIR,
                                        'simulate',
@@ -29,6 +50,7 @@ class TradingSimulate(utils.TradingBase):
         os.makedirs(self.output_dir, exist_ok=True)
         utils.logging_config(os.path.join(self.output_dir, 'result.txt'))
         self.write_data = write_data
+        self.processes = processes
 
         period = None
         if data_files:
@@ -38,7 +60,8 @@ class TradingSimulate(utils.TradingBase):
             period = '%dy' % (year_diff,)
         super(TradingSimulate, self).__init__(alpaca, period=period, start_date=start_date,
                                               end_date=end_date, model=model,
-                                              load_history=not bool(data_files))
+                                              load_history=not bool(data_files),
+                                              compact=compact, float32_prices=float32_prices)
         self.data_files = data_files
         if self.data_files:
             self.start_date = start_date or self.data_df.iloc[0].Date
@@ -57,28 +80,121 @@ class TradingSimulate(utils.TradingBase):
             while (self.end_point > 0 and
                    pd.to_datetime(self.end_date) < self.history_dates[self.end_point]):
                 self.end_point -= 1
-            if self.write_data:
-                stats_cols = ['Symbol', 'Date'] + utils.ML_FEATURES + ['Gain']
-                self.stats = pd.DataFrame(columns=stats_cols)
             self.values = {'Total': ([self.history_dates[self.start_point - 1]], [1.0])}
+        # Rows are buffered in a list since appending to a DataFrame copies it every time
+        self.stats = []
         self.win_trades, self.lose_trades = 0, 0
+        # Last simulated sell date, or last simulated date if reading data files
+        self.last_position = None
+        self.unsaved_days = 0
+        # Rows of self.stats saved to the stats journal of the checkpoint, and the size of the journal
+        self.saved_stats, self.stats_offset = 0, 0
+        self.exit_requested = False
+        self.checkpoint_path = self.get_checkpoint_path(start_date, end_date, model)
+        if resume:
+            self.load_checkpoint()
         signal.signal(signal.SIGINT, self.safe_exit)
 
+    def get_startup_stages(self, load_history):
+        """Adds the reference history when reading data files, whose dates are looked up in it."""
+        stages = super(TradingSimulate, self).get_startup_stages(load_history)
+        if not load_history:
+            stages.append(utils.Stage('reference_history', self.load_reference_history, ['clock']))
+        return stages
+
+    def get_checkpoint_path(self, start_date, end_date, model):
+        """Gets checkpoint path, which is shared by runs with the same configuration.
+
+        Dates are the requested ones rather than the resolved ones, since the
+        default end date moves every day and a resumed run would miss its checkpoint.
+        """
+        config = json.dumps([start_date, end_date, model, self.data_files, self.write_data])
+        key = hashlib.md5(config.encode()).hexdigest()[:16]
+        return os.path.join(self.root_dir, utils.OUTPUTS_DIR, 'simulate', 'checkpoints',
+                            'checkpoint_%s.p' % (key,))
+
+    def save_checkpoint(self):
+        """Saves simulation progress atomically.
+
+        Stats rows are appended to a journal next to the checkpoint, so that a
+        checkpoint only writes rows added since the last one. The checkpoint
+        records the size of the journal it covers, and rows appended after it
+        are dropped on the next save or load.
+        """
+        if self.last_position is None:
+            return
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        with open(self.get_stats_journal_path(), 'ab') as f:
+            f.truncate(self.stats_offset)
+            rows = pickle.dumps(self.stats[self.saved_stats:], protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(rows)
+        self.saved_stats = len(self.stats)
+        self.stats_offset += len(rows)
+        checkpoint = {'last_position': self.last_position,
+                      'values': self.values,
+                      'win_trades': self.win_trades,
+                      'lose_trades': self.lose_trades,
+                      'stats_offset': self.stats_offset}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.unsaved_days = 0
+
+    def get_stats_journal_path(self):
+        return self.checkpoint_path + '.stats'
+
+    def load_checkpoint(self):
+        """Restores simulation progress from the latest checkpoint if there is one."""
+        if not os.path.isfile(self.checkpoint_path):
+            logging.info('No checkpoint found at %s. Start from scratch.', self.checkpoint_path)
+            return
+        with open(self.checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        self.last_position = checkpoint['last_position']
+        self.values = checkpoint['values']
+        self.win_trades = checkpoint['win_trades']
+        self.lose_trades = checkpoint['lose_trades']
+        self.stats_offset = checkpoint['stats_offset']
+        with open(self.get_stats_journal_path(), 'rb') as f:
+            while f.tell() < self.stats_offset:
+                self.stats.extend(pickle.load(f))
+        self.saved_stats = len(self.stats)
+        logging.info('Resume from checkpoint %s after %s', self.checkpoint_path, self.last_position)
+
+    def record_progress(self, position):
+        """Marks a day as simulated and saves a checkpoint periodically, or exits if requested."""
+        self.last_position = position
+        self.unsaved_days += 1
+        if self.exit_requested:
+            self.save_checkpoint()
+            if self.write_data:
+                self.save_data()
+            else:
+                self.print_summary()
+            exit(1)
+        if self.unsaved_days >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+
     def safe_exit(self, signum, frame):
-        logging.info('Safe exiting with signal %d...', signum)
-        if self.write_data:
-            self.save_data()
-        else:
-            self.print_summary()
-        exit(1)
+        """Exits at the end of the day being simulated, whose results may be partly recorded.
 
-    def analyze_date(self, sell_date, cutoff):
-        outputs = [utils.get_header(sell_date.date())]
+        A second signal exits right away, without a checkpoint.
+        """
+        if self.exit_requested:
+            raise KeyboardInterrupt()
+        logging.info('Safe exiting with signal %d after the current day...', signum)
+        self.exit_requested = True
+
+    def compute_date(self, cutoff):
+        """Computes buy symbols, trading table and daily gain of a cutoff day.
+
+        Only history up to cutoff + 1 is read, and nothing is written to self, so
+        days can be computed independently in any order.
+        """
         buy_symbols = self.get_buy_symbols(cutoff=cutoff, skip_prediction=self.write_data)
         if self.write_data and cutoff < self.history_length - 1:
-            self.append_stats(buy_symbols, sell_date, cutoff)
-            logging.info('\n'.join(outputs))
-            return
+            return buy_symbols, None, None
         trading_list = self.get_trading_list(buy_symbols=buy_symbols)
         trading_table = []
         daily_gain = 0
@@ -104,6 +220,16 @@ class TradingSimulate(utils.TradingBase):
                                   close[cutoff + 1],
                                   '%+.2f%%' % (gain * 100,)])
             daily_gain += gain * proportion
+        return buy_symbols, trading_table, daily_gain
+
+    def analyze_date(self, sell_date, cutoff, result=None):
+        """Records results of a cutoff day. Computes them unless given."""
+        outputs = [utils.get_header(sell_date.date())]
+        buy_symbols, trading_table, daily_gain = result or self.compute_date(cutoff)
+        if self.write_data and cutoff < self.history_length - 1:
+            self.append_stats(buy_symbols, sell_date, cutoff)
+            logging.info('\n'.join(outputs))
+            return
 
         if trading_table:
             outputs.append(tabulate(trading_table, headers=[
@@ -179,8 +305,8 @@ class TradingSimulate(utils.TradingBase):
         end_year = self.start_date[:4]
         filename = ('data_%s.csv' % (start_year,) if start_year == end_year else
                     'data_%s_%s.csv' % (start_year, end_year))
-        self.stats.to_csv(os.path.join(self.root_dir, utils.DATA_DIR, filename),
-                          index=False)
+        stats = pd.DataFrame(self.stats, columns=STATS_COLUMNS)
+        stats.to_csv(os.path.join(self.root_dir, utils.DATA_DIR, filename), index=False)
 
     def print_summary(self):
         time_range = '%s ~ %s' % (self.start_date, self.end_date)
@@ -195,9 +321,9 @@ class TradingSimulate(utils.TradingBase):
         plot_symbols = ['QQQ', 'SPY', 'TQQQ']
         color_map = {'QQQ': '#78d237', 'SPY': '#FF6358', 'TQQQ': '#aa46be'}
         for symbol in [utils.REFERENCE_SYMBOL] + plot_symbols:
-            if symbol not in self.hists:
+            if symbol not in self.hists and symbol not in self.closes:
                 try:
-                    self.load_history(symbol, self.period)
+                    self.load_history(symbol)
                 except Exception:
                     pass
         for k, v in self.values.items():
@@ -212,8 +338,12 @@ class TradingSimulate(utils.TradingBase):
                      color='#28b4c8')
             curve_max = 1
             for symbol in plot_symbols:
-                if symbol in self.hists:
-                    curve = [self.hists[symbol].get('Close')[dt] for dt in dates]
+                if symbol in self.hists or symbol in self.closes:
+                    close = self.get_close_series(symbol)
+                    # Dates of data files may be outside of the loaded histories
+                    if any(dt not in close.index for dt in dates):
+                        continue
+                    curve = [close[dt] for dt in dates]
                     for i in range(len(dates) - 1, -1, -1):
                         curve[i] /= curve[0]
                     curve_max = max(curve_max, np.abs(curve[-1]))
@@ -247,25 +377,78 @@ class TradingSimulate(utils.TradingBase):
                 current_date = row.Date
                 if current_date < self.start_date or current_date > self.end_date:
                     continue
+                if self.last_position is not None and current_date <= self.last_position:
+                    continue
                 if current_date != prev_date and prev_date:
                     self.analyze_rows(prev_date, rows)
+                    self.record_progress(prev_date)
                     rows = []
                 rows.append(row)
                 prev_date = current_date
-            self.analyze_rows(prev_date, rows)
+            if rows:
+                self.analyze_rows(prev_date, rows)
+                self.record_progress(prev_date)
         else:
-            for cutoff in range(self.start_point - 1, self.end_point):
-                sell_date = self.history_dates[cutoff + 1]
-                self.analyze_date(sell_date, cutoff)
+            cutoffs = [(self.history_dates[cutoff + 1], cutoff)
+                       for cutoff in range(self.start_point - 1, self.end_point)]
             if pd.to_datetime(self.end_date) > self.history_dates[-1]:
-                self.analyze_date(self.history_dates[-1] + pd.tseries.offsets.BDay(1),
-                                  self.history_length - 1)
+                cutoffs.append((self.history_dates[-1] + pd.tseries.offsets.BDay(1),
+                                self.history_length - 1))
+            if self.last_position is not None:
+                # Compared by date since history indices shift as days pass
+                cutoffs = [(sell_date, cutoff) for sell_date, cutoff in cutoffs
+                           if sell_date > self.last_position]
+            if self.processes > 1:
+                self.run_parallel(cutoffs)
+            else:
+                for sell_date, cutoff in cutoffs:
+                    self.analyze_date(sell_date, cutoff)
+                    self.record_progress(sell_date)
 
+        self.save_checkpoint()
+        logging.info(utils.get_header('Memory After Simulation') + '\n' + self.get_memory_table())
         if self.write_data:
-            self.save_data()
+            with profiling.phase('reporting'):
+                self.save_data()
         else:
-            self.print_summary()
-            self.plot_summary()
+            with profiling.phase('reporting'):
+                self.print_summary()
+            with profiling.phase('plotting'):
+                self.plot_summary()
+
+    def run_parallel(self, cutoffs):
+        """Computes days in worker processes and records them in order.
+
+        Workers map a shared read-only copy of closes and volumes and compute
+        contiguous shards of days. Daily gains are chained into self.values by
+        this process in date order, so results are identical to a serial run.
+        """
+        if not cutoffs:
+            return
+        series_dir = os.path.join(self.output_dir, 'series')
+        utils.write_series_matrix(series_dir, self.closes, self.volumes)
+        n_shards = min(len(cutoffs), self.processes * SHARDS_PER_PROCESS)
+        shards = [[cutoff for _, cutoff in cutoffs[len(cutoffs) * i // n_shards:
+                                                    len(cutoffs) * (i + 1) // n_shards]]
+                  for i in range(n_shards)]
+        model_path = None if self.write_data else self.model_path
+        logging.info('Simulating %d days in %d shards with %d processes',
+                     len(cutoffs), n_shards, self.processes)
+        # Spawn instead of fork since tensorflow is not fork-safe
+        context = multiprocessing.get_context('spawn')
+        try:
+            with context.Pool(self.processes, initializer=_init_shard_worker,
+                              initargs=(series_dir, model_path, self.history_length,
+                                        self.write_data)) as pool:
+                i = 0
+                for shard_results in pool.imap(_compute_shard, shards):
+                    for result in shard_results:
+                        sell_date, cutoff = cutoffs[i]
+                        self.analyze_date(sell_date, cutoff, result)
+                        self.record_progress(sell_date)
+                        i += 1
+        finally:
+            shutil.rmtree(series_dir, ignore_errors=True)
 
     def append_stats(self, buy_symbols, date, cutoff):
         for symbol, _, ml_feature in buy_symbols:
@@ -278,7 +461,7 @@ class TradingSimulate(utils.TradingBase):
             stat_value['Symbol'] = symbol
             stat_value['Date'] = date
             stat_value['Gain'] = gain
-            self.stats = self.stats.append(stat_value, ignore_index=True)
+            self.stats.append(stat_value)
 
     def get_prev_market_date(self, date):
         p = 0
@@ -287,6 +470,30 @@ class TradingSimulate(utils.TradingBase):
         return self.history_dates[p - 1]
 
 
+def _init_shard_worker(series_dir, model_path, history_length, write_data):
+    global _shard_trading
+    # The main process exits at a day boundary on interrupt, which needs workers to finish their days.
+    # Workers of thread pools share the handler of the main process.
+    if multiprocessing.parent_process() is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    closes, volumes = utils.map_series_matrix(series_dir)
+    model = keras.models.load_model(model_path) if model_path else None
+    _shard_trading = TradingSimulate.from_series(closes, volumes, model)
+    _shard_trading.history_length = history_length
+    _shard_trading.write_data = write_data
+
+
+def _compute_shard(cutoffs):
+    results = []
+    for cutoff in cutoffs:
+        buy_symbols, trading_table, daily_gain = _shard_trading.compute_date(cutoff)
+        if not _shard_trading.write_data:
+            # ML features are only needed to write data. Do not send them back.
+            buy_symbols = None
+        results.append((buy_symbols, trading_table, daily_gain))
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description='Stock trading simulation.')
     parser.add_argument('--start_date', default=None,
@@ -299,15 +506,32 @@ def main():
     parser.add_argument('--data_files', default=None, nargs='*', help='Read datafile for simulation.')
     parser.add_argument("--write_data", help='Write data with ML features.',
                         action="store_true")
+    parser.add_argument('--processes', default=1, type=int,
+                        help='Number of worker processes simulating days in parallel.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume from the latest checkpoint of the same configuration.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Keep only closes and float32 volumes of histories to save memory.')
+    parser.add_argument('--float32_prices', action='store_true',
+                        help='Keep closes in float32 as well.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile phases and sample stacks into the output directory.')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='Also trace memory high-water marks of phases with --profile. Slows down allocations.')
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(args.profile_memory)
 
     alpaca = tradeapi.REST(args.api_key or os.environ['ALPACA_PAPER_API_KEY'],
                            args.api_secret or os.environ['ALPACA_PAPER_API_SECRET'],
                            utils.ALPACA_PAPER_API_BASE_URL, 'v2')
     trading = TradingSimulate(alpaca, args.start_date, args.end_date,
                               args.model, args.data_files,
-                              args.write_data)
+                              args.write_data, args.processes, args.resume,
+                              args.compact, args.float32_prices)
     trading.run()
+    if args.profile:
+        profiling.write(trading.output_dir)
 
 
 if __name__ == '__main__':
@@ -2,11 +2,16 @@ import alpaca_trade_api as tradeapi
 import argparse
 import collections
 import datetime
+import io
 import matplotlib.pyplot as plt
+import multiprocessing.dummy
 import numpy as np
 import pandas as pd
 import simulate
 import os
+import pickle
+import signal
+import tempfile
 import tensorflow.keras as keras
 import unittest
 import unittest.mock as mock
@@ -31,6 +36,9 @@ class TradingSimulateTest(unittest.TestCase):
         self.patch_keras.start()
         self.patch_mkdirs = mock.patch.object(os, 'makedirs')
         self.patch_mkdirs.start()
+        self.replace = os.replace
+        self.patch_replace = mock.patch.object(os, 'replace')
+        self.patch_replace.start()
         self.patch_savefig = mock.patch.object(plt, 'savefig')
         self.mock_savefig = self.patch_savefig.start()
         self.patch_tight_layout = mock.patch.object(plt, 'tight_layout')
@@ -62,6 +70,7 @@ class TradingSimulateTest(unittest.TestCase):
         self.patch_isfile.stop()
         self.patch_keras.stop()
         self.patch_mkdirs.stop()
+        self.patch_replace.stop()
         self.patch_history.stop()
         self.patch_savefig.stop()
         self.patch_to_csv.stop()
@@ -71,6 +80,131 @@ class TradingSimulateTest(unittest.TestCase):
         self.trading.run()
         self.assertGreaterEqual(self.mock_savefig.call_count, 3)  # quarter, year, total plots
 
+    def test_run_compact(self):
+        trading = simulate.TradingSimulate(
+            self.alpaca,
+            start_date=(datetime.datetime.today().date() - pd.tseries.offsets.BDay(30)).strftime('%F'),
+            compact=True, float32_prices=True)
+        self.assertEqual(trading.hists, {})
+        self.assertEqual(trading.closes['SYMA'].dtype, np.float32)
+        self.assertEqual(trading.volumes['SYMA'].dtype, np.float32)
+        trading.run()
+        self.assertGreaterEqual(self.mock_savefig.call_count, 3)
+
+    def test_run_parallel(self):
+        self.trading.run()
+        serial_values = self.trading.values
+        self.trading.values = {'Total': ([self.trading.history_dates[self.trading.start_point - 1]], [1.0])}
+        self.trading.last_position = None
+        self.trading.processes = 2
+        with tempfile.TemporaryDirectory() as output_dir, \
+                mock.patch('builtins.open', io.open), \
+                mock.patch.object(simulate.multiprocessing, 'get_context',
+                                  return_value=multiprocessing.dummy):
+            self.trading.output_dir = output_dir
+            self.trading.checkpoint_path = os.path.join(output_dir, 'checkpoint.p')
+            # os.makedirs is patched out in setUp
+            os.mkdir(os.path.join(output_dir, 'series'))
+            self.trading.run()
+        self.assertEqual(self.trading.values, serial_values)
+
+    def test_resume_from_checkpoint(self):
+        self.trading.run()
+        full_values = self.trading.values
+        with tempfile.TemporaryDirectory() as checkpoint_dir, \
+                mock.patch('builtins.open', io.open), \
+                mock.patch.object(os, 'replace', self.replace), \
+                mock.patch.object(utils, 'logging_config'), \
+                mock.patch.object(simulate, 'CHECKPOINT_INTERVAL', 1), \
+                mock.patch.object(simulate.TradingSimulate, 'get_checkpoint_path',
+                                  return_value=os.path.join(checkpoint_dir, 'checkpoint.p')):
+            interrupted = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date)
+            analyze_date = simulate.TradingSimulate.analyze_date
+            analyzed_days = []
+
+            def analyze_date_then_interrupt(trading, *args):
+                if len(analyzed_days) == 10:
+                    raise KeyboardInterrupt()
+                analyzed_days.append(args)
+                return analyze_date(trading, *args)
+
+            with mock.patch.object(simulate.TradingSimulate, 'analyze_date', analyze_date_then_interrupt), \
+                    self.assertRaises(KeyboardInterrupt):
+                interrupted.run()
+            resumed = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date, resume=True)
+            resumed.run()
+        self.assertEqual(resumed.values, full_values)
+
+    def test_safe_exit_at_day_boundary(self):
+        self.trading.run()
+        full_values = self.trading.values
+        with tempfile.TemporaryDirectory() as checkpoint_dir, \
+                mock.patch('builtins.open', io.open), \
+                mock.patch.object(os, 'replace', self.replace), \
+                mock.patch.object(utils, 'logging_config'), \
+                mock.patch.object(simulate.TradingSimulate, 'get_checkpoint_path',
+                                  return_value=os.path.join(checkpoint_dir, 'checkpoint.p')):
+            interrupted = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date)
+            add_profit = simulate.TradingSimulate.add_profit
+            analyzed_days = []
+
+            def add_profit_then_interrupt(trading, *args):
+                analyzed_days.append(args)
+                add_profit(trading, *args)
+                if len(analyzed_days) == 10:
+                    # Interrupted after the day is partly recorded
+                    trading.safe_exit(signal.SIGINT, None)
+
+            with mock.patch.object(simulate.TradingSimulate, 'add_profit', add_profit_then_interrupt), \
+                    self.assertRaises(SystemExit):
+                interrupted.run()
+            self.assertEqual(len(analyzed_days), 10)
+            resumed = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date, resume=True)
+            resumed.run()
+        self.assertEqual(resumed.values, full_values)
+
+    def test_resume_stats_from_journal(self):
+        self.trading.write_data = True
+        self.trading.run()
+        full_stats = self.trading.stats
+        with tempfile.TemporaryDirectory() as checkpoint_dir, \
+                mock.patch('builtins.open', io.open), \
+                mock.patch.object(os, 'replace', self.replace), \
+                mock.patch.object(utils, 'logging_config'), \
+                mock.patch.object(simulate, 'CHECKPOINT_INTERVAL', 1), \
+                mock.patch.object(simulate.TradingSimulate, 'get_checkpoint_path',
+                                  return_value=os.path.join(checkpoint_dir, 'checkpoint.p')):
+            interrupted = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date, write_data=True)
+            save_checkpoint = simulate.TradingSimulate.save_checkpoint
+            saved_rows = []
+
+            def save_checkpoint_then_interrupt(trading):
+                saved_rows.append(len(trading.stats) - trading.saved_stats)
+                save_checkpoint(trading)
+                if len(saved_rows) == 10:
+                    # Rows appended without a checkpoint covering them are dropped on resume
+                    with open(trading.get_stats_journal_path(), 'ab') as f:
+                        pickle.dump(trading.stats[-1:], f)
+                    raise KeyboardInterrupt()
+
+            with mock.patch.object(simulate.TradingSimulate, 'save_checkpoint', save_checkpoint_then_interrupt), \
+                    self.assertRaises(KeyboardInterrupt):
+                interrupted.run()
+            # Each checkpoint writes the rows of its day only
+            self.assertEqual(sum(saved_rows), len(interrupted.stats))
+            resumed = simulate.TradingSimulate(self.alpaca, start_date=self.trading.start_date, write_data=True,
+                                               resume=True)
+            resumed.run()
+        self.assertEqual(sorted((row['Date'], row['Symbol']) for row in resumed.stats),
+                         sorted((row['Date'], row['Symbol']) for row in full_stats))
+
+    def test_checkpoint_path_ignores_resolved_dates(self):
+        checkpoint_path = self.trading.get_checkpoint_path(self.trading.start_date, None, None)
+        self.trading.end_date = (datetime.datetime.today().date() + pd.tseries.offsets.BDay(1)).strftime('%F')
+        self.assertEqual(self.trading.get_checkpoint_path(self.trading.start_date, None, None), checkpoint_path)
+        self.assertNotEqual(self.trading.get_checkpoint_path(self.trading.start_date, self.trading.end_date, None),
+                            checkpoint_path)
+
     def test_run_with_data_file(self):
         data_dict = {feature: np.random.random(30) for feature in utils.ML_FEATURES}
         data_dict['Date'] = ['2020-01-01'] * 10 + ['2020-01-02'] * 10 + ['2020-01-03'] * 10
@@ -92,7 +226,10 @@ class TradingSimulateTest(unittest.TestCase):
                     return_value=argparse.Namespace(start_date=None, end_date=None,
                                                     api_key='fake_api_key',
                                                     api_secret='fake_api_secret',
-                                                    model=None, data_files=[], write_data=False)):
+                                                    model=None, data_files=[], write_data=False,
+                                                    processes=1, resume=False,
+                                                    compact=False, float32_prices=False,
+                                                    profile=False, profile_memory=False)):
             simulate.main()
         alpaca_init.assert_called_once_with('fake_api_key', 'fake_api_secret',
                                             utils.ALPACA_PAPER_API_BASE_URL, 'v2')
@@ -1,18 +1,26 @@
+import collections
 import functools
+import json
 import logging
 import numpy as np
 import os
 import pandas as pd
+import profiling
 import re
 import requests
+import resource
 import retrying
+import socket
 import sys
+import threading
+import time
 import ta.momentum as momentum
 import ta.trend as trend
 import tensorflow.keras as keras
 import yfinance as yf
 from concurrent import futures
 from exclusions import EXCLUSIONS
+from tabulate import tabulate
 from tqdm import tqdm
 from scipy import stats
 
@@ -29,6 +37,13 @@ DEFAULT_HISTORY_LOAD = '2y'
 MAX_STOCK_PICK = 8
 MAX_PROPORTION = 0.25
 VOLUME_FILTER_THRESHOLD = 1000000
+# Windows of technical indicators in ML features
+RSI_WINDOW = 14
+MACD_WINDOW_SLOW = 26
+MACD_WINDOW_FAST = 12
+MACD_WINDOW_SIGN = 9
+TSI_WINDOW_SLOW = 25
+TSI_WINDOW_FAST = 13
 ML_FEATURES = [
     'Day_1_Return',
     'Day_2_Return',
@@ -52,7 +67,19 @@ ML_FEATURES = [
     'VIX']
 ALPACA_API_BASE_URL = 'https://api.alpaca.markets'
 ALPACA_PAPER_API_BASE_URL = 'https://paper-api.alpaca.markets'
+POLYGON_API_BASE_URL = 'https://api.polygon.io'
+POLYGON_STREAM_URL = 'wss://socket.polygon.io/stocks'
 DEFAULT_MODEL = 'model_p727217.hdf5'
+# Skips anything up to the first number after a quote prefix
+QUOTE_NUMBER_PATTERN = re.compile(rb'[^0-9]{0,99}([0-9][0-9.,]*)')
+# Fraction of the max rate a rate limiter recovers on each successful request
+RATE_INCREASE = 0.01
+# Factor a rate limiter scales its rate by when throttled
+RATE_DECREASE = 0.5
+
+Stage = collections.namedtuple('Stage', ['name', 'func', 'deps'])
+Scenario = collections.namedtuple('Scenario', ['name', 'market_move', 'symbol_moves'])
+CachedQuote = collections.namedtuple('CachedQuote', ['quote', 'fetch_time', 'etag', 'last_modified'])
 
 
 class NetworkError(Exception):
@@ -63,16 +90,154 @@ class NotFoundError(Exception):
     """Content not found."""
 
 
+class RateLimiter(object):
+    """Token bucket shared by all threads calling the same upstream.
+
+    The rate adapts to observed throttling: it is halved when a request is
+    throttled and recovers additively on successful requests. A throttled
+    request also pauses the whole bucket, so that concurrent threads back off
+    together instead of retrying all at once.
+    """
+
+    def __init__(self, name, max_rate, burst=None, min_rate=None):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate or max_rate / 100
+        self.burst = burst or max_rate
+        self.rate = max_rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.throttled_count = 0
+        self.wait_secs = 0
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = max(-self.tokens / self.rate, self.paused_until - now, 0)
+            self.request_count += 1
+            self.wait_secs += delay
+        return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate * RATE_INCREASE, self.max_rate)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.throttled_count += 1
+            now = time.monotonic()
+            # Concurrent requests are throttled together. Only decrease once for them.
+            if now - self.last_decrease >= 1 / self.rate:
+                self.rate = max(self.rate * RATE_DECREASE, self.min_rate)
+                self.last_decrease = now
+            self.paused_until = max(self.paused_until, now + (retry_after or 1 / self.rate))
+        logging.warning('Requests to %s throttled. Rate decreased to %.1f per second.', self.name, self.rate)
+
+    def call(self, func, *args, **kwargs):
+        """Calls func with a token and adjusts the rate from its outcome."""
+        self.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_throttled(e):
+                self.on_throttle()
+            raise
+        self.on_success()
+        return result
+
+    def get_metrics(self):
+        with self.lock:
+            return {'name': self.name,
+                    'rate': self.rate,
+                    'requests': self.request_count,
+                    'throttled': self.throttled_count,
+                    'wait_secs': self.wait_secs}
+
+
+def is_throttled(e):
+    """Tells whether an exception is caused by HTTP status 429."""
+    status_code = getattr(e, 'status_code', None)
+    response = getattr(e, 'response', None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, 'status_code', None)
+    return status_code == 429
+
+
+# One rate limiter per upstream, shared by all fetch paths
+RATE_LIMITERS = {
+    # Polygon recommends staying under 100 requests per second
+    'polygon': RateLimiter('polygon', 100),
+    # Alpaca allows 200 requests per minute per account
+    'alpaca': RateLimiter('alpaca', 200 / 60, burst=200),
+    'yahoo': RateLimiter('yahoo', 20, burst=50),
+}
+
+
+class RateLimitedClient(object):
+    """Proxies an API client, so that every method call takes a token of a rate limiter.
+
+    The rate limiter is looked up by name at each call.
+    """
+
+    def __init__(self, client, rate_limiter):
+        self.client = client
+        self.rate_limiter = rate_limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return RATE_LIMITERS[self.rate_limiter].call(attr, *args, **kwargs)
+
+        return call
+
+
+def get_rate_limiter_table():
+    rate_limiter_table = []
+    for rate_limiter in RATE_LIMITERS.values():
+        metrics = rate_limiter.get_metrics()
+        rate_limiter_table.append([metrics['name'], '%.1f' % (metrics['rate'],), metrics['requests'],
+                                   metrics['throttled'], '%.1f' % (metrics['wait_secs'],)])
+    return tabulate(rate_limiter_table, headers=['Upstream', 'Rate', 'Requests', 'Throttled', 'Wait Seconds'],
+                    tablefmt='grid')
+
+
 class TradingBase(object):
     """Basic trade utils."""
 
     def __init__(self, alpaca, period=None, start_date=None, end_date=None,
-                 model=None, load_history=True):
+                 model=None, load_history=True, compact=False, float32_prices=False, use_model=True):
+        """Loads the model and histories.
+
+        In compact mode, only closes and volumes are kept from histories, with
+        volumes in float32, and history DataFrames are freed once read out.
+        With float32_prices, closes are kept in float32 as well. Without
+        use_model, no model is loaded, for traders that only track prices.
+        """
         model = model or DEFAULT_MODEL
-        self.alpaca = alpaca
+        self.alpaca = RateLimitedClient(alpaca, 'alpaca')
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
-        self.model = keras.models.load_model(os.path.join(self.root_dir, MODELS_DIR, model))
+        self.model_path = os.path.join(self.root_dir, MODELS_DIR, model) if use_model else None
+        self.model = None
+        self.clock = None
         self.hists, self.closes, self.volumes = {}, {}, {}
+        self.compact = compact
+        self.float32_prices = float32_prices
         self.symbols = []
         self.sectors = {}
         self.period = period
@@ -95,18 +260,55 @@ class TradingBase(object):
         else:
             self.cache_path = os.path.join(cache_root, self.start_date, self.end_date)
         os.makedirs(self.cache_path, exist_ok=True)
-        self.is_market_open = self.alpaca.get_clock().is_open
+        self.startup_times = run_stages(self.get_startup_stages(load_history), 'Startup Stages')
+
+    def get_startup_stages(self, load_history):
+        """Gets stages of initialization. Subclasses add their own stages."""
+        stages = [Stage('model', self.load_model, [])] if self.model_path else []
+        stages.append(Stage('clock', self.load_clock, []))
+        if load_history:
+            stages.extend(self.get_series_stages())
+        return stages
+
+    def get_series_stages(self):
+        """Gets stages to load histories of all symbols and read out their series."""
+        return [Stage('reference_history', self.load_reference_history, ['clock']),
+                Stage('assets', self.load_all_symbols, []),
+                Stage('histories', self.load_histories, ['reference_history', 'assets']),
+                Stage('series', self.read_series_from_histories, ['histories'])]
+
+    def load_all_series(self):
+        """Loads histories of all symbols and reads out their series."""
+        run_stages(self.get_series_stages(), 'Series Loading Stages')
+
+    def load_model(self):
+        self.model = keras.models.load_model(self.model_path)
+
+    def load_clock(self):
+        self.clock = self.alpaca.get_clock()
+        self.is_market_open = self.clock.is_open
+
+    def load_reference_history(self):
         self.history_length = self.get_history_length()
         self.history_dates = self.get_history_dates()
-        if not load_history:
-            return
-        self.load_all_symbols()
-        self.load_histories()
-        self.read_series_from_histories()
+
+    @classmethod
+    def from_series(cls, closes, volumes, model=None):
+        """Creates an instance from loaded series without network access.
+
+        Used in worker processes, which only need series and the model for scoring.
+        """
+        trading = cls.__new__(cls)
+        trading.closes, trading.volumes = closes, volumes
+        trading.hists = {}
+        trading.symbols = list(closes.keys())
+        trading.model = model
+        return trading
 
     def load_all_symbols(self):
         """Loads all tradable symbols on Alpaca."""
-        assets = self.alpaca.list_assets()
+        with profiling.phase('universe_load'):
+            assets = self.alpaca.list_assets()
         self.symbols = (['^VIX'] +
                         [asset.symbol for asset in assets
                          if re.match('^[A-Z]*$', asset.symbol) and asset.symbol not in EXCLUSIONS
@@ -120,7 +322,7 @@ class TradingBase(object):
         # Allow at most 10 errors
         error_tol = 10
 
-        with futures.ThreadPoolExecutor(max_workers=5) as pool:
+        with profiling.phase('history_load'), futures.ThreadPoolExecutor(max_workers=5) as pool:
             for symbol in self.symbols:
                 t = pool.submit(self.load_history, symbol)
                 threads.append(t)
@@ -137,12 +339,34 @@ class TradingBase(object):
     def read_series_from_histories(self):
         """Reads out close price and volume."""
         for symbol, hist in self.hists.items():
-            close = hist.get('Close')
-            volume = hist.get('Volume')
-            self.closes[symbol] = np.array(close)
-            self.volumes[symbol] = np.array(volume)
+            self.read_series(symbol, hist)
+        if self.compact:
+            self.hists = {}
         logging.info('Attempt to load %d symbols, and %d symbols actually loaded',
                      len(self.symbols), len(self.closes))
+        logging.info(get_header('Memory') + '\n' + self.get_memory_table())
+
+    def read_series(self, symbol, hist):
+        self.closes[symbol] = np.array(hist.get('Close'),
+                                       dtype=np.float32 if self.float32_prices else np.float64)
+        self.volumes[symbol] = np.array(hist.get('Volume'),
+                                        dtype=np.float32 if self.compact else np.float64)
+
+    def get_close_series(self, symbol):
+        """Gets closes of a symbol indexed by date."""
+        if symbol in self.hists:
+            return self.hists[symbol].get('Close')
+        return pd.Series(self.closes[symbol], index=self.history_dates)
+
+    def get_memory_table(self):
+        """Gets a table of memory held by series and histories, and of the process."""
+        series_bytes = sum(series.nbytes for series in list(self.closes.values()) + list(self.volumes.values()))
+        hists_bytes = sum(hist.memory_usage(deep=True).sum() for hist in self.hists.values())
+        memory_table = [['Series', '%.1f' % (series_bytes / 2 ** 20,)],
+                        ['Histories', '%.1f' % (hists_bytes / 2 ** 20,)],
+                        ['Current Process', '%.1f' % (get_memory_mb(),)],
+                        ['Peak Process', '%.1f' % (get_peak_memory_mb(),)]]
+        return tabulate(memory_table, headers=['Memory', 'MB'], tablefmt='grid')
 
     @retrying.retry(stop_max_attempt_number=3, wait_fixed=1000)
     def load_history(self, symbol):
@@ -153,9 +377,10 @@ class TradingBase(object):
         else:
             tk = yf.Ticker(symbol)
             if self.period:
-                hist = tk.history(period=self.period, interval='1d')
+                hist = RATE_LIMITERS['yahoo'].call(tk.history, period=self.period, interval='1d')
             else:
-                hist = tk.history(start=self.start_date, end=self.end_date, interval='1d')
+                hist = RATE_LIMITERS['yahoo'].call(tk.history, start=self.start_date, end=self.end_date,
+                                                    interval='1d')
             if len(hist):
                 hist.to_csv(cache_name)
             elif self.period:
@@ -167,7 +392,11 @@ class TradingBase(object):
         if self.is_market_open and drop_key in hist.index:
             hist.drop(drop_key, inplace=True)
         if symbol == REFERENCE_SYMBOL or len(hist) == self.history_length:
-            self.hists[symbol] = hist
+            if self.compact and symbol != REFERENCE_SYMBOL:
+                # Read out right away, so that the DataFrame is freed before the next one loads
+                self.read_series(symbol, hist)
+            else:
+                self.hists[symbol] = hist
         elif symbol in ('QQQ', 'SPY', '^VIX'):
             os.remove(cache_name)
             raise Exception('Error loading %s: expect length %d, but got %d.' % (
@@ -183,6 +412,20 @@ class TradingBase(object):
         self.load_history(REFERENCE_SYMBOL)
         return self.hists[REFERENCE_SYMBOL].index
 
+    def drop_low_volume_symbols(self):
+        """Drops to-be-tracked symbols with low volumes."""
+        dropped_keys = []
+        for symbol in self.closes.keys():
+            avg_trading_volume = np.average(np.multiply(
+                self.closes[symbol][-20:], self.volumes[symbol][-20:]))
+            if avg_trading_volume < VOLUME_FILTER_THRESHOLD and symbol != '^VIX':
+                dropped_keys.append(symbol)
+        for symbol in dropped_keys:
+            self.closes.pop(symbol)
+            self.volumes.pop(symbol)
+        logging.info('%d loaded symbols after drop symbols with cash volume lower than $%.1E',
+                     len(self.closes), VOLUME_FILTER_THRESHOLD)
+
     def get_buy_symbols(self, prices=None, cutoff=None, skip_prediction=False):
         """Gets symbols which trigger buy signals.
 
@@ -190,7 +433,38 @@ class TradingBase(object):
         """
         if not (prices or cutoff) or (prices and cutoff):
             raise Exception('Exactly one of prices or cutoff must be provided')
-        quarterly_volatility = {}
+        with profiling.phase('threshold'):
+            buy_info = self.get_buy_candidates(prices=prices, cutoff=cutoff)
+
+        buy_symbols, ml_features, X = [], [], []
+        with profiling.phase('features'):
+            for symbol in buy_info:
+                ml_feature = self.get_ml_feature(symbol, prices=prices, cutoff=cutoff)
+                x = [ml_feature[key] for key in ML_FEATURES]
+                ml_features.append(ml_feature)
+                X.append(x)
+        if buy_info:
+            X = np.array(X)
+            if skip_prediction:
+                weights = [1] * len(X)
+            else:
+                with profiling.phase('predict'):
+                    weights = self.model.predict(X)
+            buy_symbols = list(zip(buy_info, weights, ml_features))
+        return buy_symbols
+
+    def has_enough_volume(self, symbol, cutoff=None):
+        """Checks if the average cash volume of the last month is above VOLUME_FILTER_THRESHOLD."""
+        if cutoff:
+            close = self.closes[symbol][cutoff - DAYS_IN_A_MONTH:cutoff]
+            volume = self.volumes[symbol][cutoff - DAYS_IN_A_MONTH:cutoff]
+        else:
+            close = self.closes[symbol][-DAYS_IN_A_MONTH:]
+            volume = self.volumes[symbol][-DAYS_IN_A_MONTH:]
+        return np.average(np.multiply(close, volume)) >= VOLUME_FILTER_THRESHOLD
+
+    def get_buy_candidates(self, prices=None, cutoff=None):
+        """Gets symbols with enough trading volume and a weekly return below threshold."""
         iterator = (tqdm(self.closes.items(), ncols=80, leave=False)
                     if cutoff and sys.stdout.isatty() else self.closes.items())
         buy_info = []
@@ -198,17 +472,10 @@ class TradingBase(object):
             # Non-tradable symbols
             if symbol == '^VIX':
                 continue
-            if cutoff:
-                close_year = close[cutoff - DAYS_IN_A_YEAR:cutoff]
-                volumes_year = self.volumes[symbol][cutoff - DAYS_IN_A_YEAR:cutoff]
-            else:
-                close_year = close[-DAYS_IN_A_YEAR:]
-                volumes_year = self.volumes[symbol][-DAYS_IN_A_YEAR:]
-            avg_trading_volume = np.average(np.multiply(
-                close_year[-DAYS_IN_A_MONTH:], volumes_year[-DAYS_IN_A_MONTH:]))
             # Enough trading volume
-            if avg_trading_volume < VOLUME_FILTER_THRESHOLD:
+            if not self.has_enough_volume(symbol, cutoff):
                 continue
+            close_year = close[cutoff - DAYS_IN_A_YEAR:cutoff] if cutoff else close[-DAYS_IN_A_YEAR:]
             # Unable to get realtime price
             if prices and symbol not in prices:
                 continue
@@ -221,36 +488,60 @@ class TradingBase(object):
             if five_day_return > threshold:
                 continue
             buy_info.append(symbol)
+        return buy_info
 
-        buy_symbols, ml_features, X = [], [], []
-        for symbol in buy_info:
-            ml_feature = self.get_ml_feature(symbol, prices=prices, cutoff=cutoff)
-            x = [ml_feature[key] for key in ML_FEATURES]
-            ml_features.append(ml_feature)
-            X.append(x)
-        if buy_info:
-            X = np.array(X)
-            if skip_prediction:
-                weights = [1] * len(X)
-            else:
-                weights = self.model.predict(X)
-            buy_symbols = list(zip(buy_info, weights, ml_features))
-        return buy_symbols
+    def get_scenario_trading_lists(self, scenarios, prices):
+        """Gets trading lists of hypothetical price moves from current prices.
+
+        Each scenario moves all prices but VIX by its market move, and the prices
+        of its symbol moves further. Moves are relative, e.g. -0.01 for a 1% drop.
+        Features of a symbol are computed for all scenarios at once, and features
+        of all scenarios are scored with one batched prediction. A list of
+        (scenario, trading list) tuples is returned.
+        """
+        market_moves = np.array([scenario.market_move for scenario in scenarios])
+        scenario_buy_info = [[] for _ in scenarios]
+        scenario_rows = [[] for _ in scenarios]
+        X = []
+        with profiling.phase('features'):
+            for symbol in self.closes.keys():
+                if symbol == '^VIX' or symbol not in prices or not self.has_enough_volume(symbol):
+                    continue
+                symbol_moves = np.array([scenario.symbol_moves.get(symbol, 0) for scenario in scenarios])
+                symbol_prices = prices[symbol] * (1 + market_moves) * (1 + symbol_moves)
+                five_day_returns = np.log(symbol_prices / self.closes[symbol][-5])
+                is_candidate = five_day_returns <= self.get_threshold(symbol)
+                if not np.any(is_candidate):
+                    continue
+                features = self.get_ml_feature_matrix(symbol, symbol_prices, prices['^VIX'])
+                for i in np.flatnonzero(is_candidate):
+                    scenario_buy_info[i].append(symbol)
+                    scenario_rows[i].append(len(X))
+                    X.append(features[i])
+        with profiling.phase('predict'):
+            weights = self.model.predict(np.array(X)) if X else []
+        scenario_trading_lists = []
+        for scenario, buy_info, rows in zip(scenarios, scenario_buy_info, scenario_rows):
+            buy_symbols = [(symbol, weights[row], dict(zip(ML_FEATURES, X[row])))
+                           for symbol, row in zip(buy_info, rows)]
+            scenario_trading_lists.append((scenario, self.get_trading_list(buy_symbols=buy_symbols)))
+        return scenario_trading_lists
 
     def get_trading_list(self, buy_symbols=None, **kwargs):
         """Gets a list of symbols with trading information."""
         if buy_symbols is None:
             buy_symbols = self.get_buy_symbols(**kwargs)
-        trading_info = []
-        for symbol, classification, _ in buy_symbols:
-            trading_info.append((symbol, classification, 'long'))
-        trading_info.sort(key=lambda s: s[1], reverse=True)
-        n_symbols = min(MAX_STOCK_PICK, len(trading_info))
-        trading_list = []
-        for i in range(len(trading_info)):
-            symbol, weight, side = trading_info[i]
-            proportion = min(1 / n_symbols, MAX_PROPORTION) if i < n_symbols else 0
-            trading_list.append((symbol, proportion, weight, side))
+        with profiling.phase('portfolio_selection'):
+            trading_info = []
+            for symbol, classification, _ in buy_symbols:
+                trading_info.append((symbol, classification, 'long'))
+            trading_info.sort(key=lambda s: s[1], reverse=True)
+            n_symbols = min(MAX_STOCK_PICK, len(trading_info))
+            trading_list = []
+            for i in range(len(trading_info)):
+                symbol, weight, side = trading_info[i]
+                proportion = min(1 / n_symbols, MAX_PROPORTION) if i < n_symbols else 0
+                trading_list.append((symbol, proportion, weight, side))
         return trading_list
 
     def get_ml_feature(self, symbol, prices=None, cutoff=None):
@@ -264,51 +555,166 @@ class TradingBase(object):
 
         if cutoff:
             close = self.closes[symbol][cutoff - DAYS_IN_A_YEAR:cutoff]
-            volume = self.volumes[symbol][cutoff - DAYS_IN_A_YEAR:cutoff]
         else:
             close = self.closes[symbol][-DAYS_IN_A_YEAR:]
-            volume = self.volumes[symbol][-DAYS_IN_A_YEAR:]
         close = np.append(close, price)
+        components = self.get_feature_components(symbol, cutoff)
+        recent_close = np.append(components['Recent_Closes'], price)
 
         # Log returns
-        feature['Day_1_Return'] = np.log(close[-1] / close[-2])
-        feature['Day_2_Return'] = np.log(close[-2] / close[-3])
-        feature['Day_3_Return'] = np.log(close[-3] / close[-4])
-        feature['Weekly_Return'] = np.log(price / close[-DAYS_IN_A_WEEK])
-        feature['Monthly_Return'] = np.log(price / close[-DAYS_IN_A_MONTH])
-        feature['Quarterly_Return'] = np.log(price / close[-DAYS_IN_A_QUARTER])
-        feature['From_Weekly_High'] = np.log(price / np.max(close[-DAYS_IN_A_WEEK:]))
-        feature['From_Weekly_Low'] = np.log(price / np.min(close[-DAYS_IN_A_WEEK:]))
+        feature['Day_1_Return'] = np.log(price / components['Last_Close'])
+        feature['Day_2_Return'] = components['Day_2_Return']
+        feature['Day_3_Return'] = components['Day_3_Return']
+        feature['Weekly_Return'] = np.log(price / components['Weekly_Close'])
+        feature['Monthly_Return'] = np.log(price / components['Monthly_Close'])
+        feature['Quarterly_Return'] = np.log(price / components['Quarterly_Close'])
+        feature['From_Weekly_High'] = np.log(price / np.max(recent_close))
+        feature['From_Weekly_Low'] = np.log(price / np.min(recent_close))
 
         # Technical indicators
         pd_close = pd.Series(close)
-        feature['RSI'] = momentum.rsi(pd_close).values[-1]
-        feature['MACD_Rate'] = trend.macd_diff(pd_close).values[-1] / price
-        feature['TSI'] = momentum.tsi(pd_close).values[-1]
+        feature['RSI'] = momentum.rsi(pd_close, window=RSI_WINDOW).values[-1]
+        feature['MACD_Rate'] = trend.macd_diff(pd_close, window_slow=MACD_WINDOW_SLOW, window_fast=MACD_WINDOW_FAST,
+                                               window_sign=MACD_WINDOW_SIGN).values[-1] / price
+        feature['TSI'] = momentum.tsi(pd_close, window_slow=TSI_WINDOW_SLOW, window_fast=TSI_WINDOW_FAST).values[-1]
 
         # Markets
         feature['VIX'] = vix
 
         # Other numerical factors
         # Fit five data points to a second order polynomial
-        feature['Acceleration'] = (2 * close[-5] - 1 * close[-4] - 2 * close[-3] -
-                                   1 * close[-2] + 2 * close[-1]) / 14
-        feature['Momentum'] = (-2 * close[-5] - 1 * close[-4] +
-                               1 * close[-2] + 2 * close[-1]) / 10
-        quarterly_returns = [np.log(close[i] / close[i - 1])
-                             for i in range(-DAYS_IN_A_QUARTER, -1)]
-        monthly_returns = quarterly_returns[-DAYS_IN_A_MONTH:]
-        weekly_returns = quarterly_returns[-DAYS_IN_A_WEEK:]
-        feature['Monthly_Skewness'] = stats.skew(monthly_returns)
-        feature['Monthly_Volatility'] = np.std(monthly_returns)
-        feature['Weekly_Skewness'] = stats.skew(weekly_returns)
-        feature['Weekly_Volatility'] = np.std(weekly_returns)
-        feature['Z_Score'] = (feature['Day_1_Return'] - np.mean(quarterly_returns)) / np.std(quarterly_returns)
-        feature['Monthly_Avg_Dollar_Volume'] = np.average(np.multiply(
-            close[-DAYS_IN_A_MONTH - 1:-1], volume[-DAYS_IN_A_MONTH:])) / 1E6
+        feature['Acceleration'] = (2 * recent_close[-5] - 1 * recent_close[-4] - 2 * recent_close[-3] -
+                                   1 * recent_close[-2] + 2 * recent_close[-1]) / 14
+        feature['Momentum'] = (-2 * recent_close[-5] - 1 * recent_close[-4] +
+                               1 * recent_close[-2] + 2 * recent_close[-1]) / 10
+        for key in ['Monthly_Skewness', 'Monthly_Volatility', 'Weekly_Skewness', 'Weekly_Volatility',
+                    'Monthly_Avg_Dollar_Volume']:
+            feature[key] = components[key]
+        feature['Z_Score'] = ((feature['Day_1_Return'] - components['Quarterly_Return_Mean']) /
+                              components['Quarterly_Return_Std'])
 
         return feature
 
+    def get_ml_feature_matrix(self, symbol, prices, vix):
+        """Gets ML features of a symbol at an array of hypothetical current prices.
+
+        Returns a matrix with a row of ML_FEATURES for each price. Rows equal
+        features of get_ml_feature, but price-dependent features are computed
+        column-wise for all prices at once.
+        """
+        components = self.get_feature_components(symbol)
+        states = self.get_indicator_states(symbol)
+        recent_closes = components['Recent_Closes']
+        feature = {}
+
+        # Log returns
+        log_prices = np.log(prices)
+        feature['Day_1_Return'] = log_prices - np.log(components['Last_Close'])
+        feature['Day_2_Return'] = components['Day_2_Return']
+        feature['Day_3_Return'] = components['Day_3_Return']
+        feature['Weekly_Return'] = log_prices - np.log(components['Weekly_Close'])
+        feature['Monthly_Return'] = log_prices - np.log(components['Monthly_Close'])
+        feature['Quarterly_Return'] = log_prices - np.log(components['Quarterly_Close'])
+        feature['From_Weekly_High'] = log_prices - np.log(np.maximum(np.max(recent_closes), prices))
+        feature['From_Weekly_Low'] = log_prices - np.log(np.minimum(np.min(recent_closes), prices))
+
+        # Technical indicators, one step of their moving averages from the last close
+        diff = prices - states['Last_Close']
+        rsi_alpha = 1 / RSI_WINDOW
+        up = (1 - rsi_alpha) * states['RSI_Up'] + rsi_alpha * np.maximum(diff, 0)
+        down = (1 - rsi_alpha) * states['RSI_Down'] + rsi_alpha * np.maximum(-diff, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            feature['RSI'] = np.where(down == 0, 100, 100 - 100 / (1 + up / down))
+        ema_fast = _ema_step(states['MACD_Fast'], prices, MACD_WINDOW_FAST)
+        ema_slow = _ema_step(states['MACD_Slow'], prices, MACD_WINDOW_SLOW)
+        macd = ema_fast - ema_slow
+        feature['MACD_Rate'] = (macd - _ema_step(states['MACD_Signal'], macd, MACD_WINDOW_SIGN)) / prices
+        smoothed = _ema_step(states['TSI_Smoothed'],
+                             _ema_step(states['TSI_Diff'], diff, TSI_WINDOW_SLOW), TSI_WINDOW_FAST)
+        smoothed_abs = _ema_step(states['TSI_Smoothed_Abs'],
+                                 _ema_step(states['TSI_Diff_Abs'], np.abs(diff), TSI_WINDOW_SLOW),
+                                 TSI_WINDOW_FAST)
+        feature['TSI'] = smoothed / smoothed_abs * 100
+
+        # Markets
+        feature['VIX'] = vix
+
+        # Other numerical factors
+        feature['Acceleration'] = (2 * recent_closes[-4] - 1 * recent_closes[-3] - 2 * recent_closes[-2] -
+                                   1 * recent_closes[-1] + 2 * prices) / 14
+        feature['Momentum'] = (-2 * recent_closes[-4] - 1 * recent_closes[-3] +
+                               1 * recent_closes[-1] + 2 * prices) / 10
+        for key in ['Monthly_Skewness', 'Monthly_Volatility', 'Weekly_Skewness', 'Weekly_Volatility',
+                    'Monthly_Avg_Dollar_Volume']:
+            feature[key] = components[key]
+        feature['Z_Score'] = ((feature['Day_1_Return'] - components['Quarterly_Return_Mean']) /
+                              components['Quarterly_Return_Std'])
+
+        return np.column_stack([np.broadcast_to(feature[key], np.shape(prices)) for key in ML_FEATURES])
+
+    @functools.lru_cache(maxsize=10000)
+    def get_indicator_states(self, symbol):
+        """Gets moving averages of technical indicators at the last close.
+
+        Indicators of get_ml_feature are exponential moving averages, so their
+        values at a current price are one step from these states.
+        """
+        close = pd.Series(self.closes[symbol][-DAYS_IN_A_YEAR:])
+        diff = close.diff(1)
+        states = {'Last_Close': close.values[-1]}
+        states['RSI_Up'] = diff.where(diff > 0, 0.0).ewm(
+            alpha=1 / RSI_WINDOW, min_periods=RSI_WINDOW, adjust=False).mean().values[-1]
+        states['RSI_Down'] = (-diff.where(diff < 0, 0.0)).ewm(
+            alpha=1 / RSI_WINDOW, min_periods=RSI_WINDOW, adjust=False).mean().values[-1]
+        ema_fast = close.ewm(span=MACD_WINDOW_FAST, min_periods=MACD_WINDOW_FAST, adjust=False).mean()
+        ema_slow = close.ewm(span=MACD_WINDOW_SLOW, min_periods=MACD_WINDOW_SLOW, adjust=False).mean()
+        states['MACD_Fast'] = ema_fast.values[-1]
+        states['MACD_Slow'] = ema_slow.values[-1]
+        states['MACD_Signal'] = (ema_fast - ema_slow).ewm(
+            span=MACD_WINDOW_SIGN, min_periods=MACD_WINDOW_SIGN, adjust=False).mean().values[-1]
+        tsi_diff = diff.ewm(span=TSI_WINDOW_SLOW, min_periods=TSI_WINDOW_SLOW, adjust=False).mean()
+        tsi_diff_abs = diff.abs().ewm(span=TSI_WINDOW_SLOW, min_periods=TSI_WINDOW_SLOW, adjust=False).mean()
+        states['TSI_Diff'] = tsi_diff.values[-1]
+        states['TSI_Diff_Abs'] = tsi_diff_abs.values[-1]
+        states['TSI_Smoothed'] = tsi_diff.ewm(
+            span=TSI_WINDOW_FAST, min_periods=TSI_WINDOW_FAST, adjust=False).mean().values[-1]
+        states['TSI_Smoothed_Abs'] = tsi_diff_abs.ewm(
+            span=TSI_WINDOW_FAST, min_periods=TSI_WINDOW_FAST, adjust=False).mean().values[-1]
+        return states
+
+    @functools.lru_cache(maxsize=10000)
+    def get_feature_components(self, symbol, cutoff=None):
+        """Gets the parts of ML features that do not depend on the current price."""
+        if cutoff:
+            close = self.closes[symbol][cutoff - DAYS_IN_A_YEAR:cutoff]
+            volume = self.volumes[symbol][cutoff - DAYS_IN_A_YEAR:cutoff]
+        else:
+            close = self.closes[symbol][-DAYS_IN_A_YEAR:]
+            volume = self.volumes[symbol][-DAYS_IN_A_YEAR:]
+        components = {}
+        components['Last_Close'] = close[-1]
+        components['Day_2_Return'] = np.log(close[-1] / close[-2])
+        components['Day_3_Return'] = np.log(close[-2] / close[-3])
+        # Closes the weekly, monthly and quarterly returns are measured against
+        components['Weekly_Close'] = close[-DAYS_IN_A_WEEK + 1]
+        components['Monthly_Close'] = close[-DAYS_IN_A_MONTH + 1]
+        components['Quarterly_Close'] = close[-DAYS_IN_A_QUARTER + 1]
+        components['Recent_Closes'] = np.array(close[-DAYS_IN_A_WEEK + 1:])
+
+        # Daily returns of the past quarter, up to the last close
+        quarterly_returns = np.log(close[-DAYS_IN_A_QUARTER + 1:] / close[-DAYS_IN_A_QUARTER:-1])
+        monthly_returns = quarterly_returns[-DAYS_IN_A_MONTH:]
+        weekly_returns = quarterly_returns[-DAYS_IN_A_WEEK:]
+        components['Monthly_Skewness'] = stats.skew(monthly_returns)
+        components['Monthly_Volatility'] = np.std(monthly_returns)
+        components['Weekly_Skewness'] = stats.skew(weekly_returns)
+        components['Weekly_Volatility'] = np.std(weekly_returns)
+        components['Quarterly_Return_Mean'] = np.mean(quarterly_returns)
+        components['Quarterly_Return_Std'] = np.std(quarterly_returns)
+        components['Monthly_Avg_Dollar_Volume'] = np.average(np.multiply(
+            close[-DAYS_IN_A_MONTH:], volume[-DAYS_IN_A_MONTH:])) / 1E6
+        return components
+
     @functools.lru_cache(maxsize=10000)
     def get_threshold(self, symbol, cutoff=None):
         """Gets threshold for a symbol."""
@@ -339,37 +745,194 @@ def get_business_day(offset):
     return '%4d-%02d-%02d' % (day.year, day.month, day.day)
 
 
+def write_series_matrix(directory, closes, volumes):
+    """Writes close and volume series of equal lengths into memory-mappable matrices."""
+    os.makedirs(directory, exist_ok=True)
+    symbols = list(closes.keys())
+    np.save(os.path.join(directory, 'closes.npy'), np.array([closes[symbol] for symbol in symbols]))
+    np.save(os.path.join(directory, 'volumes.npy'), np.array([volumes[symbol] for symbol in symbols]))
+    with open(os.path.join(directory, 'symbols.json'), 'w') as f:
+        f.write(json.dumps(symbols))
+
+
+def map_series_matrix(directory):
+    """Maps matrices written by write_series_matrix read-only.
+
+    Returns dicts of per-symbol rows, which are views into pages shared by
+    every process mapping the same files.
+    """
+    with open(os.path.join(directory, 'symbols.json')) as f:
+        symbols = json.loads(f.read())
+    closes = np.load(os.path.join(directory, 'closes.npy'), mmap_mode='r')
+    volumes = np.load(os.path.join(directory, 'volumes.npy'), mmap_mode='r')
+    return ({symbol: closes[i] for i, symbol in enumerate(symbols)},
+            {symbol: volumes[i] for i, symbol in enumerate(symbols)})
+
+
+def get_free_port():
+    """Gets a free local port for stand-in servers."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def get_memory_mb():
+    """Gets current resident memory of the current process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        # Not available outside Linux
+        return get_peak_memory_mb()
+    return pages * resource.getpagesize() / 2 ** 20
+
+
+def get_peak_memory_mb():
+    """Gets peak resident memory of the current process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _ema_step(previous, values, span):
+    """Gets the next value of an exponential moving average of span, as pandas ewm with adjust=False."""
+    alpha = 2 / (span + 1)
+    return (1 - alpha) * previous + alpha * values
+
+
 def get_header(title):
     header_left = '== [ %s ] ' % (title,)
     return header_left + '=' * (80 - len(header_left))
 
 
+class QuoteScraper(object):
+    """Scrapes quotes from web pages over a persistent session.
+
+    Pages are requested conditionally with the ETag and Last-Modified headers
+    of the previous response, and quotes younger than max_age are served from
+    cache without a request. Responses are parsed on the raw bytes.
+    """
+
+    def __init__(self, timeout=5, rate_limiter='yahoo'):
+        self.timeout = timeout
+        # Name in RATE_LIMITERS, or None not to limit the rate
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def get_quote(self, url, prefixes, max_age=0):
+        key = (url, tuple(prefixes))
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached and time.monotonic() - cached.fetch_time < max_age:
+            return cached.quote
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        rate_limiter = RATE_LIMITERS[self.rate_limiter] if self.rate_limiter else None
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise NetworkError('[%s] %s' % (url, e))
+        if r.status_code == 429 and rate_limiter:
+            rate_limiter.on_throttle()
+        if r.status_code == 304 and cached:
+            quote = cached.quote
+        elif r.status_code != 200:
+            raise NetworkError('[%s] status %d' % (url, r.status_code))
+        else:
+            quote = parse_quote(r.content, prefixes)
+            if quote is None:
+                raise NotFoundError('[%s] %s not found' % (url, prefixes))
+        if rate_limiter:
+            rate_limiter.on_success()
+        with self.lock:
+            self.cache[key] = CachedQuote(quote, time.monotonic(),
+                                          r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return quote
+
+
+def parse_quote(content, prefixes):
+    """Finds the first number within 100 bytes after a prefix in raw page content.
+
+    Returns the number with thousands separators removed, or None if not found.
+    """
+    for prefix in prefixes:
+        prefix = prefix.encode()
+        prefix_pos = content.find(prefix)
+        if prefix_pos < 0:
+            continue
+        match = QUOTE_NUMBER_PATTERN.match(content, prefix_pos + len(prefix))
+        if match and match.end() - prefix_pos < 100:
+            return match.group(1).replace(b',', b'').decode()
+    return None
+
+
+QUOTE_SCRAPER = QuoteScraper()
+
+
 @retrying.retry(stop_max_attempt_number=3, wait_fixed=1000,
                 retry_on_exception=lambda e: isinstance(e, NetworkError))
-def web_scraping(url, prefixes):
-    """Scrapes a webpage for stock price."""
-    try:
-        r = requests.get(url, timeout=5)
-    except requests.exceptions.RequestException as e:
-        raise NetworkError('[%s] %s' % (url, e))
-    if r.status_code != 200:
-        raise NetworkError('[%s] status %d' % (url, r.status_code))
-    c = str(r.content)
-    for prefix in prefixes:
-        prefix_pos = c.find(prefix)
-        if prefix_pos >= 0:
-            pos = prefix_pos + len(prefix)
-            s = ''
-            while c[pos] > '9' or c[pos] < '0':
-                pos += 1
-            while '9' >= c[pos] >= '0' or c[pos] in ['.', ',']:
-                if c[pos] != ',':
-                    s += c[pos]
-                pos += 1
-            if pos - prefix_pos < 100:
-                return s
-    else:
-        raise NotFoundError('[%s] %s not found' % (url, prefixes))
+def web_scraping(url, prefixes, max_age=0):
+    """Scrapes a webpage for stock price.
+
+    Quotes fetched less than max_age seconds ago are returned without a request.
+    """
+    return QUOTE_SCRAPER.get_quote(url, prefixes, max_age)
+
+
+def run_stages(stages, title):
+    """Runs each stage as soon as the stages it depends on have finished.
+
+    Dependencies on stages not in the list are ignored. The first error is
+    raised once running stages finish, and stages depending on a failed stage
+    never start. Start offsets and wall times of stages are logged and returned.
+    """
+    names = set(stage.name for stage in stages)
+    pending = list(stages)
+    done = set()
+    running = {}
+    timeline = collections.OrderedDict()
+    error = None
+    start = time.monotonic()
+
+    def run(func):
+        stage_start = time.monotonic()
+        func()
+        return stage_start - start, time.monotonic() - stage_start
+
+    with futures.ThreadPoolExecutor(max_workers=max(len(stages), 1)) as pool:
+        while pending or running:
+            if error is None:
+                for stage in list(pending):
+                    if all(dep in done or dep not in names for dep in stage.deps):
+                        pending.remove(stage)
+                        running[pool.submit(run, stage.func)] = stage
+            if not running:
+                break
+            finished, _ = futures.wait(running.keys(), return_when=futures.FIRST_COMPLETED)
+            for f in finished:
+                stage = running.pop(f)
+                try:
+                    timeline[stage.name] = f.result()
+                except Exception as e:
+                    error = error or e
+                else:
+                    done.add(stage.name)
+    if error:
+        raise error
+    if pending:
+        raise ValueError('Stages with unmet dependencies: %s' % (', '.join(stage.name for stage in pending),))
+    stage_table = [[name, '%.2f' % (offset,), '%.2f' % (seconds,)] for name, (offset, seconds) in timeline.items()]
+    stage_table.append(['Total', '', '%.2f' % (time.monotonic() - start,)])
+    logging.info(get_header(title) + '\n' +
+                 tabulate(stage_table, headers=['Stage', 'Start', 'Seconds'], tablefmt='grid'))
+    return timeline
 
 
 def logging_config(logging_file=None):
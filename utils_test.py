@@ -1,28 +1,123 @@
 import collections
 import requests
+import time
 import unittest
 import unittest.mock as mock
 import utils
 
-Response = collections.namedtuple('Response', ['status_code', 'content'])
+Response = collections.namedtuple('Response', ['status_code', 'content', 'headers'])
 
 
 class UtilsTest(unittest.TestCase):
 
     def test_web_scraping_success(self):
         fake_response = Response(
-            200, b'{volume: 100, price: 1,325.17, symbol: QQQ}')
-        with mock.patch.object(requests, 'get', return_value=fake_response):
+            200, b'{volume: 100, price: 1,325.17, symbol: QQQ}', {})
+        with mock.patch.object(requests.Session, 'get', return_value=fake_response):
             price = utils.web_scraping('fake_url', 'price')
         self.assertEqual(price, '1325.17')
 
     def test_web_scraping_network_error(self):
-        fake_response = Response(404, b'')
-        with mock.patch.object(requests, 'get', return_value=fake_response) as fake_get:
+        fake_response = Response(404, b'', {})
+        with mock.patch.object(requests.Session, 'get', return_value=fake_response) as fake_get:
             with self.assertRaises(utils.NetworkError):
                 utils.web_scraping('fake_url', 'price')
         self.assertEqual(fake_get.call_count, 3)
 
+    def test_web_scraping_throttled(self):
+        fake_response = Response(429, b'', {})
+        rate_limiter = utils.RateLimiter('yahoo', 10)
+        with mock.patch.object(requests.Session, 'get', return_value=fake_response), \
+                mock.patch.dict(utils.RATE_LIMITERS, {'yahoo': rate_limiter}):
+            with self.assertRaises(utils.NetworkError):
+                utils.web_scraping('fake_url', 'price')
+        self.assertEqual(rate_limiter.get_metrics()['throttled'], 3)
+        self.assertLess(rate_limiter.rate, 10)
+
+    def test_parse_quote(self):
+        content = b'<span>"regularMarketPrice":{"raw":25.13,"fmt":"25.13"}</span>'
+        self.assertEqual(utils.parse_quote(content, ['"currentPrice"', '"regularMarketPrice"']), '25.13')
+        self.assertIsNone(utils.parse_quote(content, ['"currentPrice"']))
+        self.assertIsNone(utils.parse_quote(b'"currentPrice"' + b' ' * 100 + b'25.13', ['"currentPrice"']))
+
+    def test_quote_scraper_conditional_request(self):
+        scraper = utils.QuoteScraper()
+        with mock.patch.object(requests.Session, 'get',
+                               side_effect=[Response(200, b'price: 25.13', {'ETag': 'fake_etag'}),
+                                            Response(304, b'', {'ETag': 'fake_etag'})]) as fake_get:
+            self.assertEqual(scraper.get_quote('fake_url', ['price']), '25.13')
+            self.assertEqual(scraper.get_quote('fake_url', ['price']), '25.13')
+        self.assertEqual(fake_get.call_args[1]['headers'], {'If-None-Match': 'fake_etag'})
+
+    def test_quote_scraper_max_age(self):
+        scraper = utils.QuoteScraper()
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=Response(200, b'price: 25.13', {})) as fake_get:
+            self.assertEqual(scraper.get_quote('fake_url', ['price'], max_age=10), '25.13')
+            self.assertEqual(scraper.get_quote('fake_url', ['price'], max_age=10), '25.13')
+            scraper.get_quote('fake_url', ['price'])
+        self.assertEqual(fake_get.call_count, 2)
+
+    def test_rate_limiter_reserve(self):
+        with mock.patch.object(time, 'monotonic', return_value=100):
+            rate_limiter = utils.RateLimiter('fake', 10, burst=2)
+            self.assertEqual([rate_limiter.reserve() for _ in range(4)], [0, 0, 0.1, 0.2])
+        with mock.patch.object(time, 'monotonic', return_value=101):
+            # Refilled to burst
+            self.assertEqual(rate_limiter.reserve(), 0)
+
+    def test_rate_limiter_adapt(self):
+        with mock.patch.object(time, 'monotonic', return_value=100):
+            rate_limiter = utils.RateLimiter('fake', 10, burst=10)
+            rate_limiter.on_throttle(retry_after=2)
+            # Concurrent throttling only decreases the rate once
+            rate_limiter.on_throttle()
+            self.assertEqual(rate_limiter.rate, 5)
+            self.assertEqual(rate_limiter.reserve(), 2)
+        for _ in range(10):
+            rate_limiter.on_success()
+        self.assertAlmostEqual(rate_limiter.rate, 6)
+        metrics = rate_limiter.get_metrics()
+        self.assertEqual((metrics['requests'], metrics['throttled']), (1, 2))
+
+    def test_rate_limiter_call(self):
+        rate_limiter = utils.RateLimiter('fake', 1000)
+        throttled = mock.Mock(side_effect=requests.exceptions.HTTPError(response=Response(429, b'', {})))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            rate_limiter.call(throttled)
+        self.assertEqual(rate_limiter.rate, 500)
+        self.assertEqual(rate_limiter.call(lambda x: x + 1, 1), 2)
+        self.assertEqual(rate_limiter.rate, 510)
+
+    def test_rate_limited_client(self):
+        rate_limiter = utils.RateLimiter('fake', 1000)
+        client = mock.Mock(base_url='fake_url')
+        client.get_account.return_value = 'fake_account'
+        with mock.patch.dict(utils.RATE_LIMITERS, {'fake': rate_limiter}):
+            rate_limited_client = utils.RateLimitedClient(client, 'fake')
+            self.assertEqual(rate_limited_client.get_account(), 'fake_account')
+            self.assertEqual(rate_limited_client.base_url, 'fake_url')
+        client.get_account.assert_called_once_with()
+        self.assertEqual(rate_limiter.get_metrics()['requests'], 1)
+
+    def test_run_stages(self):
+        finished = []
+        stages = [utils.Stage('b', lambda: finished.append('b'), ['a']),
+                  utils.Stage('a', lambda: finished.append('a'), []),
+                  # Dependencies on stages not in the list are ignored
+                  utils.Stage('c', lambda: finished.append('c'), ['x'])]
+        timeline = utils.run_stages(stages, 'Test Stages')
+        self.assertEqual(set(timeline.keys()), {'a', 'b', 'c'})
+        self.assertLess(finished.index('a'), finished.index('b'))
+
+    def test_run_stages_error(self):
+        dependent = mock.Mock()
+        stages = [utils.Stage('a', mock.Mock(side_effect=ValueError('Test error')), []),
+                  utils.Stage('b', dependent, ['a'])]
+        with self.assertRaises(ValueError):
+            utils.run_stages(stages, 'Test Stages')
+        dependent.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
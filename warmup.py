@@ -0,0 +1,111 @@
+import alpaca_trade_api as tradeapi
+import argparse
+import logging
+import numpy as np
+import os
+import pickle
+import time
+import utils
+
+WARMUP_DIR = 'warmup'
+META_FILE = 'meta.pickle'
+
+
+def get_warmup_dir(root_dir, day=None):
+    """Gets the directory of the warm-up artifact of a trading day."""
+    return os.path.join(root_dir, utils.OUTPUTS_DIR, 'realtime',
+                        day or utils.get_business_day(0), WARMUP_DIR)
+
+
+def prepare_inputs(trading):
+    """Computes price-independent realtime inputs of all loaded symbols.
+
+    Returns thresholds, volatilities of weekly returns and ML feature components.
+    """
+    thresholds, volatilities, feature_components = {}, {}, {}
+    for symbol in trading.closes.keys():
+        thresholds[symbol] = trading.get_threshold(symbol)
+        # Volatility of weekly returns, estimated from daily returns of the last month
+        volatilities[symbol] = (trading.get_volatility(symbol, utils.DAYS_IN_A_MONTH) *
+                                np.sqrt(utils.DAYS_IN_A_WEEK))
+        if symbol != '^VIX':
+            feature_components[symbol] = trading.get_feature_components(symbol)
+    return thresholds, volatilities, feature_components
+
+
+def has_artifact(directory):
+    return os.path.isfile(os.path.join(directory, META_FILE))
+
+
+def write_artifact(directory, trading, inputs, shared=False):
+    """Writes series matrices and precomputed inputs.
+
+    The meta file is written last, so that its existence marks a complete artifact.
+    A shared artifact is not tied to a model, and is used by consumers of any model.
+    """
+    utils.write_series_matrix(directory, trading.closes, trading.volumes)
+    thresholds, volatilities, feature_components = inputs
+    meta = {'model': None if shared else os.path.basename(trading.model_path),
+            # Trading dates of the series, so that consumers need not load the reference history
+            'history_dates': trading.history_dates,
+            'thresholds': thresholds,
+            'volatilities': volatilities,
+            'feature_components': feature_components}
+    tmp_file = os.path.join(directory, META_FILE + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, os.path.join(directory, META_FILE))
+
+
+def read_artifact(directory):
+    """Maps series matrices read-only and loads precomputed inputs.
+
+    Returns closes, volumes and the meta dict written by write_artifact.
+    """
+    closes, volumes = utils.map_series_matrix(directory)
+    with open(os.path.join(directory, META_FILE), 'rb') as f:
+        meta = pickle.load(f)
+    return closes, volumes, meta
+
+
+def warm_up(alpaca, model=None):
+    """Loads histories and precomputes realtime inputs of the current trading day."""
+    start = time.monotonic()
+    trading = utils.TradingBase(alpaca, model=model)
+    load_secs = time.monotonic() - start
+    trading.drop_low_volume_symbols()
+    start = time.monotonic()
+    inputs = prepare_inputs(trading)
+    prepare_secs = time.monotonic() - start
+    directory = get_warmup_dir(trading.root_dir)
+    write_artifact(directory, trading, inputs)
+    logging.info('Warm-up artifact of %d symbols written to %s. '
+                 'Loading took %.1f seconds and preparing inputs took %.1f seconds.',
+                 len(trading.closes), directory, load_secs, prepare_secs)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stock trading pre-market warm-up.')
+    parser.add_argument('--api_key', default=None, help='Alpaca API key.')
+    parser.add_argument('--api_secret', default=None, help='Alpaca API secret.')
+    parser.add_argument('--real_trade', help='Trade with real money.',
+                        action="store_true")
+    parser.add_argument('--model', default=None, help='Model file name.')
+    args = parser.parse_args()
+
+    if args.api_key and args.api_secret or args.real_trade:
+        api_key = args.api_key or os.environ['ALPACA_API_KEY']
+        api_secret = args.api_secret or os.environ['ALPACA_API_SECRET']
+        base_url = utils.ALPACA_API_BASE_URL
+    else:
+        api_key = os.environ['ALPACA_PAPER_API_KEY']
+        api_secret = os.environ['ALPACA_PAPER_API_SECRET']
+        base_url = utils.ALPACA_PAPER_API_BASE_URL
+    utils.logging_config()
+    alpaca = tradeapi.REST(api_key, api_secret, base_url, 'v2')
+    warm_up(alpaca, args.model)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import unittest
+import utils
+import warmup
+
+
+class WarmUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        closes = {symbol: np.random.random(300) * 10 + 100 for symbol in ['^VIX', 'SYMA', 'SYMB']}
+        volumes = {symbol: np.random.random(300) * 1E6 for symbol in closes.keys()}
+        self.trading = utils.TradingBase.from_series(closes, volumes)
+        self.trading.model_path = os.path.join('models', utils.DEFAULT_MODEL)
+        self.trading.history_dates = pd.bdate_range(end='2020-06-30', periods=300)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_prepare_inputs(self):
+        thresholds, volatilities, feature_components = warmup.prepare_inputs(self.trading)
+        self.assertEqual(set(thresholds.keys()), {'^VIX', 'SYMA', 'SYMB'})
+        self.assertEqual(set(volatilities.keys()), {'^VIX', 'SYMA', 'SYMB'})
+        self.assertEqual(set(feature_components.keys()), {'SYMA', 'SYMB'})
+
+    def test_write_and_read_artifact(self):
+        self.assertFalse(warmup.has_artifact(self.dir.name))
+        inputs = warmup.prepare_inputs(self.trading)
+        warmup.write_artifact(self.dir.name, self.trading, inputs)
+        self.assertTrue(warmup.has_artifact(self.dir.name))
+        closes, volumes, meta = warmup.read_artifact(self.dir.name)
+        np.testing.assert_array_equal(closes['SYMA'], self.trading.closes['SYMA'])
+        np.testing.assert_array_equal(volumes['SYMB'], self.trading.volumes['SYMB'])
+        self.assertEqual(meta['model'], utils.DEFAULT_MODEL)
+        self.assertEqual(meta['thresholds'], inputs[0])
+        self.assertTrue(meta['history_dates'].equals(self.trading.history_dates))
+
+
+if __name__ == '__main__':
+    unittest.main()